@@ -0,0 +1,305 @@
+import json
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Default behaviour of each fake service. Latencies are in seconds.
+DEFAULT_CONFIG = {
+    "openrouter": {
+        "latency": 0.8,           # Time to first token
+        "jitter": 0.2,            # Uniform +/- jitter added to the latency
+        "error_rate": 0.0,        # Probability of answering 503
+        "tokens_per_second": 400, # Generation speed (one token ~ 4 characters)
+        "themes": 8,              # Number of themes returned by theme extraction
+        "facts": 8,               # Number of facts returned by refinement
+        "questions": 6,           # Number of questions returned by refinement
+        "fact_length": 120,       # Characters per fact
+        "invalid_answer_rate": 0.0, # Probability of a question whose correct answer isn't one of its options
+        "malformed_rate": 0.0,    # Probability of a JSON completion in a markdown fence with a trailing comma
+        "slow_rate": 0.0,         # Probability of a slow-tail completion (e.g. a congested provider)
+        "slow_latency": 5.0,      # Extra time to first token of a slow-tail completion
+        "keepalive": 0.25         # Seconds between keep-alive comments of a stream waiting for its first token
+    },
+    "sparql": {
+        "latency": 0.6,
+        "per_entity": 0.05,       # Extra latency per entity in the VALUES clause
+        "jitter": 0.2,
+        "error_rate": 0.0,
+        "triples_per_entity": 15,
+        "link_every": 3           # Every n-th value links to another entity (0 for literals only)
+    },
+    "wikidata": {
+        "latency": 0.15,
+        "jitter": 0.05,
+        "error_rate": 0.0
+    }
+}
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that give up (e.g. at their deadline) close the connection mid-response
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+
+class FakeServices:
+    """
+    Local stand-ins for the OpenRouter chat-completions API (with SSE streaming), the Wikidata
+    SPARQL endpoint and the Wikidata action API, with configurable latency, jitter, error rate
+    and payload sizes. All three are served by one threaded HTTP server:
+        /chat     OpenRouter chat completions
+        /sparql   Wikidata query service (SPARQL JSON results with IDs, like a query without the label service)
+        /api.php  Wikidata action API (wbsearchentities, wbgetentities)
+    """
+
+    def __init__(self, config=None, host="127.0.0.1", port=0, seed=None):
+        """
+        Args:
+            config (dict): Per-service settings merged over DEFAULT_CONFIG.
+            host (str): The interface to bind.
+            port (int): The port to listen on (0 picks a free port).
+            seed (int): Seed of the random generator used for jitter and errors.
+        """
+        self.config = {name: {**values, **(config or {}).get(name, {})} for name, values in DEFAULT_CONFIG.items()}
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.requests = {name: 0 for name in DEFAULT_CONFIG}
+        self.server = FakeServer((host, port), self.handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def keys(self, **overrides):
+        """
+        Build a keys.json dictionary pointing the engine at the fake services.
+        Args:
+            **overrides: Extra settings (e.g. CACHE_ENABLED, RATE_LIMITS).
+        Returns:
+            dict: The settings dictionary.
+        """
+        return {
+            "OPENROUTER_API_KEY": "benchmark",
+            "OPENROUTER_API_URL": f"{self.url}/chat",
+            "OPENROUTER_API_MODEL": "benchmark/fake-model",
+            "SPARQL_ENDPOINT": f"{self.url}/sparql",
+            "WIKIDATA_API_URL": f"{self.url}/api.php",
+            # Labels come from the fake wbgetentities, not from a property table built for the real Wikidata
+            "PROPERTY_LABELS_PATH": None,
+            **overrides
+        }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def latency(self, service, extra=0.0):
+        settings = self.config[service]
+        with self.random_lock:
+            jitter = self.random.uniform(-settings["jitter"], settings["jitter"])
+        return max(0.0, settings["latency"] + extra + jitter)
+
+    def delay(self, service, extra=0.0):
+        time.sleep(self.latency(service, extra))
+
+    def token(self):
+        with self.random_lock:
+            return " ".join(f"{self.random.getrandbits(32):08x}" for _ in range(4))
+
+    def chance(self, probability):
+        with self.random_lock:
+            return self.random.random() < probability
+
+    def fails(self, service):
+        with self.random_lock:
+            self.requests[service] += 1
+            return self.random.random() < self.config[service]["error_rate"]
+
+    def handler(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                if url.path == "/sparql":
+                    self.sparql(params.get("query", ""))
+                elif url.path == "/api.php" and params.get("action") == "wbgetentities":
+                    self.entities(params)
+                elif url.path == "/api.php":
+                    self.search(params)
+                else:
+                    self.sendJSON({"error": "not found"}, status=404)
+
+            def do_POST(self):
+                if urlparse(self.path).path != "/chat":
+                    self.sendJSON({"error": "not found"}, status=404)
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                self.chat(json.loads(self.rfile.read(length) or b"{}"))
+
+            # ---------- Services ----------
+
+            def search(self, params):
+                if services.fails("wikidata"):
+                    return self.unavailable()
+                services.delay("wikidata")
+                term = params.get("search", "")
+                qid = f"Q{zlib.crc32(term.lower().encode('utf-8')) % 1000000 + 1}"
+                self.sendJSON({"search": [{"id": qid, "label": term, "match": {"type": "label", "text": term}}]})
+
+            def entities(self, params):
+                if services.fails("wikidata"):
+                    return self.unavailable()
+                services.delay("wikidata")
+                entities = {}
+                for id in params.get("ids", "").split("|"):
+                    label = f"property {int(id[1:]) - 1000}" if id.startswith("P") else f"entity {id}"
+                    entities[id] = {"id": id, "labels": {"en": {"language": "en", "value": label}}}
+                self.sendJSON({"entities": entities})
+
+            def sparql(self, query):
+                if services.fails("sparql"):
+                    return self.unavailable()
+                values = re.search(r"VALUES \?item \{([^}]*)\}", query)
+                qids = re.findall(r"wd:(Q\d+)", values.group(1) if values else query)
+                services.delay("sparql", services.config["sparql"]["per_entity"] * len(qids))
+                settings = services.config["sparql"]
+                bindings = []
+                for qid in qids:
+                    for i in range(settings["triples_per_entity"]):
+                        label = f"value {i} of {qid}"
+                        # Every link_every-th value is another entity (followed by the multi-hop expansion)
+                        if settings["link_every"] and i % settings["link_every"] == 0:
+                            value = {"type": "uri", "value": f"http://www.wikidata.org/entity/Q{zlib.crc32(label.encode('utf-8')) % 1000000 + 1}"}
+                        else:
+                            value = {"type": "literal", "value": label}
+                        bindings.append({
+                            "item": {"type": "uri", "value": f"http://www.wikidata.org/entity/{qid}"},
+                            "property": {"type": "uri", "value": f"http://www.wikidata.org/entity/P{1000 + i}"},
+                            "value": value
+                        })
+                self.sendJSON({"head": {"vars": ["item", "property", "value"]}, "results": {"bindings": bindings}})
+
+            def chat(self, payload):
+                if services.fails("openrouter"):
+                    return self.unavailable()
+                settings = services.config["openrouter"]
+                messages = payload.get("messages", [])
+                system_msg = messages[0]["content"] if len(messages) > 1 else ""
+                user_msg = messages[-1]["content"] if messages else ""
+                json_mode = bool(payload.get("response_format"))
+                content = self.completion(system_msg, user_msg, settings, json_mode)
+                if json_mode:
+                    content = json.dumps(content)
+                    if services.chance(settings["malformed_rate"]):
+                        content = f"```json\n{content[:-1]},{content[-1]}\n```"
+                usage = {
+                    "prompt_tokens": sum(len(m["content"]) for m in messages) // 4,
+                    "completion_tokens": len(content) // 4
+                }
+
+                latency = services.latency("openrouter", settings["slow_latency"] if services.chance(settings["slow_rate"]) else 0.0)
+                chars_per_second = settings["tokens_per_second"] * 4
+                if not payload.get("stream"):
+                    time.sleep(latency + len(content) / chars_per_second)
+                    return self.sendJSON({
+                        "id": "fake", "model": payload.get("model"),
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                        "usage": usage
+                    })
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                # Like OpenRouter, keep-alive comments are sent until the first token (a client that
+                # closed the stream is noticed on the next write)
+                waited = 0.0
+                while True:
+                    self.writeChunk(": OPENROUTER PROCESSING\n\n")
+                    if waited >= latency:
+                        break
+                    time.sleep(min(settings["keepalive"], latency - waited))
+                    waited += settings["keepalive"]
+                step = 16
+                for i in range(0, len(content), step):
+                    time.sleep(step / chars_per_second)
+                    event = {"choices": [{"index": 0, "delta": {"content": content[i:i + step]}}]}
+                    self.writeChunk(f"data: {json.dumps(event)}\n\n")
+                self.writeChunk(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n")
+                self.writeChunk("data: [DONE]\n\n")
+                self.writeChunk("")
+
+            def completion(self, system_msg, user_msg, settings, json_mode):
+                topic = user_msg.split("\n", 1)[0].replace("Original question:", "").strip()[:60] or "topic"
+                if "themes" in system_msg.lower() and "triples" not in system_msg.lower():
+                    return [topic] + [f"{topic} subtopic {i}" for i in range(1, settings["themes"])]
+                filler = ("lorem ipsum dolor sit amet " * (settings["fact_length"] // 27 + 1))[:settings["fact_length"]]
+                if not json_mode:
+                    return f"Summary about {topic}. {filler}"
+                # Only the keys of the JSON structure the system message asks for (all of them by default)
+                keys = [key for key in ("facts", "questions", "summary") if f'"{key}"' in system_msg] or ["facts", "questions", "summary"]
+                # Replacements of invalid items must differ from the items already kept
+                variant = f" ({services.token()})" if "were invalid" in system_msg else ""
+                content = {
+                    "facts": [f"Fact {i} about {topic}{variant}: {filler}" for i in range(settings["facts"])],
+                    "questions": [
+                        {
+                            "question": f"Question {i} about {topic}{variant}?",
+                            "options": [f"Option {i}{letter}" for letter in "ABCD"],
+                            "correct_answer": f"Option {i}E" if services.chance(settings["invalid_answer_rate"]) else f"Option {i}A"
+                        }
+                        for i in range(settings["questions"])
+                    ],
+                    "summary": f"Summary about {topic}. {filler}"
+                }
+                return {key: content[key] for key in keys}
+
+            # ---------- Helpers ----------
+
+            def unavailable(self):
+                self.sendJSON({"error": "unavailable"}, status=503, headers={"Retry-After": "0"})
+
+            def sendJSON(self, data, status=200, headers=None):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def writeChunk(self, text):
+                data = text.encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
@@ -0,0 +1,241 @@
+"""
+Offline end-to-end benchmark of KnowledgeEngine.getCombinedResponse.
+
+Starts local fake OpenRouter/SPARQL/wbsearchentities services, points a KnowledgeEngine at them
+through a generated keys.json and drives the pipeline at several concurrency levels, reporting
+throughput, p50/p95/p99 latency and a per-stage breakdown.
+
+Usage:
+    python bench/benchmark.py --requests 20 --concurrency 1 4 8
+    python bench/benchmark.py --config bench_config.json --json results.json
+    python bench/benchmark.py --baseline results.json --tolerance 0.2
+    python bench/benchmark.py --deadline 5 --config slow_services.json
+    python bench/benchmark.py --lazy
+    python bench/benchmark.py --themes llm local --topics topics.txt
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from FakeServices import FakeServices
+from KnowledgeEngine import KnowledgeEngine
+from Tracing import percentile
+
+
+def runLevel(keys_path, concurrency, requests, stream=False, repeat_topics=False, deadline=None, lazy=False, extractor="llm", topics=None):
+    """
+    Run a batch of generations at a fixed concurrency with a fresh engine.
+    Args:
+        keys_path (str): Path to the keys.json pointing at the fake services.
+        concurrency (int): Number of generations running at the same time.
+        requests (int): Total number of generations.
+        stream (bool): Use getCombinedResponseStream instead of getCombinedResponse.
+        repeat_topics (bool): Reuse the same topics across levels (measures warm caches).
+        deadline (float): End-to-end latency budget of every generation (None for no budget).
+        lazy (bool): Use getLazyResponse and measure the time to the summary (the first card).
+        extractor (str): Theme extraction of every generation, "llm" or "local".
+        topics (list): Prompts cycled through by the generations (generated topic names by default).
+    Returns:
+        dict: Throughput, latency percentiles, failures, degraded responses and per-stage statistics.
+    """
+    engine = KnowledgeEngine(keys_path)
+    prefix = "topic" if repeat_topics else f"topic-c{concurrency}"
+
+    def generate(i):
+        prompt = topics[i % len(topics)] if topics else f"{prefix}-{i}"
+        start = time.perf_counter()
+        if lazy:
+            response = engine.getLazyResponse(prompt, deadline=deadline, extractor=extractor)
+            ok = bool(response and response.values.get("summary"))
+            return time.perf_counter() - start, ok, bool(response and response.get("degraded"))
+        if stream:
+            response = None
+            for key, value in engine.getCombinedResponseStream(prompt, deadline=deadline, extractor=extractor):
+                if key == "result":
+                    response = value
+        else:
+            response = engine.getCombinedResponse(prompt, deadline=deadline, extractor=extractor)
+        ok = bool(response and (response.get("facts") or response.get("questions")))
+        return time.perf_counter() - start, ok, bool(response and response.get("degraded"))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(generate, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _, _ in results)
+    stages = {
+        stage: {key: data.get(key) for key in ("count", "p50", "p95", "p99", "bytes_received", "triples", "triples_in", "themes", "resolved", "cache_hits")}
+        for stage, data in engine.tracer.summary().items()
+    }
+    return {
+        "extractor": extractor,
+        "concurrency": concurrency,
+        "requests": requests,
+        "failures": sum(1 for _, ok, _ in results if not ok),
+        "degraded": sum(1 for _, _, degraded in results if degraded),
+        "seconds": elapsed,
+        "throughput": requests / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "stages": stages,
+        "http": engine.transport.metrics(),
+        "validation": engine.validation.stats(),
+        "hedge": engine.hedge.stats() if engine.hedge is not None else {},
+        "library": engine.library.stats() if engine.library is not None else {},
+        "local_themes": engine.local_themes.stats()
+    }
+
+
+def printReport(results):
+    print()
+    print(f"{'conc':>5} {'reqs':>5} {'fail':>5} {'degr':>5} {'req/s':>8} {'p50 (s)':>9} {'p95 (s)':>9} {'p99 (s)':>9}")
+    for r in results:
+        print(f"{r['concurrency']:>5} {r['requests']:>5} {r['failures']:>5} {r.get('degraded', 0):>5} {r['throughput']:>8.2f} "
+              f"{r['p50']:>9.3f} {r['p95']:>9.3f} {r['p99']:>9.3f}")
+
+    for r in results:
+        print(f"\nStages at concurrency {r['concurrency']}:")
+        print(f"  {'stage':<22} {'count':>6} {'p50 (s)':>9} {'p95 (s)':>9} {'p99 (s)':>9}")
+        for stage, data in sorted(r["stages"].items(), key=lambda item: -(item[1]["p95"] or 0)):
+            print(f"  {stage:<22} {data['count']:>6} {data['p50']:>9.3f} {data['p95']:>9.3f} {data['p99']:>9.3f}")
+        if r.get("validation"):
+            print(f"  {'output':<22} {'repaired':>9} {'invalid':>8} {'regen':>6} {'regen items':>12}")
+            for output, data in sorted(r["validation"].items()):
+                print(f"  {output:<22} {data['repair_rate']:>8.0%} {data['invalid_items']:>8} {data['regeneration_rate']:>6.0%} {data['regenerated_items']:>12}")
+        if r.get("library", {}).get("lookups"):
+            library = r["library"]
+            print(f"  deck library: {library['hit_rate']:.0%} hits ({library['exact_hits']} exact, {library['close_hits']} close, "
+                  f"{library['entity_hits']} same entity of {library['lookups']} lookups)")
+        if r.get("hedge"):
+            print(f"  {'hedged stage':<22} {'requests':>9} {'hedged':>7} {'backup':>7} {'saved (s)':>10} {'delay (s)':>10}")
+            for stage, data in sorted(r["hedge"].items()):
+                print(f"  {stage:<22} {data['requests']:>9} {data['hedge_rate']:>7.0%} {data['backup_wins']:>7} {data['saved_seconds']:>10.2f} {data['delay']:>10.2f}")
+
+
+def printThemeComparison(results):
+    """
+    Compare the theme extraction paths: latency of extractThemes and downstream yield per generation
+    (themes, resolved themes, triples fetched and triples kept after ranking).
+    """
+    print("\nTheme extraction:")
+    print(f"  {'extractor':<10} {'conc':>5} {'p50 (s)':>9} {'p95 (s)':>9} {'local':>6} {'themes':>7} {'resolved':>9} {'fetched':>8} {'kept':>6}")
+    for r in results:
+        themes = r["stages"].get("extractThemes") or {}
+        pipeline = r["stages"].get("pipeline") or r["stages"].get("getThemesID") or {}
+        ranked = r["stages"].get("rankTriples") or {}
+        per_request = lambda value: (value or 0) / r["requests"]
+        print(f"  {r['extractor']:<10} {r['concurrency']:>5} {themes.get('p50') or 0:>9.3f} {themes.get('p95') or 0:>9.3f} "
+              f"{r['local_themes']['local_rate'] if r['extractor'] == 'local' else 0:>6.0%} {per_request(pipeline.get('themes')):>7.1f} "
+              f"{per_request(pipeline.get('resolved')):>9.1f} {per_request(ranked.get('triples_in')):>8.1f} {per_request(ranked.get('triples')):>6.1f}")
+
+
+def compareBaseline(results, baseline_path, tolerance):
+    """
+    Compare p95 latency and throughput with a previous run.
+    Args:
+        results (list): The results of this run.
+        baseline_path (str): JSON file written by a previous run (--json).
+        tolerance (float): Allowed relative regression (e.g. 0.2 for 20%).
+    Returns:
+        list: A list of regression messages (empty if none).
+    """
+    with open(baseline_path) as f:
+        baseline = {r["concurrency"]: r for r in json.load(f)["results"]}
+
+    regressions = []
+    for r in results:
+        base = baseline.get(r["concurrency"])
+        if not base:
+            continue
+        if r["p95"] > base["p95"] * (1 + tolerance):
+            regressions.append(f"concurrency {r['concurrency']}: p95 {base['p95']:.3f}s -> {r['p95']:.3f}s")
+        if r["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"concurrency {r['concurrency']}: throughput {base['throughput']:.2f} -> {r['throughput']:.2f} req/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the KnowledgeEngine pipeline.")
+    parser.add_argument("--requests", type=int, default=20, help="Generations per concurrency level.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8], help="Concurrency levels to run.")
+    parser.add_argument("--config", help="JSON file with FakeServices settings (see FakeServices.DEFAULT_CONFIG).")
+    parser.add_argument("--keys", help="JSON file with extra keys.json settings for the engine.")
+    parser.add_argument("--stream", action="store_true", help="Use the streaming pipeline.")
+    parser.add_argument("--cache", action="store_true", help="Keep the on-disk cache and the deck library enabled (disabled by default).")
+    parser.add_argument("--repeat-topics", action="store_true", help="Reuse topics across levels to measure warm caches.")
+    parser.add_argument("--lazy", action="store_true", help="Generate the summary only (time to the first card).")
+    parser.add_argument("--deadline", type=float, help="End-to-end latency budget (seconds) of every generation.")
+    parser.add_argument("--themes", nargs="+", choices=["llm", "local"], default=["llm"], help="Theme extraction paths to run (and compare).")
+    parser.add_argument("--topics", help="File of prompts (one per line) used instead of generated topic names.")
+    parser.add_argument("--verbose", action="store_true", help="Show the engine's log output.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the fake services' jitter and errors.")
+    parser.add_argument("--json", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Fail if p95 or throughput regress against this JSON file.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression for --baseline.")
+    args = parser.parse_args()
+
+    config = {}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+    topics = None
+    if args.topics:
+        with open(args.topics, encoding="utf-8") as f:
+            topics = [line.strip() for line in f if line.strip()]
+    extra_keys = {}
+    if args.keys:
+        with open(args.keys) as f:
+            extra_keys = json.load(f)
+
+    with FakeServices(config, seed=args.seed) as services, tempfile.TemporaryDirectory() as tmp:
+        keys = services.keys(
+            CACHE_ENABLED=args.cache,
+            CACHE_PATH=os.path.join(tmp, "cache.sqlite"),
+            DECK_LIBRARY_ENABLED=args.cache,
+            DECK_LIBRARY_PATH=os.path.join(tmp, "decks.sqlite"),
+            **extra_keys
+        )
+        keys_path = os.path.join(tmp, "keys.json")
+        with open(keys_path, "w") as f:
+            json.dump(keys, f)
+
+        results = []
+        for extractor in args.themes:
+            for concurrency in args.concurrency:
+                print(f"[Benchmark]: {extractor} themes, concurrency {concurrency}, {args.requests} requests...")
+                output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+                with output:
+                    results.append(runLevel(
+                        keys_path, concurrency, args.requests, args.stream, args.repeat_topics, args.deadline, args.lazy, extractor, topics
+                    ))
+
+    printReport(results)
+    if len(args.themes) > 1 or args.themes != ["llm"]:
+        printThemeComparison(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": services.config, "results": results}, f, indent=2)
+
+    if args.baseline:
+        regressions = compareBaseline(results, args.baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for message in regressions:
+                print(f"  {message}")
+            sys.exit(1)
+        print("\nNo regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Default time-to-live (seconds) for each kind of cached result
+DEFAULT_TTLS = {
+    "lookup": 30 * 24 * 3600,
+    "sparql": 7 * 24 * 3600,
+    "llm": 24 * 3600,
+    "label": 30 * 24 * 3600,
+}
+
+MISSING = object()
+
+
+class Cache:
+    """
+    Two-tier cache: an in-process LRU in front of an on-disk SQLite table.
+    Keys are content-addressed (hash of the kind and the arguments) so entries are shared
+    across restarts, Streamlit sessions and worker processes using the same file.
+    Values must be JSON serializable.
+    """
+
+    def __init__(self, path, memory_size=512, disk_size=50000, ttls=None):
+        """
+        Args:
+            path (str): Path to the SQLite file (None keeps the cache in memory only).
+            memory_size (int): Maximum number of entries in the in-process tier.
+            disk_size (int): Maximum number of entries in the on-disk tier.
+            ttls (dict): Time-to-live in seconds per kind, merged over DEFAULT_TTLS.
+        """
+        self.path = path
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+
+        self._memory = OrderedDict()
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._writes = 0
+        self._stats = {}
+
+        if self.path:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._connection().execute(
+                    "CREATE TABLE IF NOT EXISTS cache ("
+                    "key TEXT PRIMARY KEY, kind TEXT, value TEXT, expires REAL, accessed REAL)"
+                )
+                self._connection().execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache(accessed)")
+            except sqlite3.Error as e:
+                print(f"[Cache - Disk Tier Disabled]: {e}")
+                self.path = None
+
+    @staticmethod
+    def key(kind, *parts):
+        """
+        Build a content-addressed key for a cached result.
+        Args:
+            kind (str): The kind of result (e.g. lookup, sparql, llm).
+            *parts: JSON serializable values identifying the result.
+        Returns:
+            str: The hex digest key.
+        """
+        raw = json.dumps([kind, *parts], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, kind, key):
+        """
+        Look up a cached value, first in memory and then on disk.
+        Args:
+            kind (str): The kind of result.
+            key (str): The key built with Cache.key.
+        Returns:
+            The cached value, or MISSING if there is no valid entry.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > now:
+                    self._memory.move_to_end(key)
+                    self._count(kind, "memory_hits")
+                    return value
+                del self._memory[key]
+
+        if self.path:
+            try:
+                connection = self._connection()
+                row = connection.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+                if row and row[1] > now:
+                    connection.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+                    value = json.loads(row[0])
+                    self._remember(key, row[1], value)
+                    self._count(kind, "disk_hits")
+                    return value
+            except sqlite3.Error as e:
+                print(f"[Cache - Read Error]: {e}")
+
+        self._count(kind, "misses")
+        return MISSING
+
+    def set(self, kind, key, value):
+        """
+        Store a value in both tiers.
+        Args:
+            kind (str): The kind of result (selects the TTL).
+            key (str): The key built with Cache.key.
+            value: A JSON serializable value.
+        """
+        now = time.time()
+        expires = now + self.ttls.get(kind, DEFAULT_TTLS["llm"])
+        self._remember(key, expires, value)
+
+        if self.path:
+            try:
+                connection = self._connection()
+                connection.execute(
+                    "INSERT OR REPLACE INTO cache (key, kind, value, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+                    (key, kind, json.dumps(value, ensure_ascii=False), expires, now)
+                )
+                with self._lock:
+                    self._writes += 1
+                    evict = self._writes % 100 == 0
+                if evict:
+                    self._evict(connection, now)
+            except sqlite3.Error as e:
+                print(f"[Cache - Write Error]: {e}")
+
+    def stats(self):
+        """
+        Get the hit/miss counters per kind.
+        Returns:
+            dict: A dictionary mapping each kind to its memory_hits, disk_hits and misses.
+        """
+        with self._lock:
+            return {kind: dict(counters) for kind, counters in self._stats.items()}
+
+    def clear(self):
+        """
+        Remove every entry from both tiers.
+        """
+        with self._lock:
+            self._memory.clear()
+        if self.path:
+            self._connection().execute("DELETE FROM cache")
+
+    def _remember(self, key, expires, value):
+        with self._lock:
+            self._memory[key] = (expires, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def _evict(self, connection, now):
+        # Drop expired entries, then the least recently used ones over the size limit
+        connection.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+        connection.execute(
+            "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self.disk_size,)
+        )
+
+    def _count(self, kind, counter):
+        with self._lock:
+            counters = self._stats.setdefault(kind, {"memory_hits": 0, "disk_hits": 0, "misses": 0})
+            counters[counter] += 1
+
+    def _connection(self):
+        # SQLite connections can't be shared between threads, so keep one per thread
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
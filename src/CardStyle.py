@@ -0,0 +1,87 @@
+"""
+Flashcard styling shared by the Streamlit UI (HTML/CSS) and the server-side deck exporter (Pillow).
+"""
+import re
+
+POST_IT_COLORS = ["#cdfc93", "#ff7ecd", "#71d7ff", "#ce81ff", "#fff68b"]
+SHARED_CARD_STYLE = (
+    "background: {bg_color}; "
+    "padding: 25px 20px; "
+    "border-radius: 12px; "
+    "max-width: 600px; "
+    "box-shadow: 5px 7px 15px rgba(0,0,0,0.3); "
+    "font-family: 'Comic Sans MS', cursive, sans-serif; "
+    "border: 2px solid {border_color}; "
+    "margin-top: 20px; "
+    "position: relative;"
+)
+
+STICKER_DECORATION = (
+    "position: absolute; "
+    "top: 0px; "
+    "left: -15px; "
+    "width: 60px; "
+    "height: 15px; "
+    "background: repeating-linear-gradient(45deg, #FFD580, #FFD580 5px, #FFA500 5px, #FFA500 10px); "
+    "border-radius: 3px; "
+    "box-shadow: 0 1px 3px rgba(0,0,0,0.15); "
+    "transform: rotate(-40deg);"
+)
+
+
+def darker_color(hex_color, amount=30):
+    hex_color = hex_color.lstrip('#')
+    r, g, b = [int(hex_color[i:i+2], 16) for i in (0, 2, 4)]
+    r, g, b = max(r - amount, 0), max(g - amount, 0), max(b - amount, 0)
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+
+def parseStyle(style):
+    """
+    Parse a CSS declaration string into a dictionary.
+    Args:
+        style (str): The declarations (e.g. SHARED_CARD_STYLE).
+    Returns:
+        dict: A dictionary mapping properties to their values.
+    """
+    declarations = {}
+    for declaration in style.split(";"):
+        if ":" in declaration:
+            name, value = declaration.split(":", 1)
+            declarations[name.strip()] = value.strip()
+    return declarations
+
+
+def pixels(value):
+    """
+    Get the pixel lengths of a CSS value (e.g. "25px 20px" -> [25, 20]).
+    """
+    return [int(float(number)) for number in re.findall(r"(-?[\d.]+)px", value)]
+
+
+def imageStyle():
+    """
+    Translate the card and sticker CSS into the measures used to draw cards with Pillow.
+    Returns:
+        dict: Padding, radius, width, border, shadow and sticker measures in pixels.
+    """
+    card = parseStyle(SHARED_CARD_STYLE)
+    sticker = parseStyle(STICKER_DECORATION)
+    shadow = re.match(r"(-?\d+)px (-?\d+)px (\d+)px rgba\((\d+),\s*(\d+),\s*(\d+),\s*([\d.]+)\)", card["box-shadow"])
+    stripes = re.findall(r"(#[0-9A-Fa-f]{6}) (\d+)px", sticker["background"])
+    padding = pixels(card["padding"])
+    return {
+        "padding_y": padding[0],
+        "padding_x": padding[-1],
+        "radius": pixels(card["border-radius"])[0],
+        "width": pixels(card["max-width"])[0],
+        "border": pixels(card["border"])[0],
+        "shadow_offset": (int(shadow.group(1)), int(shadow.group(2))),
+        "shadow_blur": int(shadow.group(3)),
+        "shadow_color": (int(shadow.group(4)), int(shadow.group(5)), int(shadow.group(6)), int(float(shadow.group(7)) * 255)),
+        "sticker_size": (pixels(sticker["width"])[0], pixels(sticker["height"])[0]),
+        "sticker_position": (pixels(sticker["left"])[0], pixels(sticker["top"])[0]),
+        "sticker_angle": float(re.search(r"rotate\((-?[\d.]+)deg\)", sticker["transform"]).group(1)),
+        "sticker_stripes": [color for color, _ in stripes[::2]],
+        "sticker_stripe_width": int(stripes[1][1]) if len(stripes) > 1 else 5
+    }
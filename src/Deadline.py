@@ -0,0 +1,133 @@
+import contextlib
+import contextvars
+import threading
+import time
+
+# Default split of an end-to-end budget between the pipeline stages. Time left over by a stage
+# rolls over to the next ones, and the last stage always ends at the overall deadline.
+STAGE_SHARES = {"themes": 0.2, "triples": 0.3, "refine": 0.5}
+
+_current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    Raised when a request can't start (or go on) because the current deadline has passed.
+    """
+
+
+class Deadline:
+    """
+    End-to-end latency budget of one generation. Stage deadlines are children of the overall
+    deadline that share its record of degraded parts.
+    """
+
+    def __init__(self, seconds, shares=None):
+        """
+        Args:
+            seconds (float): The budget.
+            shares (dict): Fraction of the budget given to each stage, in stage order (defaults to STAGE_SHARES).
+        """
+        self.start = time.monotonic()
+        self.seconds = seconds
+        self.end = self.start + seconds
+        self.shares = shares or STAGE_SHARES
+        self.name = None
+        self.degraded = {}
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        return max(0.0, self.end - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.end
+
+    def timeout(self, default=None):
+        """
+        Cap a request timeout to the time left.
+        Args:
+            default (float): The timeout the request would use without a deadline (None for no timeout).
+        Returns:
+            float: The capped timeout.
+        Raises:
+            DeadlineExceeded: If the deadline has passed.
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"deadline of {self.name or 'the generation'} exceeded")
+        return remaining if default is None else min(default, remaining)
+
+    def child(self, name):
+        """
+        Build the deadline of a stage: it ends once the shares of the stages up to this one are spent.
+        Args:
+            name (str): The stage name (a key of the shares).
+        Returns:
+            Deadline: The stage deadline.
+        """
+        stages = list(self.shares)
+        fraction = sum(self.shares[stage] for stage in stages[:stages.index(name) + 1]) if name in self.shares else 1.0
+        stage = Deadline.__new__(Deadline)
+        stage.__dict__.update(self.__dict__)
+        stage.name = name
+        stage.end = self.end if name == stages[-1] else min(self.end, self.start + self.seconds * fraction)
+        return stage
+
+    def degrade(self, part, reason):
+        # The first (most specific) reason of a part is kept
+        with self.lock:
+            self.degraded.setdefault(part, reason)
+        print(f"[Deadline - Degraded {part}]: {reason}")
+
+    def report(self):
+        """
+        Get the parts of the response that were degraded to meet the deadline.
+        Returns:
+            dict: A dictionary mapping parts (themes, triples, refine) to the reason.
+        """
+        with self.lock:
+            return dict(self.degraded)
+
+
+def currentDeadline():
+    return _current_deadline.get()
+
+
+@contextlib.contextmanager
+def activate(deadline):
+    """
+    Run the enclosed code under a deadline (None runs it without one).
+    Args:
+        deadline (Deadline): The deadline.
+    """
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+@contextlib.contextmanager
+def deadlineStage(name):
+    """
+    Run the enclosed code under the deadline of a stage of the current deadline, if any.
+    Args:
+        name (str): The stage name.
+    Yields:
+        Deadline: The stage deadline, or None without a current deadline.
+    """
+    deadline = _current_deadline.get()
+    with activate(deadline.child(name) if deadline else None) as stage:
+        yield stage
+
+
+def degrade(part, reason):
+    """
+    Record that a part of the response was degraded to meet the current deadline (no-op without one).
+    Args:
+        part (str): The degraded part (themes, triples, refine).
+        reason (str): What was skipped or cut.
+    """
+    deadline = _current_deadline.get()
+    if deadline is not None:
+        deadline.degrade(part, reason)
@@ -0,0 +1,474 @@
+"""
+Server-side export of whole decks (summary, facts and questions) to PNG, PDF and Anki.
+
+Cards are drawn with Pillow from the same style as the app's flashcards (CardStyle). Rendered
+cards are cached by the hash of their content, so exporting a deck again (or in another format)
+only renders the cards that changed, and large decks are rendered across a pool of processes.
+
+Usage:
+    python src/DeckExporter.py decks.jsonl --format pdf -o exports/
+    python src/DeckExporter.py decks.jsonl --format png anki -o exports/ --workers 8
+"""
+import argparse
+import functools
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+from CardStyle import POST_IT_COLORS, SHARED_CARD_STYLE, STICKER_DECORATION, darker_color, imageStyle
+
+try:
+    import genanki
+except ImportError:
+    genanki = None
+
+# Bump when the drawing changes so cached cards are rendered again
+RENDER_VERSION = 1
+
+FORMATS = ("png", "pdf", "anki")
+EXTENSIONS = {"png": "zip", "pdf": "pdf", "anki": "apkg"}
+
+# Fonts tried in order: the app's Comic Sans, then common system fonts
+REGULAR_FONTS = ["comic.ttf", "Comic Sans MS.ttf", "DejaVuSans.ttf", "Arial.ttf", "LiberationSans-Regular.ttf"]
+BOLD_FONTS = ["comicbd.ttf", "Comic Sans MS Bold.ttf", "DejaVuSans-Bold.ttf", "Arial Bold.ttf", "LiberationSans-Bold.ttf"]
+TITLE_SIZE = 19
+TEXT_SIZE = 16
+LINE_SPACING = 1.35
+
+# Emoji and pictographs (the card fonts can't draw them)
+EMOJI = re.compile("[\U0001F000-\U0001FAFF\u2600-\u27BF\uFE0F\u200D]")
+
+# Stable Anki IDs, so re-importing an export updates the existing notes
+ANKI_MODEL_ID = 1607392319
+ANKI_MODEL_CSS = ".card { font-family: 'Comic Sans MS', cursive, sans-serif; font-size: 16px; color: #000000; }"
+
+
+def deckCards(prompt, response):
+    """
+    List the cards of a deck: the summary, then every fact, then every question.
+    Args:
+        prompt (str): The prompt (theme) of the deck.
+        response (dict): The response of getCombinedResponse (or LazyResponse.toDict()).
+    Returns:
+        list: Cards as dictionaries with a kind, a title, the front text and the back text (answer).
+    """
+    cards = []
+    if response.get("summary"):
+        cards.append({"kind": "summary", "title": f"About {prompt}", "front": response["summary"], "back": ""})
+    for i, fact in enumerate(response.get("facts") or []):
+        cards.append({"kind": "fact", "title": f"Fact {i + 1}", "front": fact, "back": ""})
+    for i, question in enumerate(response.get("questions") or []):
+        options = "\n".join(f"{chr(ord('A') + j)}) {option}" for j, option in enumerate(question.get("options", [])))
+        cards.append({
+            "kind": "question",
+            "title": f"Question {i + 1}",
+            "front": f"{question.get('question', '')}\n\n{options}".strip(),
+            "back": f"Answer: {question.get('correct_answer', '')}"
+        })
+    return cards
+
+
+def cardColor(index):
+    return POST_IT_COLORS[index % len(POST_IT_COLORS)]
+
+
+def cardHash(card, color, scale):
+    """
+    Get the content hash of a rendered card (its render cache key).
+    """
+    data = json.dumps([RENDER_VERSION, card["title"], card["front"], card["back"], color, scale], ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def loadFont(bold, size):
+    for name in BOLD_FONTS if bold else REGULAR_FONTS:
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    return ImageFont.load_default(size=size)
+
+
+def wrapText(text, font, width):
+    """
+    Wrap text to a width in pixels, keeping its line breaks (like white-space: pre-wrap).
+    Args:
+        text (str): The text.
+        font (ImageFont): The font it is drawn with.
+        width (int): The maximum line width in pixels.
+    Returns:
+        list: The lines.
+    """
+    lines = []
+    for paragraph in EMOJI.sub("", text).split("\n"):
+        line = ""
+        for word in paragraph.split(" "):
+            candidate = f"{line} {word}" if line else word
+            if font.getlength(candidate) <= width or not line:
+                line = candidate
+            else:
+                lines.append(line)
+                line = word
+            # Words longer than a line are split
+            while font.getlength(line) > width and len(line) > 1:
+                cut = len(line)
+                while cut > 1 and font.getlength(line[:cut]) > width:
+                    cut -= 1
+                lines.append(line[:cut])
+                line = line[cut:]
+        lines.append(line)
+    return lines
+
+
+def drawSticker(style, scale):
+    # The striped tape of STICKER_DECORATION, rotated like its CSS transform
+    width, height = (round(size * scale) for size in style["sticker_size"])
+    stripe = style["sticker_stripe_width"] * scale
+    colors = style["sticker_stripes"]
+    tape = Image.new("RGBA", (width, height))
+    draw = ImageDraw.Draw(tape)
+    for i, x in enumerate(range(-height, width + height, max(1, round(stripe)))):
+        draw.polygon([(x, height), (x + height, 0), (x + height + stripe, 0), (x + stripe, height)], fill=colors[i % len(colors)])
+    mask = Image.new("L", (width, height))
+    ImageDraw.Draw(mask).rounded_rectangle((0, 0, width - 1, height - 1), radius=round(3 * scale), fill=255)
+    tape.putalpha(mask)
+    # CSS rotates clockwise, Pillow counter-clockwise
+    return tape.rotate(-style["sticker_angle"], resample=Image.BICUBIC, expand=True)
+
+
+def renderCard(card, color, scale=2):
+    """
+    Draw a card like the app's flashcards: post-it background, darker border, drop shadow and sticker.
+    Module-level (and font caches per process) so it can run in a process pool.
+    Args:
+        card (dict): A card of deckCards.
+        color (str): The background color (e.g. one of POST_IT_COLORS).
+        scale (float): Pixel density (2 renders at twice the CSS size).
+    Returns:
+        bytes: The card as a PNG image with a transparent background.
+    """
+    style = imageStyle()
+    s = lambda value: round(value * scale)
+    title_font = loadFont(True, s(TITLE_SIZE))
+    text_font = loadFont(False, s(TEXT_SIZE))
+
+    # Layout inside the border and padding of the card
+    card_width = s(style["width"])
+    inset_x = s(style["border"] + style["padding_x"])
+    inset_y = s(style["border"] + style["padding_y"])
+    text_width = card_width - 2 * inset_x
+    title_lines = wrapText(card["title"], title_font, text_width)
+    text_lines = wrapText(card["front"], text_font, text_width)
+    if card["back"]:
+        text_lines += [""] + wrapText(card["back"], text_font, text_width)
+    title_height = round(s(TITLE_SIZE) * LINE_SPACING)
+    text_height = round(s(TEXT_SIZE) * LINE_SPACING)
+    card_height = 2 * inset_y + title_height * len(title_lines) + s(10) + text_height * len(text_lines)
+
+    # Room around the card for the shadow and the sticker sticking out
+    margin = s(style["shadow_blur"] + max(style["shadow_offset"]) + 5)
+    image = Image.new("RGBA", (card_width + 2 * margin, card_height + 2 * margin))
+    box = (margin, margin, margin + card_width - 1, margin + card_height - 1)
+
+    shadow = Image.new("RGBA", image.size)
+    dx, dy = (s(offset) for offset in style["shadow_offset"])
+    ImageDraw.Draw(shadow).rounded_rectangle(
+        (box[0] + dx, box[1] + dy, box[2] + dx, box[3] + dy), radius=s(style["radius"]), fill=style["shadow_color"]
+    )
+    image.alpha_composite(shadow.filter(ImageFilter.GaussianBlur(s(style["shadow_blur"]) / 2)))
+
+    draw = ImageDraw.Draw(image)
+    draw.rounded_rectangle(box, radius=s(style["radius"]), fill=color, outline=darker_color(color), width=max(1, s(style["border"])))
+
+    y = margin + inset_y
+    for line in title_lines:
+        draw.text((margin + inset_x, y), line, font=title_font, fill="#000000")
+        y += title_height
+    y += s(10)
+    for line in text_lines:
+        draw.text((margin + inset_x, y), line, font=text_font, fill="#000000")
+        y += text_height
+
+    # The sticker is positioned (and rotated around its center) relative to the card's padding box
+    sticker = drawSticker(style, scale)
+    left, top = style["sticker_position"]
+    width, height = style["sticker_size"]
+    center_x = margin + s(style["border"] + left + width / 2)
+    center_y = margin + s(style["border"] + top + height / 2)
+    image.alpha_composite(sticker, (center_x - sticker.width // 2, center_y - sticker.height // 2))
+
+    output = io.BytesIO()
+    image.save(output, format="PNG", optimize=True)
+    return output.getvalue()
+
+
+def renderTask(task):
+    card, color, scale = task
+    return renderCard(card, color, scale)
+
+
+def slugify(text):
+    return re.sub(r"[^\w-]+", "_", text.strip()).strip("_")[:80] or "deck"
+
+
+class DeckExporter:
+    """
+    Renders and packages decks. Rendered cards are kept in an in-memory LRU tier and, with a cache
+    directory, as <hash>.png files shared by all sessions and processes.
+    """
+
+    def __init__(self, cache_dir=None, workers=4, scale=2, parallel_threshold=8, memory_size=256):
+        """
+        Args:
+            cache_dir (str): Directory of the on-disk render cache (None keeps rendered cards in memory only).
+            workers (int): Processes rendering large batches (1 renders in the calling thread).
+            scale (float): Pixel density of the images.
+            parallel_threshold (int): Minimum number of cards to render before the process pool is used.
+            memory_size (int): Maximum cards kept in the in-memory tier.
+        """
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.scale = scale
+        self.parallel_threshold = parallel_threshold
+        self.memory_size = memory_size
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = None
+        self.counters = {"hits": 0, "misses": 0, "rendered": 0}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def cacheGet(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.counters["hits"] += 1
+                return self.memory[key]
+        path = os.path.join(self.cache_dir, f"{key}.png") if self.cache_dir else None
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                image = f.read()
+            self.cacheSet(key, image, persist=False)
+            with self.lock:
+                self.counters["hits"] += 1
+            return image
+        with self.lock:
+            self.counters["misses"] += 1
+        return None
+
+    def cacheSet(self, key, image, persist=True):
+        with self.lock:
+            self.memory[key] = image
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_size:
+                self.memory.popitem(last=False)
+        if persist and self.cache_dir:
+            # Write then rename so concurrent exporters never read a partial file
+            path = os.path.join(self.cache_dir, f"{key}.png")
+            temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp, "wb") as f:
+                f.write(image)
+            os.replace(temp, path)
+
+    def renderCards(self, cards, colors=None):
+        """
+        Render cards, taking the ones already rendered from the cache.
+        Args:
+            cards (list): Cards of deckCards.
+            colors (list): Background color per card (defaults to cycling through POST_IT_COLORS).
+        Returns:
+            list: The PNG images of the cards, in order.
+        """
+        colors = colors or [cardColor(i) for i in range(len(cards))]
+        keys = [cardHash(card, color, self.scale) for card, color in zip(cards, colors)]
+        images = [self.cacheGet(key) for key in keys]
+
+        # Render each missing card once, even if it appears several times in the batch
+        missing = {}
+        for i, image in enumerate(images):
+            if image is None:
+                missing.setdefault(keys[i], (cards[i], colors[i], self.scale))
+        if missing:
+            if self.workers > 1 and len(missing) >= self.parallel_threshold:
+                rendered = list(self.pool().map(renderTask, missing.values(), chunksize=max(1, len(missing) // (self.workers * 4))))
+            else:
+                rendered = [renderTask(task) for task in missing.values()]
+            rendered = dict(zip(missing, rendered))
+            for key, image in rendered.items():
+                self.cacheSet(key, image)
+            with self.lock:
+                self.counters["rendered"] += len(rendered)
+            images = [image if image is not None else rendered[key] for image, key in zip(images, keys)]
+            print(f"[Export - Render]: {len(rendered)} cards rendered, {len(cards) - len(rendered)} from cache")
+        return images
+
+    def pool(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self.executor
+
+    def cardPNG(self, card, color):
+        """
+        Get the PNG image of a single card (e.g. the one on screen).
+        """
+        return self.renderCards([card], [color])[0]
+
+    def toPNG(self, prompt, response):
+        """
+        Export a deck as a zip of PNG images, one per card.
+        Args:
+            prompt (str): The prompt of the deck.
+            response (dict): The response of getCombinedResponse.
+        Returns:
+            bytes: The zip file.
+        """
+        cards = deckCards(prompt, response)
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_STORED) as archive:
+            # PNG images are already compressed
+            for i, (card, image) in enumerate(zip(cards, self.renderCards(cards))):
+                archive.writestr(f"{slugify(prompt)}/{i + 1:02d}_{card['kind']}.png", image)
+        return output.getvalue()
+
+    def toPDF(self, prompt, response):
+        """
+        Export a deck as a PDF with one card per page.
+        Returns:
+            bytes: The PDF file.
+        """
+        pages = []
+        for image in self.renderCards(deckCards(prompt, response)):
+            card = Image.open(io.BytesIO(image))
+            page = Image.new("RGB", card.size, "#ffffff")
+            page.paste(card, mask=card)
+            pages.append(page)
+        if not pages:
+            raise ValueError(f"The deck of {prompt} has no cards")
+        output = io.BytesIO()
+        pages[0].save(output, format="PDF", save_all=True, append_images=pages[1:], resolution=72 * self.scale, title=prompt)
+        return output.getvalue()
+
+    def toAnki(self, prompt, response):
+        """
+        Export a deck as an Anki package: one note per card, with the answer of questions on the back.
+        Returns:
+            bytes: The .apkg file.
+        Raises:
+            ImportError: If genanki isn't installed.
+        """
+        if genanki is None:
+            raise ImportError("Anki export requires genanki (pip install genanki)")
+
+        model = genanki.Model(
+            ANKI_MODEL_ID,
+            "AutoFlash card",
+            fields=[{"name": "Title"}, {"name": "Front"}, {"name": "Back"}, {"name": "Color"}, {"name": "Border"}],
+            templates=[{
+                "name": "Card",
+                "qfmt": cardTemplate("{{Title}}", "{{Front}}"),
+                "afmt": cardTemplate("{{Title}}", "{{Front}}<hr id=answer>{{Back}}")
+            }],
+            css=ANKI_MODEL_CSS
+        )
+        deck = genanki.Deck(int(hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8], 16), f"AutoFlash::{prompt}")
+        for i, card in enumerate(deckCards(prompt, response)):
+            color = cardColor(i)
+            deck.add_note(genanki.Note(
+                model=model,
+                fields=[card["title"], htmlText(card["front"]), htmlText(card["back"]), color, darker_color(color)],
+                guid=genanki.guid_for(prompt, card["kind"], card["title"])
+            ))
+
+        # genanki only writes packages to files
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "deck.apkg")
+            genanki.Package(deck).write_to_file(path)
+            with open(path, "rb") as f:
+                return f.read()
+
+    def export(self, prompt, response, format):
+        """
+        Export a deck.
+        Args:
+            prompt (str): The prompt of the deck.
+            response (dict): The response of getCombinedResponse.
+            format (str): png (zip of images), pdf or anki.
+        Returns:
+            tuple: The file contents and its suggested file name.
+        """
+        exporters = {"png": self.toPNG, "pdf": self.toPDF, "anki": self.toAnki}
+        if format not in exporters:
+            raise ValueError(f"Unknown export format: {format} (expected one of {', '.join(FORMATS)})")
+        return exporters[format](prompt, response), f"{slugify(prompt)}.{EXTENSIONS[format]}"
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def close(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown()
+
+
+def htmlText(text):
+    return EMOJI.sub("", text).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("\n", "<br>")
+
+
+def cardTemplate(title, content):
+    # Same card HTML as UI.render_card, with the colors taken from the note fields
+    base_style = SHARED_CARD_STYLE.format(bg_color="{{Color}}", border_color="{{Border}}")
+    return (
+        f"<div style='position: relative; margin: 15px auto; text-align: left; {base_style}'>"
+        f"<div style='{STICKER_DECORATION}'></div>"
+        f"<h3 style='color: #000000; margin-bottom: 10px;'>{title}</h3>"
+        f"<p style='font-size: 16px; color: #000000; margin: 0;'>{content}</p>"
+        "</div>"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export decks generated by src/batch.py as PNG, PDF or Anki files.")
+    parser.add_argument("decks", help="JSONL file of decks (the output of src/batch.py).")
+    parser.add_argument("--format", nargs="+", choices=FORMATS, default=["pdf"], help="Export formats.")
+    parser.add_argument("-o", "--output", default="exports", help="Directory receiving the exported files.")
+    parser.add_argument("--cache-dir", default=os.path.join(os.path.dirname(__file__), "../.cache", "cards"), help="Render cache directory.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="Rendering processes.")
+    parser.add_argument("--scale", type=float, default=2, help="Pixel density of the images.")
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    exporter = DeckExporter(args.cache_dir, workers=args.workers, scale=args.scale)
+    try:
+        with open(args.decks, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                deck = json.loads(line)
+                if deck.get("error") or not deck.get("response"):
+                    print(f"[Export - Skipped]: {deck.get('topic')} ({deck.get('error') or 'no response'})")
+                    continue
+                for format in args.format:
+                    data, name = exporter.export(deck["topic"], deck["response"], format)
+                    with open(os.path.join(args.output, name), "wb") as output:
+                        output.write(data)
+                    print(f"[Export - Done]: {deck['topic']} -> {name}")
+    finally:
+        exporter.close()
+    print(f"[Export]: {exporter.stats()}")
+
+
+if __name__ == "__main__":
+    main()
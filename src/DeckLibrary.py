@@ -0,0 +1,470 @@
+"""
+Persistent deck library.
+
+Every generated deck is saved in SQLite with its themes, QIDs and triples, with an FTS5 index over
+the topic, themes, facts and questions. Generating a topic that is already in the library (or one
+whose name closely matches a stored topic, found through a trigram index of the topics) serves the
+stored deck instead of running the pipeline, and so does a topic whose main theme resolves to the
+entity of a stored deck with mostly the same themes ("DNA" / "Deoxyribonucleic acid").
+Listing and searching read one page of deck summaries at a time, whatever the size of the library.
+
+Usage:
+    python src/DeckLibrary.py list --db .cache/decks.sqlite --page 2
+    python src/DeckLibrary.py search "roman empire" --db .cache/decks.sqlite
+    python src/DeckLibrary.py show 42 --db .cache/decks.sqlite
+    python src/DeckLibrary.py import decks.jsonl --db .cache/decks.sqlite
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import Levenshtein
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS decks (
+    id INTEGER PRIMARY KEY,
+    topic TEXT NOT NULL,
+    normalized TEXT NOT NULL UNIQUE,
+    model TEXT,
+    themes TEXT NOT NULL,
+    qids TEXT NOT NULL,
+    triples TEXT NOT NULL,
+    response TEXT NOT NULL,
+    facts INTEGER NOT NULL,
+    questions INTEGER NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS decks_updated ON decks(updated);
+CREATE VIRTUAL TABLE IF NOT EXISTS decks_fts USING fts5(
+    topic, themes, facts, questions, tokenize = 'unicode61 remove_diacritics 2'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS decks_grams USING fts5(normalized, tokenize = 'trigram');
+"""
+
+# Added after the first release: the QID of the main theme, to match topics naming the same entity
+MIGRATIONS = {
+    "main_qid": "ALTER TABLE decks ADD COLUMN main_qid TEXT"
+}
+
+# Columns of the deck summaries returned by list and search (the deck itself is only read by get)
+SUMMARY_COLUMNS = "decks.id, decks.topic, decks.themes, decks.facts, decks.questions, decks.created, decks.updated, decks.hits"
+
+# Stored topics sharing the most trigrams with the requested one that are compared to it
+MATCH_CANDIDATES = 20
+# Trigrams of the requested topic used to look up the candidates
+MAX_TRIGRAMS = 32
+
+TOKEN = re.compile(r"\w+")
+
+
+def defaultNormalize(topic):
+    return " ".join(topic.lower().split())
+
+
+def ftsQuery(text, column=None):
+    """
+    Build an FTS5 query matching any word of a text (words are quoted, so operators in the text are literal).
+    Args:
+        text (str): The text.
+        column (str): Restrict the query to this column.
+    Returns:
+        str: The query, or None if the text has no words.
+    """
+    words = [f'"{word}"' for word in TOKEN.findall(text.lower())]
+    if not words:
+        return None
+    query = " OR ".join(dict.fromkeys(words))
+    return f"{column} : ({query})" if column else query
+
+
+def trigramQuery(text):
+    """
+    Build an FTS5 query matching any trigram of a text (the neighbour lookup of close topics).
+    Args:
+        text (str): The normalized topic.
+    Returns:
+        str: The query, or None if the text is shorter than a trigram.
+    """
+    trigrams = dict.fromkeys(text[i:i + 3] for i in range(len(text) - 2))
+    trigrams = [f'"{trigram}"' for trigram in trigrams if '"' not in trigram][:MAX_TRIGRAMS]
+    return " OR ".join(trigrams) or None
+
+
+def exactWords(words):
+    # Short words and numbers change the topic with a single edit ("world war i" / "world war ii", "1920s" / "1980s")
+    return [word for word in words if len(word) <= 3 or any(character.isdigit() for character in word)]
+
+
+def topicSimilarity(a, b):
+    """
+    Compare two normalized topics: the Levenshtein ratio of the topics, or of their sorted words
+    ("history of rome" ~ "rome history of"), and 0 if their short words or numbers differ.
+    """
+    words_a, words_b = sorted(a.split()), sorted(b.split())
+    if exactWords(words_a) != exactWords(words_b):
+        return 0.0
+    return max(Levenshtein.ratio(a, b), Levenshtein.ratio(" ".join(words_a), " ".join(words_b)))
+
+
+def themeOverlap(themes_a, themes_b, threshold=0.85):
+    """
+    Fraction of the themes of the shorter list that closely match (topicSimilarity) a theme of the other list
+    ("genes" / "gene"). Two empty lists match (1); an empty list doesn't match a non-empty one (0), so a prompt
+    whose only theme is its main theme isn't served a broader deck of the same entity, and vice versa.
+    """
+    if not themes_a and not themes_b:
+        return 1.0
+    if not themes_a or not themes_b:
+        return 0.0
+    shorter, longer = sorted((themes_a, themes_b), key=len)
+    matched = sum(1 for theme in shorter if any(topicSimilarity(theme, other) >= threshold for other in longer))
+    return matched / len(shorter)
+
+
+class DeckLibrary:
+    """
+    SQLite store of generated decks, one per normalized topic (saving a topic again replaces its deck).
+    """
+
+    def __init__(self, path, match_threshold=0.9, theme_overlap=0.5, normalize=defaultNormalize):
+        """
+        Args:
+            path (str): Path to the SQLite file.
+            match_threshold (float): Minimum similarity of a stored topic to serve its deck for another topic
+                                     (1 only serves decks of the same normalized topic).
+            theme_overlap (float): Minimum overlap of the themes of a deck with the same main entity (see findEntity).
+            normalize (callable): Normalization of topics (same normalized topic, same deck).
+        """
+        self.path = path
+        self.match_threshold = match_threshold
+        self.theme_overlap = theme_overlap
+        self.normalize = normalize
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {"lookups": 0, "exact_hits": 0, "close_hits": 0, "entity_lookups": 0, "entity_hits": 0, "saved": 0}
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._migrate(self._connection())
+
+    def _migrate(self, connection):
+        connection.executescript(SCHEMA)
+        columns = {row["name"] for row in connection.execute("PRAGMA table_info(decks)")}
+        for column, statement in MIGRATIONS.items():
+            if column not in columns:
+                connection.execute(statement)
+                # Main theme QIDs of the decks saved before the column existed
+                for row in connection.execute("SELECT id, themes, qids FROM decks").fetchall():
+                    themes, qids = json.loads(row["themes"]), json.loads(row["qids"])
+                    connection.execute("UPDATE decks SET main_qid = ? WHERE id = ?", (qids.get(themes[0]) if themes else None, row["id"]))
+        connection.execute("CREATE INDEX IF NOT EXISTS decks_main_qid ON decks(main_qid)")
+        connection.execute(
+            "INSERT INTO decks_grams (rowid, normalized) SELECT id, normalized FROM decks "
+            "WHERE id NOT IN (SELECT rowid FROM decks_grams)"
+        )
+
+    def _connection(self):
+        # SQLite connections can't be shared between threads, so keep one per thread
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def save(self, topic, response, triples=(), model=None, themes=None, themes_id=None):
+        """
+        Save a deck, replacing the deck of the same normalized topic.
+        Args:
+            topic (str): The prompt the deck was generated for.
+            response (dict): The response (facts, questions, summary).
+            triples (list): The triples the deck was generated from (with their entity and qid).
+            model (str): The model that generated the deck.
+            themes (list): The extracted themes, the main theme first. Without them (e.g. imported decks) they
+                are taken from the triples, whose first entity may not be the main theme if it had no triples.
+            themes_id (dict): The resolved themes mapped to their Wikidata IDs.
+        Returns:
+            int: The deck id.
+        """
+        if themes is None:
+            themes = list(dict.fromkeys(triple["entity"] for triple in triples))
+            themes_id = {triple["entity"]: triple["qid"] for triple in triples if triple.get("qid")}
+        themes = list(themes)
+        qids = dict(themes_id or {})
+        main_qid = qids.get(themes[0]) if themes else None
+        facts = response.get("facts") or []
+        questions = response.get("questions") or []
+        now = time.time()
+
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT id, created, hits FROM decks WHERE normalized = ?", (self.normalize(topic),)).fetchone()
+            values = (
+                topic, self.normalize(topic), model,
+                json.dumps(themes, ensure_ascii=False), json.dumps(qids, ensure_ascii=False),
+                json.dumps(list(triples), ensure_ascii=False), json.dumps(response, ensure_ascii=False),
+                len(facts), len(questions), row["created"] if row else now, now, row["hits"] if row else 0, main_qid
+            )
+            if row:
+                connection.execute(
+                    "UPDATE decks SET topic = ?, normalized = ?, model = ?, themes = ?, qids = ?, triples = ?, response = ?, "
+                    "facts = ?, questions = ?, created = ?, updated = ?, hits = ?, main_qid = ? WHERE id = ?", (*values, row["id"])
+                )
+                deck_id = row["id"]
+                connection.execute("DELETE FROM decks_fts WHERE rowid = ?", (deck_id,))
+                connection.execute("DELETE FROM decks_grams WHERE rowid = ?", (deck_id,))
+            else:
+                deck_id = connection.execute(
+                    "INSERT INTO decks (topic, normalized, model, themes, qids, triples, response, facts, questions, created, updated, hits, main_qid) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", values
+                ).lastrowid
+            connection.execute("INSERT INTO decks_grams (rowid, normalized) VALUES (?, ?)", (deck_id, self.normalize(topic)))
+            connection.execute(
+                "INSERT INTO decks_fts (rowid, topic, themes, facts, questions) VALUES (?, ?, ?, ?, ?)",
+                (deck_id, topic, " ".join(themes), "\n".join(map(str, facts)),
+                 "\n".join(f"{q.get('question', '')} {' '.join(map(str, q.get('options', [])))}" for q in questions))
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        self._count("saved")
+        print(f"[DeckLibrary - Saved]: {topic} (deck {deck_id})")
+        return deck_id
+
+    def find(self, topic):
+        """
+        Find the deck of a topic: the deck of the same normalized topic, or else the deck of the most
+        similar stored topic if its similarity reaches match_threshold. Only the MATCH_CANDIDATES topics
+        sharing the most trigrams with the topic are compared to it.
+        Args:
+            topic (str): The prompt.
+        Returns:
+            dict: The deck (see get) with its similarity to the topic and the match (exact or close), or None.
+        """
+        self._count("lookups")
+        normalized = self.normalize(topic)
+        connection = self._connection()
+        row = connection.execute("SELECT id FROM decks WHERE normalized = ?", (normalized,)).fetchone()
+        if row:
+            self._count("exact_hits")
+            return self.get(row["id"], served=True, similarity=1.0, match="exact")
+
+        query = trigramQuery(normalized)
+        if query and self.match_threshold < 1:
+            candidates = connection.execute(
+                "SELECT decks.id, decks.normalized FROM decks_grams JOIN decks ON decks.id = decks_grams.rowid "
+                "WHERE decks_grams MATCH ? ORDER BY bm25(decks_grams) LIMIT ?", (query, MATCH_CANDIDATES)
+            ).fetchall()
+            scored = [(topicSimilarity(normalized, candidate["normalized"]), candidate["id"]) for candidate in candidates]
+            if scored:
+                similarity, deck_id = max(scored)
+                if similarity >= self.match_threshold:
+                    self._count("close_hits")
+                    return self.get(deck_id, served=True, similarity=similarity, match="close")
+        return None
+
+    def findEntity(self, qid, themes):
+        """
+        Find a deck generated for the same main entity: among the decks whose main theme resolved to qid,
+        the one whose themes overlap the most with the given themes, if the overlap reaches theme_overlap
+        (so "History of France" isn't served the deck of "France").
+        Args:
+            qid (str): The Wikidata ID of the main theme of the prompt.
+            themes (list): The themes extracted from the prompt, the main theme first.
+        Returns:
+            dict: The deck (see get) with its theme overlap as similarity and "entity" as match, or None.
+        """
+        self._count("entity_lookups")
+        rows = self._connection().execute(
+            "SELECT id, themes FROM decks WHERE main_qid = ? ORDER BY updated DESC LIMIT ?", (qid, MATCH_CANDIDATES)
+        ).fetchall()
+        # The main themes name the same entity, whatever their spelling: compare the other themes
+        related = [self.normalize(theme) for theme in themes[1:]]
+        scored = [(themeOverlap(related, [self.normalize(theme) for theme in json.loads(row["themes"])[1:]]), row["id"]) for row in rows]
+        if scored:
+            overlap, deck_id = max(scored)
+            if overlap >= self.theme_overlap:
+                self._count("entity_hits")
+                return self.get(deck_id, served=True, similarity=overlap, match="entity")
+        return None
+
+    def get(self, deck_id, served=False, similarity=None, match=None):
+        """
+        Load a whole deck.
+        Args:
+            deck_id (int): The deck id.
+            served (bool): Count the read as a use of the deck (hits).
+            similarity (float): Similarity of the requested topic, added to the deck.
+            match (str): How the requested topic matched the deck (exact, close or entity), added to the deck.
+        Returns:
+            dict: The id, topic, model, themes, qids, triples, response, created, updated and hits, or None.
+        """
+        connection = self._connection()
+        if served:
+            connection.execute("UPDATE decks SET hits = hits + 1 WHERE id = ?", (deck_id,))
+        row = connection.execute(
+            "SELECT id, topic, model, themes, qids, triples, response, created, updated, hits FROM decks WHERE id = ?", (deck_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        deck = dict(row)
+        for field in ("themes", "qids", "triples", "response"):
+            deck[field] = json.loads(deck[field])
+        if similarity is not None:
+            deck["similarity"] = similarity
+        if match is not None:
+            deck["match"] = match
+        return deck
+
+    def list(self, page=1, page_size=20, order="updated"):
+        """
+        List one page of deck summaries.
+        Args:
+            page (int): The page, from 1.
+            page_size (int): Decks per page.
+            order (str): updated (most recent first), hits (most served first) or topic.
+        Returns:
+            list: Deck summaries (id, topic, themes, number of facts and questions, created, updated, hits).
+        """
+        orders = {"updated": "updated DESC", "hits": "hits DESC, updated DESC", "topic": "normalized"}
+        if order not in orders:
+            raise ValueError(f"Unknown deck order: {order} (expected one of {', '.join(orders)})")
+        rows = self._connection().execute(
+            f"SELECT {SUMMARY_COLUMNS} FROM decks ORDER BY {orders[order]} LIMIT ? OFFSET ?",
+            (page_size, (max(page, 1) - 1) * page_size)
+        ).fetchall()
+        return [self._summary(row) for row in rows]
+
+    def search(self, text, page=1, page_size=20):
+        """
+        Full-text search over the topics, themes, facts and questions (any word, best matches first).
+        Args:
+            text (str): The search text.
+            page (int): The page, from 1.
+            page_size (int): Decks per page.
+        Returns:
+            list: Deck summaries (see list), each with a snippet of the matching text.
+        """
+        query = ftsQuery(text)
+        if query is None:
+            return []
+        rows = self._connection().execute(
+            f"SELECT {SUMMARY_COLUMNS}, snippet(decks_fts, -1, '[', ']', '...', 12) AS snippet "
+            "FROM decks_fts JOIN decks ON decks.id = decks_fts.rowid "
+            "WHERE decks_fts MATCH ? ORDER BY bm25(decks_fts, 10.0, 5.0, 1.0, 1.0) LIMIT ? OFFSET ?",
+            (query, page_size, (max(page, 1) - 1) * page_size)
+        ).fetchall()
+        return [{**self._summary(row), "snippet": row["snippet"]} for row in rows]
+
+    def _summary(self, row):
+        summary = dict(row)
+        summary["themes"] = json.loads(summary["themes"])
+        return summary
+
+    def count(self):
+        return self._connection().execute("SELECT COUNT(*) FROM decks").fetchone()[0]
+
+    def delete(self, deck_id):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        connection.execute("DELETE FROM decks WHERE id = ?", (deck_id,))
+        connection.execute("DELETE FROM decks_fts WHERE rowid = ?", (deck_id,))
+        connection.execute("DELETE FROM decks_grams WHERE rowid = ?", (deck_id,))
+        connection.execute("COMMIT")
+
+    def _count(self, event):
+        with self._lock:
+            self._stats[event] += 1
+
+    def stats(self):
+        """
+        Get the lookup and save counters and the hit rate.
+        Returns:
+            dict: lookups, exact_hits, close_hits, entity_lookups, entity_hits, misses, saved, and
+                hit_rate (lookups served from the library).
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        hits = stats["exact_hits"] + stats["close_hits"] + stats["entity_hits"]
+        stats["misses"] = stats["lookups"] - hits
+        stats["hit_rate"] = hits / stats["lookups"] if stats["lookups"] else 0.0
+        return stats
+
+
+def printSummaries(summaries):
+    for deck in summaries:
+        print(f"{deck['id']:>6}  {deck['topic'][:40]:<40} {deck['facts']:>3} facts {deck['questions']:>3} questions  {deck['hits']:>4} hits")
+        if deck.get("snippet"):
+            print(f"        {deck['snippet']}")
+
+
+def importDecks(library, path):
+    """
+    Save the decks of a src/batch.py output file, with their themes and main QID (so they can be entity-matched),
+    skipping failed and degraded generations.
+    Args:
+        library (DeckLibrary): The library.
+        path (str): The JSONL output file.
+    Returns:
+        int: The number of saved decks.
+    """
+    saved = 0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            deck = json.loads(line) if line.strip() else None
+            if not deck or not deck.get("response") or deck.get("error") or deck["response"].get("degraded"):
+                continue
+            # Decks served from a library carry its metadata, which isn't part of the deck
+            response = {key: value for key, value in deck["response"].items() if key not in ("degraded", "library")}
+            # Output files of older versions have no themes: they are taken from the triples
+            library.save(deck["topic"], response, deck.get("triples", []), deck.get("model"), deck.get("themes") or None, deck.get("themes_id"))
+            saved += 1
+    return saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Browse and fill the deck library.")
+    parser.add_argument("--db", default=os.path.join(os.path.dirname(__file__), "../.cache", "decks.sqlite"), help="Path to the library file.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    list_command = commands.add_parser("list", help="List the decks, most recent first.")
+    list_command.add_argument("--page", type=int, default=1)
+    list_command.add_argument("--page-size", type=int, default=20)
+    list_command.add_argument("--order", choices=["updated", "hits", "topic"], default="updated")
+    search_command = commands.add_parser("search", help="Search the topics, themes, facts and questions.")
+    search_command.add_argument("text")
+    search_command.add_argument("--page", type=int, default=1)
+    search_command.add_argument("--page-size", type=int, default=20)
+    show_command = commands.add_parser("show", help="Print a deck as JSON.")
+    show_command.add_argument("id", type=int)
+    import_command = commands.add_parser("import", help="Save the decks of a src/batch.py output file.")
+    import_command.add_argument("decks")
+    args = parser.parse_args()
+
+    # Same topic normalization as the engine
+    from KnowledgeEngine import normalizePrompt
+    library = DeckLibrary(args.db, normalize=normalizePrompt)
+
+    if args.command == "list":
+        printSummaries(library.list(args.page, args.page_size, args.order))
+        print(f"\n{library.count()} decks")
+    elif args.command == "search":
+        printSummaries(library.search(args.text, args.page, args.page_size))
+    elif args.command == "show":
+        print(json.dumps(library.get(args.id), indent=2, ensure_ascii=False))
+    elif args.command == "import":
+        saved = importDecks(library, args.decks)
+        print(f"{saved} decks imported, {library.count()} decks")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import threading
+from collections import deque
+
+
+class HedgeCancelled(Exception):
+    """
+    Raised in the losing request of a hedged pair once the other one returned a valid answer.
+    """
+
+
+def percentile(values, p):
+    # Nearest-rank percentile of a sorted list
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+class HedgePolicy:
+    """
+    Decides when to hedge an LLM request: the backup request is sent once the primary has been running
+    longer than a percentile of the recent latencies of its stage, so only the slowest requests are
+    duplicated. Keeps the hedge counters and an estimate of the latency saved by backup wins.
+    """
+
+    EVENTS = ("requests", "hedged", "backup_wins", "primary_wins", "failures")
+
+    def __init__(self, percentile=90, min_delay=0.5, max_delay=None, default_delay=5.0, min_samples=10, window=200):
+        """
+        Args:
+            percentile (float): Percentile of the recent latencies after which the backup is sent.
+            min_delay (float): Minimum seconds before hedging (bounds the extra load when latencies are low).
+            max_delay (float): Maximum seconds before hedging (None for no maximum).
+            default_delay (float): Seconds before hedging while a stage has fewer than min_samples latencies.
+            min_samples (int): Latencies needed before the percentile is used.
+            window (int): Recent latencies kept per stage.
+        """
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        self.window = window
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._stats = {}
+
+    def record(self, stage, seconds):
+        """
+        Record the latency of a completed request (or the time a cancelled primary had been running,
+        a lower bound that keeps the slow tail in the window).
+        """
+        with self._lock:
+            self._latencies.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+
+    def delay(self, stage):
+        """
+        Get the seconds to wait for the primary request of a stage before sending the backup.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies.get(stage, ()))
+        if len(latencies) < self.min_samples:
+            delay = self.default_delay
+        else:
+            delay = percentile(latencies, self.percentile)
+        delay = max(self.min_delay, delay)
+        return min(delay, self.max_delay) if self.max_delay else delay
+
+    def saved(self, stage, elapsed):
+        """
+        Estimate the seconds saved by a backup win: the expected latency of the primary given that it was
+        still running after elapsed seconds (mean of the recent latencies above elapsed), minus elapsed.
+        Args:
+            stage (str): The stage of the request.
+            elapsed (float): Seconds since the primary was sent when the backup won.
+        Returns:
+            float: The estimated saving (0 if no recent latency was slower).
+        """
+        with self._lock:
+            slower = [seconds for seconds in self._latencies.get(stage, ()) if seconds > elapsed]
+        return sum(slower) / len(slower) - elapsed if slower else 0.0
+
+    def count(self, stage, event, value=1):
+        with self._lock:
+            counters = self._stats.setdefault(stage, {**dict.fromkeys(self.EVENTS, 0), "saved_seconds": 0.0})
+            counters[event] += value
+
+    def stats(self):
+        """
+        Get the hedge counters per stage.
+        Returns:
+            dict: A dictionary mapping stages to requests, hedged, backup_wins, primary_wins, failures,
+                saved_seconds, hedge_rate (hedged / requests) and the current hedge delay.
+        """
+        with self._lock:
+            stats = {stage: dict(counters) for stage, counters in self._stats.items()}
+        for stage, counters in stats.items():
+            counters["hedge_rate"] = counters["hedged"] / counters["requests"] if counters["requests"] else 0.0
+            counters["delay"] = self.delay(stage)
+        return stats
@@ -0,0 +1,394 @@
+import email.utils
+import random
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+
+from Deadline import currentDeadline
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Statuses telling that the server turned the request away without processing it: the only ones (with
+# any status carrying Retry-After) on which a non-idempotent request is resent
+REJECTED_STATUSES = {429, 503}
+
+# Methods that are safe to resend after a read timeout or a dropped connection (the server may have
+# processed the first attempt); other methods (the billed LLM completions) only retry connect failures
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+def isConnectFailure(error):
+    """
+    Check whether a request failed before reaching the server (connect timeout, refused or unresolved host),
+    so resending it can't duplicate it.
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(error, requests.ConnectionError) and isinstance(reason, NewConnectionError)
+
+
+def isRetryableStatus(method, response):
+    """
+    Check whether a response status is worth resending the request for. A 500, 502 or 504 may come after
+    the server processed the request, so it is only retried for idempotent methods.
+    """
+    if response.status_code not in RETRY_STATUSES:
+        return False
+    if method.upper() in IDEMPOTENT_METHODS or response.status_code in REJECTED_STATUSES:
+        return True
+    return "Retry-After" in response.headers
+
+
+# Cancellation of the request being sent by the current thread (read by CancellableConnection)
+_sending = threading.local()
+
+
+def abortConnection(connection):
+    # Shutting the socket down (closing it isn't enough) wakes a read blocked on it in another thread
+    sock = getattr(connection, "sock", None)
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class Cancellation:
+    """
+    A cancel flag that also aborts the requests sent under it (HttpTransport.request(..., cancel=...)):
+    setting it shuts down their connections, so a read blocked on a stalled server, before the response
+    headers or between two streamed events, fails at once instead of waiting for its read timeout.
+    A streamed response stays attached until the thread that requested it calls detach.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    def set(self):
+        with self._lock:
+            self._event.set()
+            for connection in self._connections.values():
+                abortConnection(connection)
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def attach(self, connection):
+        with self._lock:
+            self._connections[threading.get_ident()] = connection
+            if self._event.is_set():
+                abortConnection(connection)
+
+    def detach(self):
+        # Called before the connection goes back to the pool, where another request could pick it up
+        with self._lock:
+            self._connections.pop(threading.get_ident(), None)
+
+
+class CancellableConnection:
+    """
+    Connection mixin attaching every request sent on the connection to the Cancellation of its thread.
+    """
+
+    def connect(self):
+        super().connect()
+        # A new connection has no socket when attached, so it can only be aborted once connected
+        cancel = getattr(_sending, "cancel", None)
+        if cancel is not None and cancel.is_set():
+            abortConnection(self)
+
+    def request(self, *args, **kwargs):
+        cancel = getattr(_sending, "cancel", None)
+        if cancel is not None:
+            cancel.attach(self)
+        return super().request(*args, **kwargs)
+
+
+class CancellableHTTPConnection(CancellableConnection, HTTPConnection):
+    pass
+
+
+class CancellableHTTPSConnection(CancellableConnection, HTTPSConnection):
+    pass
+
+
+class CancellableHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CancellableHTTPConnection
+
+
+class CancellableHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CancellableHTTPSConnection
+
+
+class CancellableAdapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": CancellableHTTPConnectionPool, "https": CancellableHTTPSConnectionPool}
+
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter: allows `rate` requests per second with bursts of up to `capacity`.
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        Args:
+            rate (float): Tokens added per second.
+            capacity (float): Maximum number of stored tokens.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, blocking until one is available.
+        Returns:
+            float: The number of seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class HttpTransport:
+    """
+    HTTP transport shared by all KnowledgeEngine calls.
+    Keeps one pooled keep-alive session per host, retries failed requests with jittered
+    exponential backoff (honouring Retry-After on 429/503) and enforces per-endpoint
+    token-bucket rate limits. Request, retry and throttle counts are kept per endpoint.
+    """
+
+    def __init__(self, max_retries=3, backoff_base=0.5, backoff_max=8.0, pool_size=10, tracer=None):
+        """
+        Args:
+            max_retries (int): Maximum number of retries per request.
+            backoff_base (float): Base delay (seconds) of the exponential backoff.
+            backoff_max (float): Maximum delay (seconds) between two attempts.
+            pool_size (int): Maximum number of kept-alive connections per host.
+            tracer (Tracer): Optional tracer receiving the bytes sent and received by each request.
+        """
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        self.tracer = tracer
+
+        self.sessions = {}
+        self.limits = {}
+        self.semaphores = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def setRateLimit(self, endpoint, rate, burst=None):
+        """
+        Set the rate limit of an endpoint.
+        Args:
+            endpoint (str): The endpoint name.
+            rate (float): Requests per second (0 or None disables the limit).
+            burst (float): Maximum burst size (defaults to the rate, at least 1).
+        """
+        with self.lock:
+            if rate:
+                self.limits[endpoint] = TokenBucket(rate, burst or max(1, rate))
+            else:
+                self.limits.pop(endpoint, None)
+
+    def setConcurrencyLimit(self, endpoint, semaphore):
+        """
+        Cap the number of requests in flight to an endpoint with a shared semaphore (e.g. a
+        multiprocessing manager semaphore shared by a pool of worker processes). The semaphore is held
+        until the response headers arrive, so streamed bodies are read outside of it.
+        Args:
+            endpoint (str): The endpoint name.
+            semaphore: An object with acquire() and release() (None removes the cap).
+        """
+        with self.lock:
+            if semaphore is None:
+                self.semaphores.pop(endpoint, None)
+            else:
+                self.semaphores[endpoint] = semaphore
+
+    def get(self, url, endpoint=None, **kwargs):
+        return self.request("GET", url, endpoint=endpoint, **kwargs)
+
+    def post(self, url, endpoint=None, **kwargs):
+        return self.request("POST", url, endpoint=endpoint, **kwargs)
+
+    def request(self, method, url, endpoint=None, cancel=None, **kwargs):
+        """
+        Send a request, retrying connection errors and retryable statuses (429, 5xx). Read timeouts, dropped
+        connections and 500/502/504 responses are only retried for idempotent methods: a POST is only resent
+        if it never reached the server, or if the server rejected it (429, 503 or a Retry-After header).
+        Under a deadline (see Deadline), the timeout of every attempt is capped to the time left
+        and retries that can't complete before the deadline are skipped.
+        Args:
+            method (str): The HTTP method.
+            url (str): The request URL.
+            endpoint (str): The endpoint name used for rate limits and metrics (defaults to the host).
+            cancel (Cancellation): Aborts the request when set (it is then no longer retried). A streamed
+                                   response must be detached from it once read (cancel.detach()).
+            **kwargs: Extra arguments passed to requests (params, headers, data, timeout, stream...).
+        Returns:
+            requests.Response: The last response received (callers still check its status).
+        Raises:
+            requests.RequestException: If every attempt failed without a response.
+            DeadlineExceeded: If the deadline passed before an attempt.
+        """
+        host = urlparse(url).netloc
+        endpoint = endpoint or host
+        session = self.session(host)
+        semaphore = self.semaphores.get(endpoint)
+        deadline = currentDeadline()
+        timeout = kwargs.get("timeout")
+
+        attempt = 0
+        while True:
+            self.throttle(endpoint)
+            if deadline is not None:
+                kwargs["timeout"] = deadline.timeout(timeout)
+            self.count(endpoint, "requests")
+            try:
+                if semaphore is not None:
+                    semaphore.acquire()
+                _sending.cancel = cancel
+                try:
+                    response = session.request(method, url, **kwargs)
+                except BaseException:
+                    if cancel is not None:
+                        cancel.detach()
+                    raise
+                finally:
+                    _sending.cancel = None
+                    if semaphore is not None:
+                        semaphore.release()
+                if cancel is not None and not kwargs.get("stream", False):
+                    cancel.detach()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                delay = self.backoff(attempt)
+                retryable = method.upper() in IDEMPOTENT_METHODS or isConnectFailure(e)
+                if cancel is not None and cancel.is_set():
+                    retryable = False
+                if not retryable or attempt >= self.max_retries or not self.fitsDeadline(deadline, delay):
+                    self.count(endpoint, "failures")
+                    raise
+                print(f"[HTTP Retry - {endpoint}]: {e.__class__.__name__}, retrying in {delay:.2f}s")
+            else:
+                self.traceBytes(response, kwargs.get("stream", False))
+                retry = isRetryableStatus(method, response) and attempt < self.max_retries
+                if cancel is not None and cancel.is_set():
+                    retry = False
+                delay = self.retryAfter(response) if retry else 0
+                if delay is None:
+                    delay = self.backoff(attempt)
+                if not retry or not self.fitsDeadline(deadline, delay):
+                    if response.status_code >= 400:
+                        self.count(endpoint, "failures")
+                    return response
+                print(f"[HTTP Retry - {endpoint}]: status {response.status_code}, retrying in {delay:.2f}s")
+                if cancel is not None:
+                    cancel.detach()
+                response.close()
+
+            self.count(endpoint, "retries")
+            time.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    def fitsDeadline(deadline, delay):
+        # A retry is only worth it if it can start (and get some time to run) before the deadline
+        return deadline is None or deadline.remaining() > delay + 0.1
+
+    def session(self, host):
+        """
+        Get the pooled session of a host.
+        Args:
+            host (str): The host name.
+        Returns:
+            requests.Session: The session used for every request to that host.
+        """
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = CancellableAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.sessions[host] = session
+            return session
+
+    def throttle(self, endpoint):
+        bucket = self.limits.get(endpoint)
+        if bucket is None:
+            return
+        waited = bucket.acquire()
+        if waited:
+            self.count(endpoint, "throttled")
+            self.count(endpoint, "throttle_seconds", waited)
+
+    def traceBytes(self, response, stream):
+        if self.tracer is None:
+            return
+        request = response.request
+        sent = len(request.url) + len(request.body or b"")
+        # Streamed bodies are counted by the consumer as they are read
+        received = 0 if stream else len(response.content)
+        self.tracer.annotate(http_requests=1, bytes_sent=sent, bytes_received=received)
+
+    def backoff(self, attempt):
+        # Full jitter: uniform delay up to the exponential cap
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def retryAfter(self, response):
+        # Retry-After is only honoured for rate limiting and unavailability
+        if response.status_code not in (429, 503):
+            return None
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                delay = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+        return min(max(delay, 0.0), self.backoff_max)
+
+    def count(self, endpoint, counter, amount=1):
+        with self.lock:
+            counters = self.counters.setdefault(endpoint, {
+                "requests": 0, "retries": 0, "failures": 0, "throttled": 0, "throttle_seconds": 0.0
+            })
+            counters[counter] += amount
+
+    def metrics(self):
+        """
+        Get the request, retry, failure and throttle counters per endpoint.
+        Returns:
+            dict: A dictionary mapping each endpoint name to its counters.
+        """
+        with self.lock:
+            return {endpoint: dict(counters) for endpoint, counters in self.counters.items()}
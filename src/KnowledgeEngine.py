@@ -1,11 +1,68 @@
-import requests
+import copy
 import json
+import math
 import os
 import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, CancelledError, Future, ThreadPoolExecutor, as_completed, wait
+from Cache import Cache, MISSING
+from Deadline import STAGE_SHARES, Deadline, DeadlineExceeded, activate, currentDeadline, deadlineStage, degrade
+from DeckExporter import DeckExporter
+from DeckLibrary import DeckLibrary
+from Hedging import HedgeCancelled, HedgePolicy
+from HttpTransport import Cancellation, HttpTransport
+from LabelIndex import LabelIndex
+from LabelResolver import LabelResolver
+from LazyResponse import LazyResponse
+from LocalStore import LocalStore
+from MapReduce import chunkTriples, estimateTokens, isDuplicate, mergeCandidates, tripleLine
+from OutputValidator import OutputError, ValidationStats, isValidJSON, repairJSON, validateRefined, validateThemes
+from Pipeline import PriorityExecutor
+from SingleFlight import FLIGHTS
+from StreamParser import IncrementalJSONParser
+from TripleRanker import preprocessTriples
+from ThemeExtractor import ThemeExtractor
+from Tracing import Tracer, traced
+
+
+# IRI of a Wikidata item (values linking to another entity, followed by expandTriples)
+ENTITY_IRI = re.compile(r"^https?://www\.wikidata\.org/entity/Q\d+$")
+
+# Label of an entity without an English label (the label service falls back to its ID)
+ENTITY_ID = re.compile(r"^[QP]\d+$")
+
+
+# Properties not followed by expandTriples: classes (instance of, subclass of), country, main category,
+# described by source and on focus list lead to generic entities unrelated to the topic
+EXPANSION_DENY_PROPERTIES = ["P31", "P279", "P17", "P910", "P1343", "P5008"]
+
+
+# Version of the shape of the cached claims, raw (property ID, value ID, value) tuples whose labels are
+# resolved when they are read: claims cached by older queries (labelled tuples) aren't reused
+TRIPLES_QUERY_VERSION = 4
+
+
+def normalizePrompt(prompt):
+    """
+    Normalize a prompt so trivially different spellings of the same topic share a generation.
+    Args:
+        prompt (str): The prompt.
+    Returns:
+        str: The lowercased prompt with collapsed whitespace and no trailing punctuation.
+    """
+    return " ".join(prompt.lower().split()).rstrip("?!. ")
+
 
 class KnowledgeEngine:
-    def __init__(self):
-        with open(os.path.join(os.path.dirname(__file__), "../.config", "keys.json")) as f:
+    def __init__(self, keys_path=None):
+        """
+        Args:
+            keys_path (str): Path to the keys/settings file (defaults to .config/keys.json).
+        """
+        keys_path = keys_path or os.path.join(os.path.dirname(__file__), "../.config", "keys.json")
+        with open(keys_path) as f:
             keys = json.load(f)
 
         self.sparql_endpoint = keys["SPARQL_ENDPOINT"]
@@ -15,46 +72,719 @@ class KnowledgeEngine:
         self.openrouter_apikey = keys["OPENROUTER_API_KEY"]
         self.openrouter_model = keys["OPENROUTER_API_MODEL"]
 
+        # Model per pipeline stage (themes, refine, map, part, summary, regenerate), OPENROUTER_API_MODEL otherwise
+        self.model_routes = keys.get("MODEL_ROUTES", {})
+
+        # Hedged LLM requests: a backup request is sent when the primary is slower than most recent ones
+        self.hedge = HedgePolicy(
+            percentile=keys.get("HEDGE_PERCENTILE", 90),
+            min_delay=keys.get("HEDGE_MIN_DELAY", 0.5),
+            max_delay=keys.get("HEDGE_MAX_DELAY"),
+            default_delay=keys.get("HEDGE_DEFAULT_DELAY", 5.0),
+            min_samples=keys.get("HEDGE_MIN_SAMPLES", 10)
+        ) if keys.get("HEDGE_ENABLED", False) else None
+        self.hedge_model = keys.get("HEDGE_MODEL")
+        self.hedge_url = keys.get("HEDGE_API_URL", self.openrouter_url)
+        self.hedge_apikey = keys.get("HEDGE_API_KEY", self.openrouter_apikey)
+        self.hedger = ThreadPoolExecutor(max_workers=keys.get("HEDGE_WORKERS", 16), thread_name_prefix="hedge") if self.hedge else None
+
+        # Theme extraction: "llm", or "local" (spaCy and the main entity's neighbours, the LLM when unsure)
+        self.theme_extractor = keys.get("THEME_EXTRACTOR", "llm")
+        self.theme_local_confidence = keys.get("THEME_LOCAL_CONFIDENCE", 0.6)
+        self.local_themes = ThemeExtractor(keys.get("SPACY_MODEL", "en_core_web_sm"))
+
+        # Entity resolution settings
+        self.lookup_concurrency = keys.get("LOOKUP_CONCURRENCY", 5)
+        self.lookup_timeout = keys.get("LOOKUP_TIMEOUT", 5)
+        self.label_index = LabelIndex(keys["LABEL_INDEX_PATH"]) if keys.get("LABEL_INDEX_PATH") else None
+        self.label_index_confidence = keys.get("LABEL_INDEX_CONFIDENCE", 0.8)
+
+        # Triple retrieval settings
+        self.sparql_batch_size = max(1, keys.get("SPARQL_BATCH_SIZE", 10))
+        self.sparql_timeout = keys.get("SPARQL_TIMEOUT", 10)
+        self.triples_per_entity = keys.get("TRIPLES_PER_ENTITY", 10)
+
+        # Breadth-first expansion to the neighbours of the themes (depth 1 only fetches the themes' own triples)
+        self.expansion_depth = keys.get("EXPANSION_DEPTH", 1)
+        self.expansion_frontier = keys.get("EXPANSION_FRONTIER", 20)
+        self.expansion_max_triples = keys.get("EXPANSION_MAX_TRIPLES", 150)
+        self.expansion_time_budget = keys.get("EXPANSION_TIME_BUDGET", 4.0)
+        self.expansion_allow = set(keys.get("EXPANSION_ALLOW_PROPERTIES", []))
+        self.expansion_deny = set(keys.get("EXPANSION_DENY_PROPERTIES", EXPANSION_DENY_PROPERTIES))
+
+        # Local Wikidata subset store answering getTriples before the remote SPARQL endpoint
+        self.local_store = LocalStore(keys["LOCAL_STORE_PATH"]) if keys.get("LOCAL_STORE_PATH") else None
+
+        # Triple pre-processing before refinement
+        self.triple_token_budget = keys.get("TRIPLE_TOKEN_BUDGET", 2400)
+        self.triple_dedupe_threshold = keys.get("TRIPLE_DEDUPE_THRESHOLD", 0.9)
+
+        # Refinement settings (single prompt or map-reduce over chunks of triples)
+        self.refine_mode = keys.get("REFINE_MODE", "auto")
+        self.refine_token_budget = keys.get("REFINE_TOKEN_BUDGET", 1200)
+        self.refine_concurrency = keys.get("REFINE_CONCURRENCY", 4)
+        self.refine_max_facts = keys.get("REFINE_MAX_FACTS", 15)
+        self.refine_max_questions = keys.get("REFINE_MAX_QUESTIONS", 10)
+
+        # Structured-output validation: invalid facts and questions are regenerated by a small follow-up call
+        self.regenerate_invalid = keys.get("REGENERATE_INVALID", True)
+        self.validation = ValidationStats()
+
+        # Lazy refinement: the summary first, facts and questions when first shown (or prefetched)
+        self.lazy_refinement = keys.get("LAZY_REFINEMENT", False)
+        self.prefetcher = PriorityExecutor(keys.get("PREFETCH_WORKERS", 2), name="prefetch") if keys.get("LAZY_PREFETCH", False) else None
+
+        # Pipelined resolve -> fetch execution
+        self.pipelined = keys.get("PIPELINED", True)
+        self.pipeline_quorum = keys.get("PIPELINE_QUORUM", 1.0)
+        self.pipeline_deadline = keys.get("PIPELINE_DEADLINE")
+        self.pipeline_batch_window = keys.get("PIPELINE_BATCH_WINDOW", 0.05)
+        self.pipeline = PriorityExecutor(keys.get("PIPELINE_WORKERS", 8)) if self.pipelined else None
+
+        # End-to-end latency budget of a generation, split across the stages
+        self.response_deadline = keys.get("RESPONSE_DEADLINE")
+        self.deadline_shares = {**STAGE_SHARES, **keys.get("DEADLINE_SHARES", {})}
+
+        # Per-stage tracing and metrics
+        self.tracer = Tracer(trace_path=keys.get("TRACE_PATH"), metrics_path=keys.get("METRICS_PATH"))
+
+        # Shared HTTP transport: pooled connections, retries and per-endpoint rate limits
+        self.transport = HttpTransport(
+            max_retries=keys.get("HTTP_MAX_RETRIES", 3),
+            backoff_base=keys.get("HTTP_BACKOFF_BASE", 0.5),
+            backoff_max=keys.get("HTTP_BACKOFF_MAX", 8),
+            pool_size=max(self.lookup_concurrency, 10),
+            tracer=self.tracer
+        )
+        rate_limits = {"openrouter": [0, 0], "sparql": [5, 5], "wikidata": [20, 20], **keys.get("RATE_LIMITS", {})}
+        for endpoint, (rate, burst) in rate_limits.items():
+            self.transport.setRateLimit(endpoint, rate, burst)
+
+        # Cache for Wikidata lookups, SPARQL results and LLM completions
+        cache_path = keys.get("CACHE_PATH", os.path.join(os.path.dirname(__file__), "../.cache", "knowledge_cache.sqlite"))
+        self.cache = Cache(
+            cache_path if keys.get("CACHE_ENABLED", True) else None,
+            memory_size=keys.get("CACHE_MEMORY_SIZE", 512),
+            disk_size=keys.get("CACHE_DISK_SIZE", 50000),
+            ttls=keys.get("CACHE_TTL")
+        )
+
+        # Labels of the triples: local property table, then an LRU and the cache, then batched wbgetentities calls
+        self.labels = LabelResolver(
+            self.transport,
+            self.wikidata_api,
+            cache=self.cache,
+            property_path=keys.get("PROPERTY_LABELS_PATH", os.path.join(os.path.dirname(__file__), "../data", "property_labels.tsv")),
+            build_endpoint=self.sparql_endpoint if keys.get("PROPERTY_LABELS_BUILD", True) else None,
+            memory_size=keys.get("LABEL_CACHE_SIZE", 20000),
+            timeout=self.lookup_timeout,
+            tracer=self.tracer
+        )
+
+        # Server-side deck export (PNG/PDF/Anki) with a render cache shared by all sessions
+        self.exporter = DeckExporter(
+            keys.get("EXPORT_CACHE_DIR", os.path.join(os.path.dirname(__file__), "../.cache", "cards")),
+            workers=keys.get("EXPORT_WORKERS", 4),
+            scale=keys.get("EXPORT_SCALE", 2)
+        )
+
+        # Library of generated decks, served again for the same (or a closely matching) topic
+        library_path = keys.get("DECK_LIBRARY_PATH", os.path.join(os.path.dirname(__file__), "../.cache", "decks.sqlite"))
+        self.library = DeckLibrary(
+            library_path,
+            match_threshold=keys.get("DECK_MATCH_THRESHOLD", 0.9),
+            theme_overlap=keys.get("DECK_THEME_OVERLAP", 0.5),
+            normalize=normalizePrompt
+        ) if keys.get("DECK_LIBRARY_ENABLED", True) else None
+        # Also serve the deck of a topic naming the same main entity (costs a theme extraction and one lookup,
+        # both cached and reused by the generation when no deck matches)
+        self.entity_match = keys.get("DECK_ENTITY_MATCH", True)
+
+        # Coalescing of concurrent identical generations and stage calls, shared by the whole process
+        self.flights = FLIGHTS if keys.get("SINGLE_FLIGHT", True) else None
+
+        self.tracer.addCollector(self.metricsLines)
+        if keys.get("METRICS_PORT"):
+            self.tracer.serve(keys["METRICS_PORT"])
+
+    def cacheGet(self, kind, key):
+        """
+        Look up the cache and record the hit or miss on the current trace span.
+        Args:
+            kind (str): The kind of result (lookup, sparql, llm).
+            key (str): The cache key.
+        Returns:
+            The cached value, or MISSING.
+        """
+        value = self.cache.get(kind, key)
+        self.tracer.annotate(**{"cache_misses" if value is MISSING else "cache_hits": 1})
+        return value
+
+    def coalesce(self, kind, key, fn, *args, stage=None):
+        """
+        Run fn once for all concurrent calls with the same key (see SingleFlight), unless SINGLE_FLIGHT is disabled.
+        Under a deadline, a follower waits for the leader (which may have a later deadline, or none) at most
+        until its own deadline.
+        Args:
+            kind (str): The kind of computation (response, triples, lookup, sparql, llm).
+            key (str): The key of the computation.
+            fn (callable): The computation.
+            *args: Arguments of fn.
+            stage (str): Stage whose deadline bounds the wait of a follower (defaults to the current deadline).
+        Returns:
+            tuple: The result, and whether it was shared from another caller's computation.
+        Raises:
+            DeadlineExceeded: If a follower's deadline passed before the leader finished.
+        """
+        if self.flights is None:
+            return fn(*args), False
+        deadline = currentDeadline()
+        if deadline is not None and stage is not None:
+            deadline = deadline.child(stage)
+        try:
+            # Running out of the leader's own deadline isn't an error for the followers: they retry
+            result, shared = self.flights.do(
+                kind, key, fn, *args, timeout=deadline.remaining() if deadline else None, private=(DeadlineExceeded,)
+            )
+        except DeadlineExceeded:
+            raise
+        except TimeoutError:
+            self.tracer.annotate(coalesce_timeouts=1)
+            raise DeadlineExceeded(f"deadline of {deadline.name or 'the generation'} exceeded waiting for a shared {kind} computation")
+        if shared:
+            self.tracer.annotate(coalesced=1)
+        return result, shared
+
+    def followerTimeout(self):
+        # Seconds a follower of a single-flight call may wait (the time left before the current deadline)
+        deadline = currentDeadline()
+        return deadline.remaining() if deadline is not None else None
+
+    def annotateUsage(self, data):
+        """
+        Record the prompt and completion token counts reported by OpenRouter on the current trace span.
+        Args:
+            data (dict): A completion response (or the final stream event) with a "usage" field.
+        """
+        usage = data.get("usage") or {}
+        self.tracer.annotate(
+            prompt_tokens=usage.get("prompt_tokens", 0),
+            completion_tokens=usage.get("completion_tokens", 0)
+        )
+
+    def metricsLines(self):
+        """
+        Export the cache, theme extraction, label, validation, hedging, deck library and transport counters in the Prometheus text format.
+        Returns:
+            list: A list of Prometheus text lines.
+        """
+        lines = ["# TYPE kg_cache_events_total counter"]
+        for kind, counters in sorted(self.cache.stats().items()):
+            for event, value in sorted(counters.items()):
+                lines.append(f'kg_cache_events_total{{kind="{kind}",event="{event}"}} {value}')
+        if self.flights is not None:
+            lines.append("# TYPE kg_singleflight_events_total counter")
+            for kind, counters in sorted(self.flights.stats().items()):
+                for event, value in sorted(counters.items()):
+                    lines.append(f'kg_singleflight_events_total{{kind="{kind}",event="{event}"}} {value}')
+        lines.append("# TYPE kg_output_validation_total counter")
+        validation = self.validation.stats()
+        for output, counters in sorted(validation.items()):
+            for event in ValidationStats.EVENTS:
+                lines.append(f'kg_output_validation_total{{output="{output}",event="{event}"}} {counters[event]}')
+        lines.append("# TYPE kg_output_validation_rate gauge")
+        for output, counters in sorted(validation.items()):
+            for rate in ("repair_rate", "regeneration_rate"):
+                lines.append(f'kg_output_validation_rate{{output="{output}",rate="{rate}"}} {counters[rate]:.4f}')
+        if self.hedge is not None:
+            hedge = self.hedge.stats()
+            lines.append("# TYPE kg_llm_hedge_total counter")
+            for stage, counters in sorted(hedge.items()):
+                for event in HedgePolicy.EVENTS:
+                    lines.append(f'kg_llm_hedge_total{{stage="{stage}",event="{event}"}} {counters[event]}')
+            lines.append("# TYPE kg_llm_hedge_saved_seconds_total counter")
+            for stage, counters in sorted(hedge.items()):
+                lines.append(f'kg_llm_hedge_saved_seconds_total{{stage="{stage}"}} {counters["saved_seconds"]:.3f}')
+            lines.append("# TYPE kg_llm_hedge_delay_seconds gauge")
+            for stage, counters in sorted(hedge.items()):
+                lines.append(f'kg_llm_hedge_delay_seconds{{stage="{stage}"}} {counters["delay"]:.3f}')
+        lines.append("# TYPE kg_local_themes_total counter")
+        for event in ThemeExtractor.EVENTS:
+            lines.append(f'kg_local_themes_total{{event="{event}"}} {self.local_themes.stats()[event]}')
+        lines.append("# TYPE kg_label_events_total counter")
+        for event, value in sorted(self.labels.stats().items()):
+            if event not in ("properties", "items"):
+                lines.append(f'kg_label_events_total{{event="{event}"}} {value}')
+        if self.library is not None:
+            library = self.library.stats()
+            lines.append("# TYPE kg_deck_library_total counter")
+            for event, value in sorted(library.items()):
+                if event != "hit_rate":
+                    lines.append(f'kg_deck_library_total{{event="{event}"}} {value}')
+            lines.append("# TYPE kg_deck_library_hit_rate gauge")
+            lines.append(f"kg_deck_library_hit_rate {library['hit_rate']:.4f}")
+        lines.append("# TYPE kg_http_events_total counter")
+        for endpoint, counters in sorted(self.transport.metrics().items()):
+            for event, value in sorted(counters.items()):
+                lines.append(f'kg_http_events_total{{endpoint="{endpoint}",event="{event}"}} {value}')
+        return lines
 
-    def getCombinedResponse(self,prompt):
+    def getCombinedResponse(self, prompt, deadline=None, extractor=None):
         """
         Get a combined response from the LLM by extracting themes, querying Wikidata, and refining the results.
+        Concurrent calls with the same (normalized) prompt share a single generation.
+        Under a deadline, the budget is split across the stages (DEADLINE_SHARES): requests still outstanding
+        at a stage deadline are cancelled and the response is built from what arrived in time, with a
+        "degraded" key listing the parts that were cut.
         Args:
             prompt (str): The input prompt to process.
+            deadline (float): End-to-end latency budget in seconds (defaults to RESPONSE_DEADLINE).
+            extractor (str): Theme extraction of this request, "llm" or "local" (defaults to THEME_EXTRACTOR).
         Returns:
             dict: A dictionary containing the refined response with facts, questions, and an answer.
         """
-        #Step 1: Extract Entities Themes from LLM
-        themes = self.extractThemes(prompt)
-        if themes:
-            #Step 2: Get Themes IDs from Wikidata
-            themes_id = self.getThemesID(themes)
+        deck = self.getDeck(prompt, deadline, extractor)
+        return deck["response"] if deck else None
+
+    @traced("getCombinedResponse")
+    def getDeck(self, prompt, deadline=None, extractor=None):
+        """
+        Same as getCombinedResponse, also returning what the response was generated from (e.g. for
+        src/batch.py, whose output can be imported in the deck library).
+        Args:
+            prompt (str): The input prompt to process.
+            deadline (float): End-to-end latency budget in seconds (defaults to RESPONSE_DEADLINE).
+            extractor (str): Theme extraction of this request, "llm" or "local" (defaults to THEME_EXTRACTOR).
+        Returns:
+            dict: The response, the themes (main theme first), their Wikidata IDs (themes_id) and the triples,
+                or None if no themes could be extracted.
+        """
+        extractor = extractor or self.theme_extractor
+        stored = self.libraryDeck(prompt)
+        if stored is not None:
+            return self.storedDeck(stored)
+
+        deadline = deadline or self.response_deadline
+        key = self.cache.key("response", self.openrouter_url, self.openrouter_model, self.model_routes, normalizePrompt(prompt), deadline, extractor)
+        deck, shared = self.coalesce("response", key, self.generateResponse, prompt, deadline, extractor)
+        # Every caller gets its own copy of a shared deck
+        return copy.deepcopy(deck) if shared else deck
+
+    def generateResponse(self, prompt, deadline=None, extractor=None):
+        with activate(Deadline(deadline, self.deadline_shares) if deadline else None):
+            graph = self.collectTriples(prompt, extractor)
+            if graph is None:
+                return None
+            if "deck" in graph:
+                return self.storedDeck(graph["deck"])
+            triples = graph["triples"]
+
+            #Step 4: Refine Triplets with LLM
+            with deadlineStage("refine"):
+                response = self.refineTriples(prompt, triples)
+            response = self.degradeResponse(response, triples)
+        self.storeDeck(prompt, response, triples, graph["themes"], graph["themes_id"])
+        return {"response": response, "themes": graph["themes"], "themes_id": graph["themes_id"], "triples": triples}
 
-            #Step 3: Get Triplets using SPARQL
-            triples = self.getTriples(themes_id)
+    @traced("getCombinedResponse")
+    def getCombinedResponseStream(self, prompt, deadline=None, extractor=None):
+        """
+        Streaming version of getCombinedResponse: the refinement step is streamed and every
+        fact, question and the summary are yielded as soon as they are complete.
+        Args:
+            prompt (str): The input prompt to process.
+            deadline (float): End-to-end latency budget in seconds (defaults to RESPONSE_DEADLINE).
+            extractor (str): Theme extraction of this request, "llm" or "local" (defaults to THEME_EXTRACTOR).
+        Yields:
+            tuple: (key, value) events where key is "facts", "questions" or "summary", followed by
+                a final ("result", dict) event with the same dict getCombinedResponse returns.
+        """
+        extractor = extractor or self.theme_extractor
+        stored = self.libraryDeck(prompt)
+        if stored is not None:
+            yield "result", self.completeDeck(stored)
+            return
+
+        deadline = deadline or self.response_deadline
+        with activate(Deadline(deadline, self.deadline_shares) if deadline else None):
+            graph = self.collectTriples(prompt, extractor)
+            if graph is None:
+                yield "result", None
+                return
+            if "deck" in graph:
+                yield "result", self.completeDeck(graph["deck"])
+                return
+            triples = graph["triples"]
 
             #Step 4: Refine Triplets with LLM
-            return self.refineTriples(prompt, triples)
+            with deadlineStage("refine"):
+                for key, value in self.refineTriplesStream(prompt, triples):
+                    if key == "result":
+                        value = self.degradeResponse(value, triples)
+                        self.storeDeck(prompt, value, triples, graph["themes"], graph["themes_id"])
+                    yield key, value
+
+    @traced("getLazyResponse")
+    def getLazyResponse(self, prompt, deadline=None, extractor=None):
+        """
+        Lazy version of getCombinedResponse: collect the triples and generate the summary only.
+        The facts and questions are generated the first time they are read, or in the background
+        when LAZY_PREFETCH is set.
+        Args:
+            prompt (str): The input prompt to process.
+            deadline (float): Latency budget in seconds of the triples and the summary (defaults to RESPONSE_DEADLINE).
+            extractor (str): Theme extraction of this request, "llm" or "local" (defaults to THEME_EXTRACTOR).
+        Returns:
+            LazyResponse: The response, or None if no themes could be extracted.
+        """
+        extractor = extractor or self.theme_extractor
+        stored = self.libraryDeck(prompt)
+        if stored is not None:
+            return self.storedLazyResponse(stored)
+
+        deadline = deadline or self.response_deadline
+        with activate(Deadline(deadline, self.deadline_shares) if deadline else None) as budget:
+            graph = self.collectTriples(prompt, extractor)
+            if graph is None:
+                return None
+            if "deck" in graph:
+                return self.storedLazyResponse(graph["deck"])
+            triples = graph["triples"]
+
+            #Step 4: Generate the summary now, the facts and questions on demand
+            response = LazyResponse(self, prompt, triples, themes=graph["themes"], themes_id=graph["themes_id"])
+            with deadlineStage("refine"):
+                response.part("summary")
+            if budget is not None:
+                response.values["degraded"] = budget.report()
+
+        if self.prefetcher is not None:
+            response.prefetch(self.prefetcher)
+        return response
+
+    @traced("libraryDeck")
+    def libraryDeck(self, prompt):
+        """
+        Look up the deck library for a deck of the same or a closely matching topic. This lookup is local and
+        runs before the deadline starts; the entity match (DECK_ENTITY_MATCH) needs the themes and runs in
+        the themes stage (see entityDeck).
+        Args:
+            prompt (str): The input prompt.
+        Returns:
+            dict: The stored deck (its response has a "library" key with the stored topic), or None.
+        """
+        if self.library is None:
+            return None
+        try:
+            deck = self.library.find(prompt)
+        except sqlite3.Error as e:
+            self.tracer.error(e)
+            print(f"[DeckLibrary - Error]: {e}")
+            return None
+        return self.libraryHit(prompt, deck) if deck is not None else None
+
+    def entityDeck(self, prompt, themes):
+        """
+        Resolve the main theme of the prompt and look up a deck of the same entity with overlapping themes.
+        Called in the themes stage, so both run under its deadline.
+        Args:
+            prompt (str): The input prompt.
+            themes (list): The extracted themes, the main theme first.
+        Returns:
+            tuple: The stored deck (see DeckLibrary.findEntity) or None, and the ID of the main theme
+                (None if it didn't resolve), reused to fetch the triples after a miss.
+        """
+        qid = self.wikidataLookup(themes[0], type="item")
+        if not qid:
+            return None, None
+        try:
+            deck = self.library.findEntity(qid, themes)
+        except sqlite3.Error as e:
+            self.tracer.error(e)
+            print(f"[DeckLibrary - Error]: {e}")
+            return None, qid
+        return (self.libraryHit(prompt, deck) if deck is not None else None), qid
+
+    def storedLazyResponse(self, deck):
+        """
+        Wrap a library deck in a LazyResponse: parts missing from a deck saved by a lazy response (tabs that
+        were never opened) are generated from its triples on first access, and update the stored deck.
+        Args:
+            deck (dict): The stored deck.
+        Returns:
+            LazyResponse: The response.
+        """
+        return LazyResponse(self, deck["topic"], deck["triples"], deck["response"], deck["themes"], deck["qids"])
+
+    def storedDeck(self, deck):
+        # A library deck in the shape of getDeck's result
+        return {"response": self.completeDeck(deck), "themes": deck["themes"], "themes_id": deck["qids"], "triples": deck["triples"]}
+
+    def completeDeck(self, deck):
+        # Non-lazy callers expect every part: generate the ones a partially saved deck is missing
+        if all(part in deck["response"] for part in LazyResponse.PARTS):
+            return deck["response"]
+        return self.storedLazyResponse(deck).toDict()
+
+    def libraryHit(self, prompt, deck):
+        self.tracer.annotate(library_hits=1)
+        print(f"[DeckLibrary - Hit]: {prompt} -> {deck['topic']} ({deck['match']} match, similarity {deck['similarity']:.2f})")
+        deck["response"]["library"] = {"id": deck["id"], "topic": deck["topic"], "similarity": deck["similarity"], "match": deck["match"]}
+        return deck
+
+    def storeDeck(self, prompt, response, triples, themes=None, themes_id=None):
+        """
+        Save a generated deck in the library, unless it is empty or was degraded to meet a deadline.
+        Args:
+            prompt (str): The input prompt.
+            response (dict): The response.
+            triples (list): The triples it was generated from.
+            themes (list): The extracted themes, the main theme first (indexed for the entity match).
+            themes_id (dict): The resolved themes mapped to their Wikidata IDs.
+        """
+        if self.library is None or not response or response.get("degraded") or not (response.get("facts") or response.get("questions")):
+            return
+        try:
+            self.library.save(
+                prompt, {k: v for k, v in response.items() if k not in ("degraded", "library")}, triples, self.modelFor("refine"),
+                themes, themes_id
+            )
+        except sqlite3.Error as e:
+            self.tracer.error(e)
+            print(f"[DeckLibrary - Error]: {e}")
+
+    def degradeResponse(self, response, triples):
+        """
+        Under a deadline, fall back to the raw triples if the refinement ran out of time,
+        and add the "degraded" report to the response.
+        Args:
+            response (dict): The refined response.
+            triples (list): The triples given to the refinement.
+        Returns:
+            dict: The response (unchanged without a deadline).
+        """
+        deadline = currentDeadline()
+        if deadline is None:
+            return response
+        if deadline.expired():
+            if not response or not (response.get("facts") or response.get("questions")):
+                degrade("refine", "refinement timed out, the facts are the raw triples")
+                response = {
+                    "facts": [f"{t['entity']} {t['relation']} {t['object']}." for t in triples[:self.refine_max_facts]],
+                    "questions": [],
+                    "summary": f"Key facts about {triples[0]['entity']}." if triples else "No information could be generated."
+                }
+            else:
+                degrade("refine", "refinement reached the deadline, the response may be partial")
+        return {**response, "degraded": deadline.report()}
+
+    def collectTriples(self, prompt, extractor=None):
+        """
+        Run the knowledge graph part of the pipeline: extract themes, resolve their IDs and fetch their triples.
+        Concurrent calls with the same (normalized) prompt share a single run.
+        Args:
+            prompt (str): The input prompt to process.
+            extractor (str): Theme extraction, "llm" or "local" (defaults to THEME_EXTRACTOR).
+        Returns:
+            dict: The themes, their IDs (themes_id) and the ranked triples, or the themes and a "deck" from the
+                library when a deck of the same main entity matched (DECK_ENTITY_MATCH); None if no themes
+                could be extracted.
+        """
+        extractor = extractor or self.theme_extractor
+        key = self.cache.key("triples", self.openrouter_url, self.modelFor("themes"), normalizePrompt(prompt), extractor)
+        try:
+            graph, shared = self.coalesce("triples", key, self.buildTriples, prompt, extractor, stage="triples")
+        except DeadlineExceeded as e:
+            # Only reached by a follower whose leader is slower than our triples deadline
+            degrade("triples", str(e))
+            return {"themes": [], "themes_id": {}, "triples": []}
+        return copy.deepcopy(graph) if shared else graph
+
+    def buildTriples(self, prompt, extractor=None):
+        #Step 1: Extract Entities Themes from LLM (or locally), then look for a deck of the same main entity
+        known = {}
+        with deadlineStage("themes") as stage:
+            themes = self.extractThemes(prompt, extractor)
+            if themes and self.library is not None and self.entity_match:
+                deck, qid = self.entityDeck(prompt, themes)
+                if deck is not None:
+                    return {"themes": themes, "themes_id": {themes[0]: qid}, "deck": deck}
+                if qid:
+                    known[themes[0]] = qid
+        if not themes and stage is not None and stage.expired():
+            degrade("themes", "theme extraction timed out, the prompt is the only theme")
+            themes = [prompt]
+
+        if themes:
+            with deadlineStage("triples") as stage:
+                if self.pipelined:
+                    #Steps 2 and 3: Resolve each theme and fetch its triples as soon as its ID is known
+                    themes_id, triples = self.pipelineTriples(themes, known)
+                else:
+                    #Step 2: Get Themes IDs from Wikidata
+                    themes_id = self.getThemesID(themes, known)
+
+                    #Step 3: Get Triplets using SPARQL
+                    triples = self.getTriples(themes_id)
+
+                #Step 3a: Expand to the neighbours of the themes (EXPANSION_DEPTH)
+                triples = self.expandTriples(themes_id, triples)
+
+            skipped = len(set(themes)) - len(themes_id)
+            if stage is not None and stage.expired() and skipped:
+                degrade("triples", f"{skipped} of {len(set(themes))} themes skipped at the deadline")
+
+            #Step 3b: Prune, dedupe and rank the triples before refinement
+            return {"themes": themes, "themes_id": themes_id, "triples": self.rankTriples(triples, themes[0])}
         else:
             print("[getCombinedResponse - Error]: No themes extracted.")
             return None
 
-    def llmQuery(self, sys_msg, user_msg, json_mode= False):
+    @traced("pipeline")
+    def pipelineTriples(self, themes, known=None):
         """
-        Query the LLM with a system message and user message.
+        Resolve the themes and fetch their triples as independent resolve -> fetch tasks, so lookups and
+        SPARQL queries overlap. Resolved themes are micro-batched: they are fetched together once
+        SPARQL_BATCH_SIZE are ready, every theme is resolved, or PIPELINE_BATCH_WINDOW seconds after the
+        first of a batch resolved. The first (main) theme is scheduled first. Returns once every theme is done,
+        or once the main theme and PIPELINE_QUORUM of all themes are done, or at PIPELINE_DEADLINE seconds
+        (or the deadline of the triples stage); tasks that haven't started by then are cancelled.
+        Args:
+            themes (list): A list of themes, the main theme first.
+            known (dict): Themes already resolved (by the entity match), mapped to their IDs.
+        Returns:
+            tuple: A dictionary mapping themes to their Wikidata IDs, and the list of triples (in theme order).
+        """
+        themes = list(dict.fromkeys(themes))
+        done = {theme: Future() for theme in themes}
+        tasks = []
+        lock = threading.Lock()
+
+        def finish(theme, qid, triples):
+            with lock:
+                if not done[theme].done():
+                    done[theme].set_result((qid, triples))
+
+        ready = []
+        timers = []
+        unresolved = [len(themes)]
+
+        def fetched(batch, future):
+            failed = future.cancelled() or future.exception() is not None
+            triples = [] if failed else future.result()
+            for theme, qid in batch:
+                finish(theme, qid, [triple for triple in triples if triple["entity"] == theme])
+
+        def flush():
+            # Fetch the themes resolved so far with one batched query
+            with lock:
+                batch = list(ready)
+                ready.clear()
+            if not batch:
+                return
+            priority = 0 if any(theme == themes[0] for theme, _ in batch) else 1
+            future = self.pipeline.submit(priority, self.tracer.bind(self.getTriples), dict(batch))
+            future.add_done_callback(lambda f: fetched(batch, f))
+            tasks.append(future)
+
+        def resolve(theme, priority):
+            qid = (known or {}).get(theme) or self.wikidataLookup(theme, type="item")
+            if not qid:
+                print(f"[getThemesID - Failed]: {theme}")
+                finish(theme, None, [])
+            with lock:
+                unresolved[0] -= 1
+                if qid:
+                    ready.append((theme, qid))
+                full = bool(ready) and (len(ready) >= self.sparql_batch_size or unresolved[0] == 0 or not self.pipeline_batch_window)
+                first = len(ready) == 1
+            if full:
+                flush()
+            elif qid and first:
+                timer = threading.Timer(self.pipeline_batch_window, self.tracer.bind(flush))
+                timer.daemon = True
+                timer.start()
+                timers.append(timer)
+
+        for i, theme in enumerate(themes):
+            priority = 0 if i == 0 else 1
+            future = self.pipeline.submit(priority, self.tracer.bind(resolve), theme, priority)
+            future.add_done_callback(lambda f, theme=theme: (f.cancelled() or f.exception()) and finish(theme, None, []))
+            tasks.append(future)
+
+        # Wait for every theme, or for the main theme plus the quorum, or for the deadline
+        quorum = math.ceil(self.pipeline_quorum * len(themes))
+        deadline = time.monotonic() + self.pipeline_deadline if self.pipeline_deadline else None
+        stage = currentDeadline()
+        if stage is not None:
+            deadline = stage.end if deadline is None else min(deadline, stage.end)
+        pending = set(done.values())
+        while pending:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            _, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if deadline is not None and time.monotonic() >= deadline:
+                print(f"[Pipeline - Deadline]: {len(pending)} themes still pending")
+                break
+            if done[themes[0]].done() and len(themes) - len(pending) >= quorum:
+                break
+
+        for timer in timers:
+            timer.cancel()
+        for future in list(tasks):
+            future.cancel()
+
+        themes_id = {}
+        triples = []
+        for theme in themes:
+            if done[theme].done():
+                qid, theme_triples = done[theme].result()
+                if qid:
+                    themes_id[theme] = qid
+                    triples.extend(theme_triples)
+
+        self.tracer.annotate(themes=len(themes), completed=len(themes) - len(pending), resolved=len(themes_id), triples=len(triples))
+        print(f"[getThemesID - Result]: {themes_id}")
+        return themes_id, triples
+
+    @traced("rankTriples")
+    def rankTriples(self, triples, main_entity):
+        """
+        Drop metadata triples (identifiers, templates, categories), dedupe near-identical triples and keep the
+        ones most relevant to the main entity within TRIPLE_TOKEN_BUDGET.
+        Args:
+            triples (list): A list of triples.
+            main_entity (str): The main theme.
+        Returns:
+            list: The processed triples.
+        """
+        result = preprocessTriples(triples, main_entity, self.triple_token_budget, self.triple_dedupe_threshold)
+        self.tracer.annotate(triples_in=len(triples), triples=len(result))
+        print(f"[rankTriples]: kept {len(result)} of {len(triples)} triples")
+        return result
+
+    def modelFor(self, stage):
+        """
+        Get the model a pipeline stage is routed to (MODEL_ROUTES), OPENROUTER_API_MODEL by default.
+        """
+        return self.model_routes.get(stage, self.openrouter_model)
+
+    def llmRequest(self, sys_msg, user_msg, json_mode=False, model=None):
+        """
+        Build the OpenRouter payload and headers for a query.
         Args:
             sys_msg (str): System message to set the context.
             user_msg (str): User message to query the LLM.
-            json_mode (bool): If True, return response in JSON format.
+            json_mode (bool): If True, ask for a JSON response.
+            model (str): The model to query (defaults to OPENROUTER_API_MODEL).
         Returns:
-            str: The response from the LLM.
+            tuple: The payload and headers dictionaries.
         """
         messages = []
         if sys_msg:
             messages.append({"role": "system", "content": sys_msg})
         messages.append({"role": "user", "content": user_msg})
         payload = {
-            "model": self.openrouter_model,
+            "model": model or self.openrouter_model,
             "messages": messages
         }
         headers = {
@@ -63,28 +793,289 @@ class KnowledgeEngine:
         }
         if json_mode:
             payload["response_format"] = {"type": "json"}
-        
+        return payload, headers
+
+    @traced("llmQuery")
+    def llmQuery(self, sys_msg, user_msg, json_mode= False, stage="refine"):
+        """
+        Query the LLM with a system message and user message.
+        Args:
+            sys_msg (str): System message to set the context.
+            user_msg (str): User message to query the LLM.
+            json_mode (bool): If True, return response in JSON format.
+            stage (str): The pipeline stage of the query, selecting its model (see MODEL_ROUTES).
+        Returns:
+            str: The response from the LLM.
+        """
+        payload, headers = self.llmRequest(sys_msg, user_msg, json_mode, self.modelFor(stage))
+        cache_key = self.cache.key("llm", self.openrouter_url, payload)
         try:
-            response = requests.post(
-                self.openrouter_url,
-                headers=headers,
-                data=json.dumps(payload),
-                timeout=30
-            )
-            response.raise_for_status()
-            return response.json()["choices"][0]["message"]["content"].strip()
+            content, _ = self.coalesce("llm", cache_key, self.llmComplete, payload, headers, cache_key, stage)
+            return content
         except Exception as e:
+            self.tracer.error(e)
             print(f"[LLM Query Error]: {e}")
             return None
 
-    def extractThemes(self, prompt):
+    def llmComplete(self, payload, headers, cache_key, stage="refine"):
+        """
+        Send a (non-streamed) completion request, unless the completion is cached.
+        Args:
+            payload (dict): The OpenRouter payload.
+            headers (dict): The request headers.
+            cache_key (str): The cache key of the completion.
+            stage (str): The pipeline stage of the request (hedge delays are tracked per stage).
+        Returns:
+            str: The completion.
+        Raises:
+            Exception: If the request fails or the response can't be parsed.
+        """
+        cached = self.cacheGet("llm", cache_key)
+        if cached is not MISSING:
+            return cached
+
+        if self.hedge is not None:
+            content = self.hedgedCompletion(payload, headers, stage)
+            self.cache.set("llm", cache_key, content)
+            return content
+
+        response = self.transport.post(
+            self.openrouter_url,
+            endpoint="openrouter",
+            headers=headers,
+            data=json.dumps(payload),
+            timeout=30
+        )
+        response.raise_for_status()
+        data = response.json()
+        self.annotateUsage(data)
+        content = data["choices"][0]["message"]["content"].strip()
+        self.cache.set("llm", cache_key, content)
+        return content
+
+    def hedgedCompletion(self, payload, headers, stage):
         """
-        Extract high-level themes from the prompt using the LLM.
+        Send a completion request, and a backup request (HEDGE_MODEL, HEDGE_API_URL) once the primary has been
+        running longer than the hedge delay of its stage, or as soon as it fails. The first valid completion
+        (non-empty, and parsable for JSON requests) is returned and the other request is cancelled: its
+        connection is shut down, so it stops at once even while waiting for its first byte.
+        Args:
+            payload (dict): The OpenRouter payload.
+            headers (dict): The request headers.
+            stage (str): The pipeline stage of the request.
+        Returns:
+            str: The completion.
+        Raises:
+            Exception: The last error if neither request returned a completion.
+        """
+        json_mode = "response_format" in payload
+        cancel = Cancellation()
+        start = time.monotonic()
+        self.hedge.count(stage, "requests")
+        attempts = {
+            self.hedger.submit(self.tracer.bind(self.cancellableCompletion), payload, headers, None, cancel): "primary"
+        }
+        wait(attempts, timeout=self.hedge.delay(stage))
+
+        hedged = False
+        content = error = None
+        try:
+            while attempts:
+                for future in [future for future in attempts if future.done()]:
+                    attempt = attempts.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        error = e
+                        continue
+                    if result and (not json_mode or isValidJSON(result)):
+                        elapsed = time.monotonic() - start
+                        if attempt == "primary":
+                            self.hedge.record(stage, elapsed)
+                        if hedged:
+                            self.hedge.count(stage, "backup_wins" if attempt == "backup" else "primary_wins")
+                            if attempt == "backup":
+                                self.hedge.count(stage, "saved_seconds", self.hedge.saved(stage, elapsed))
+                                # The cancelled primary took at least this long
+                                self.hedge.record(stage, elapsed)
+                                self.tracer.annotate(hedge_won=1)
+                        return result
+                    # Kept in case the other attempt is no better
+                    content = content or result
+
+                if not hedged:
+                    hedged = True
+                    self.hedge.count(stage, "hedged")
+                    self.tracer.annotate(hedged=1)
+                    print(f"[LLM Hedge]: sending a backup {stage} request after {time.monotonic() - start:.2f}s")
+                    backup = {**payload, "model": self.hedge_model or payload["model"]}
+                    backup_headers = {**headers, "Authorization": f"Bearer {self.hedge_apikey}"}
+                    future = self.hedger.submit(self.tracer.bind(self.cancellableCompletion), backup, backup_headers, self.hedge_url, cancel)
+                    attempts[future] = "backup"
+                if attempts:
+                    wait(attempts, return_when=FIRST_COMPLETED)
+        finally:
+            # Cancel the request still running, if any
+            cancel.set()
+
+        if content:
+            return content
+        self.hedge.count(stage, "failures")
+        raise error or RuntimeError("empty completion")
+
+    def cancellableCompletion(self, payload, headers, url=None, cancel=None):
+        """
+        Stream a completion request to its end (an attempt of a hedged request).
+        Args:
+            payload (dict): The OpenRouter payload.
+            headers (dict): The request headers.
+            url (str): The completion API URL (defaults to OPENROUTER_API_URL).
+            cancel (Cancellation): Set to abort the request.
+        Returns:
+            str: The completion.
+        Raises:
+            HedgeCancelled: If the request was cancelled.
+        """
+        return "".join(self.streamCompletion(payload, headers, url, cancel)).strip()
+
+    @traced("llmQuery")
+    def llmStream(self, sys_msg, user_msg, json_mode=False, stage="refine"):
+        """
+        Query the LLM and stream the completion as it is generated (server-sent events).
+        A cached completion, or one shared from an identical request already in flight, is yielded in a single chunk.
+        Streams are routed like queries but not hedged (their chunks are already shown).
+        Args:
+            sys_msg (str): System message to set the context.
+            user_msg (str): User message to query the LLM.
+            json_mode (bool): If True, return response in JSON format.
+            stage (str): The pipeline stage of the query, selecting its model (see MODEL_ROUTES).
+        Yields:
+            str: The next chunk of the completion.
+        Raises:
+            Exception: If the request fails or the stream is interrupted.
+        """
+        payload, headers = self.llmRequest(sys_msg, user_msg, json_mode, self.modelFor(stage))
+
+        cache_key = self.cache.key("llm", self.openrouter_url, payload)
+        cached = self.cacheGet("llm", cache_key)
+        if cached is not MISSING:
+            yield cached
+            return
+
+        call, leader = self.flights.join("llm", cache_key) if self.flights else (None, False)
+        if call is not None and not leader:
+            self.tracer.annotate(coalesced=1)
+            try:
+                yield call.result(timeout=self.followerTimeout())
+                return
+            except TimeoutError:
+                raise DeadlineExceeded("deadline exceeded waiting for a shared completion stream")
+            except CancelledError:
+                # The leading request was interrupted: stream on our own
+                call = None
+
+        try:
+            content = yield from self.streamCompletion(payload, headers)
+        except DeadlineExceeded:
+            # Our own deadline: the followers retry on their own
+            if call is not None:
+                self.flights.cancel("llm", cache_key, call)
+            raise
+        except Exception as e:
+            if call is not None:
+                self.flights.fail("llm", cache_key, call, e)
+            raise
+        except BaseException:
+            # Also reached when the consumer closes the generator early
+            if call is not None:
+                self.flights.cancel("llm", cache_key, call)
+            raise
+        self.cache.set("llm", cache_key, content)
+        if call is not None:
+            self.flights.resolve("llm", cache_key, call, content)
+
+    def streamCompletion(self, payload, headers, url=None, cancel=None):
+        """
+        Send a streamed completion request and yield its chunks.
+        Args:
+            payload (dict): The OpenRouter payload.
+            headers (dict): The request headers.
+            url (str): The completion API URL (defaults to OPENROUTER_API_URL).
+            cancel (Cancellation): Set to abort the request, even while it waits for the server.
+        Yields:
+            str: The next chunk of the completion.
+        Returns:
+            str: The whole completion.
+        Raises:
+            DeadlineExceeded: If the current deadline passes while streaming.
+            HedgeCancelled: If cancel is set while streaming.
+        """
+        url = url or self.openrouter_url
+        deadline = currentDeadline()
+        chunks = []
+        try:
+            with self.transport.post(
+                url,
+                endpoint="openrouter" if url == self.openrouter_url else "hedge",
+                headers=headers,
+                data=json.dumps({**payload, "stream": True}),
+                timeout=30,
+                stream=True,
+                cancel=cancel
+            ) as response:
+                try:
+                    response.raise_for_status()
+                    response.encoding = "utf-8"
+                    for line in response.iter_lines(decode_unicode=True):
+                        self.tracer.annotate(bytes_received=len(line) + 1)
+                        if deadline is not None:
+                            deadline.timeout()
+                        if cancel is not None and cancel.is_set():
+                            raise HedgeCancelled()
+                        # Skip keep-alive comments (e.g. ": OPENROUTER PROCESSING") and blank lines
+                        if not line or not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+                        event = json.loads(data)
+                        if "error" in event:
+                            raise RuntimeError(event["error"])
+                        self.annotateUsage(event)
+                        if not event.get("choices"):
+                            continue
+                        delta = event["choices"][0].get("delta", {}).get("content")
+                        if delta:
+                            chunks.append(delta)
+                            yield delta
+                finally:
+                    if cancel is not None:
+                        cancel.detach()
+        except Exception:
+            # An aborted connection fails (or ends early) with whatever error the read raised
+            if cancel is not None and cancel.is_set():
+                raise HedgeCancelled()
+            raise
+        if cancel is not None and cancel.is_set():
+            raise HedgeCancelled()
+        return "".join(chunks).strip()
+
+    @traced("extractThemes")
+    def extractThemes(self, prompt, extractor=None):
+        """
+        Extract high-level themes from the prompt using the LLM, or locally (see localThemes) when the
+        extractor is "local" and the local themes are confident enough.
         Args:
             prompt (str): The input prompt to process.
+            extractor (str): "llm" or "local" (defaults to THEME_EXTRACTOR).
         Returns:
             list: A list of extracted themes.
         """
+        if (extractor or self.theme_extractor) == "local":
+            themes = self.localThemes(prompt)
+            if themes:
+                return themes
+
         system_msg = (
             "Extract a list of up to 10 related high-level topics (themes) from the prompt."
             "The first of the list should be the prompted theme."
@@ -92,41 +1083,91 @@ class KnowledgeEngine:
             "methods (e.g., Convolutional Neural Networks), or technologies (e.g., Deep Learning). "
             "Only return a valid JSON list of strings. No explanations or markdown."
         )
-        content = self.llmQuery(system_msg, prompt, json_mode=True)
+        content = self.llmQuery(system_msg, prompt, json_mode=True, stage="themes")
         if content:
-            if content.startswith("```json"):
-                content = content[7:]
-            if content.endswith("```"):
-                content = content[:-3]
-            themes = json.loads(content)
+            themes, dropped = validateThemes(self.parseOutput("themes", content, list))
+            if dropped:
+                self.validation.count("themes", "invalid_items", dropped)
+            if not themes:
+                # Unusable completion: the prompt is the only theme
+                print(f"[Theme Extraction Error]: {content}")
+                return [prompt]
             print(f"[Extracted Themes]: {themes}")
             return themes
         else:
             print(f"[Theme Extraction Error]: {content}")
             return None
     
-    def getThemesID(self, themes):
+    def localThemes(self, prompt):
+        """
+        Extract the themes with spaCy (entities and noun chunks of the prompt), resolve the main theme and
+        complete the list with the entities it links to in Wikidata (local store or cache first; the fetched
+        claims are reused by getTriples).
+        Args:
+            prompt (str): The input prompt to process.
+        Returns:
+            list: The themes, or None to fall back to the LLM (spaCy unavailable, confidence below
+                THEME_LOCAL_CONFIDENCE, or main theme not found in Wikidata).
+        """
+        themes, confidence = self.local_themes.extract(prompt)
+        if not themes or confidence < self.theme_local_confidence:
+            reason = "unavailable" if not self.local_themes.available() else "low_confidence"
+            self.local_themes.count(reason)
+            self.tracer.annotate(local_theme_fallbacks=1)
+            print(f"[Local Theme Extraction - Fallback]: {reason} ({themes}, confidence {confidence:.2f})")
+            return None
+        qid = self.wikidataLookup(themes[0], type="item")
+        if not qid:
+            self.local_themes.count("unresolved")
+            self.tracer.annotate(local_theme_fallbacks=1)
+            print(f"[Local Theme Extraction - Fallback]: main theme {themes[0]} not found")
+            return None
+
+        seen = {theme.lower() for theme in themes}
+        for _, obj, pid, value_id in self.entityTriples([qid]).get(qid, []):
+            if len(themes) >= self.local_themes.max_themes:
+                break
+            if value_id and self.followsProperty(pid) and not ENTITY_ID.match(obj) and obj.lower() not in seen:
+                themes.append(obj)
+                seen.add(obj.lower())
+        self.local_themes.count("local")
+        self.tracer.annotate(local_themes=1)
+        print(f"[Extracted Themes - Local]: {themes} (confidence {confidence:.2f})")
+        return themes
+
+    @traced("getThemesID")
+    def getThemesID(self, themes, known=None):
         """
         Get Wikidata IDs for the extracted themes.
         Args:
             themes (list): A list of themes to look up.
+            known (dict): Themes already resolved (by the entity match), mapped to their IDs.
         Returns:
             dict: A dictionary mapping themes to their Wikidata IDs.
         """
+        known = known or {}
+        # Resolve all themes concurrently; each lookup fails independently
+        with ThreadPoolExecutor(max_workers=max(1, self.lookup_concurrency)) as executor:
+            qids = list(executor.map(self.tracer.bind(lambda theme: known.get(theme) or self.wikidataLookup(theme, type="item")), themes))
+
+        # Keep the input theme order in the result
         themes_id = {}
-        for theme in themes:
-            qid = self.wikidataLookup(theme, type="item")
+        for theme, qid in zip(themes, qids):
             if qid:
-                themes_id[theme] = qid 
+                themes_id[theme] = qid
             else:
                 print(f"[getThemesID - Failed]: {theme}")
 
+        self.tracer.annotate(themes=len(themes), resolved=len(themes_id))
         print(f"[getThemesID - Result]: {themes_id}")
         return themes_id
     
+    @traced("wikidataLookup")
     def wikidataLookup(self, search_term, type="item"):
         """
         Look up a term in Wikidata and return its ID.
+        Items are resolved with the local label index (LABEL_INDEX_PATH) first; the wbsearchentities
+        API is only called when the local match is below LABEL_INDEX_CONFIDENCE.
         Args:
             search_term (str): The term to look up.
             type (str): The type of entity to search for (item [default] or property).
@@ -134,77 +1175,341 @@ class KnowledgeEngine:
             str: The Wikidata ID of the entity.
         """
         print(f"[Wikidata Lookup - {type.title()} Search Term]: {search_term}")
+        local = None
         try:
             if re.match(r"^[PQ]\d+$", search_term):
                 print(f"[Wikidata Search Result]: {search_term}")
                 return search_term
 
-            params = {
-                "action": "wbsearchentities",
-                "search": search_term,
-                "language": "en",
-                "format": "json",
-                "type": type
-            }
-            response = requests.get(self.wikidata_api, params=params)
-            result = response.json().get("search", [])[0]["id"]
-            print(f"[Wikidata Search Result]: {result}")
+            if self.label_index and type == "item":
+                local = self.label_index.lookup(search_term)
+                if local and local["confidence"] >= self.label_index_confidence:
+                    self.tracer.annotate(label_index_hits=1)
+                    print(f"[Wikidata Search Result - Local {local['match'].title()}]: {local['qid']} ({local['confidence']})")
+                    return local["qid"]
+                self.tracer.annotate(label_index_misses=1)
+
+            cache_key = self.cache.key("lookup", self.wikidata_api, search_term, type)
+            result, _ = self.coalesce("lookup", cache_key, self.searchEntity, search_term, type, cache_key)
             return result
         except Exception as e:
+            self.tracer.error(e)
             print(f"[Wikidata {type.title()} Lookup Failed]: {e}")
+            # A low-confidence local match is still better than no entity when the API is unreachable
+            if local:
+                print(f"[Wikidata Search Result - Local Fallback]: {local['qid']} ({local['confidence']})")
+                return local["qid"]
             return None
     
+    def searchEntity(self, search_term, type, cache_key):
+        """
+        Search an entity with the wbsearchentities API, unless the result is cached.
+        Args:
+            search_term (str): The term to look up.
+            type (str): The type of entity to search for (item or property).
+            cache_key (str): The cache key of the lookup.
+        Returns:
+            str: The Wikidata ID of the first result.
+        Raises:
+            Exception: If the request fails or there is no result.
+        """
+        cached = self.cacheGet("lookup", cache_key)
+        if cached is not MISSING:
+            print(f"[Wikidata Search Result - Cached]: {cached}")
+            return cached
+
+        params = {
+            "action": "wbsearchentities",
+            "search": search_term,
+            "language": "en",
+            "format": "json",
+            "type": type
+        }
+        response = self.transport.get(self.wikidata_api, endpoint="wikidata", params=params, timeout=self.lookup_timeout)
+        response.raise_for_status()
+        result = response.json().get("search", [])[0]["id"]
+        self.cache.set("lookup", cache_key, result)
+        print(f"[Wikidata Search Result]: {result}")
+        return result
+
+    @traced("getTriples")
     def getTriples(self, themes_id):
         """
         Get triples from Wikidata using SPARQL for the given themes.
         Args:
             themes_id (dict): A dictionary mapping themes to their Wikidata IDs.
         Returns:
-            list: A list of triples extracted from Wikidata.
+            list: A list of triples extracted from Wikidata (hop 0, see expandTriples).
         """
+        results = self.entityTriples(themes_id.values())
+
+        # Rebuild the triples in theme order
         triples = []
         for theme, id in themes_id.items():
-            query = f"""
-            SELECT DISTINCT ?propertyLabel (SAMPLE(?valueLabel) AS ?valueLabel) (SAMPLE(?valueDescription) AS ?valueDescription) WHERE {{
-                wd:{id} ?p ?statement .
-                ?statement ?ps ?value .
-                ?property wikibase:directClaim ?ps .
-                
-                OPTIONAL {{
-                    ?value schema:description ?valueDescription .
-                    FILTER(LANG(?valueDescription) = "en")
-                }}
-                
-                SERVICE wikibase:label {{ 
-                    bd:serviceParam wikibase:language "en" .
-                    ?property rdfs:label ?propertyLabel .
-                    ?value rdfs:label ?valueLabel .
-                }}
-            }}
-            GROUP BY ?propertyLabel
-            LIMIT 10
-            """
-            try:
-                response = requests.get(
-                    self.sparql_endpoint,
-                    params={"query": query, "format": "json"},
-                    headers={"Accept": "application/sparql-results+json"},
-                    timeout=10
-                )
-                response.raise_for_status()
-                results = response.json()["results"]["bindings"]
-                for r in results:
-                    triple = {
-                        "entity": theme,
-                        "relation": r["propertyLabel"]["value"],
-                        "object": r["valueLabel"]["value"]
-                    }
-                    triples.append(triple)
-            except Exception as e:
-                print(f"[SPARQL Query Error]: {e}")
+            for relation, obj, *_ in results.get(id, []):
+                triples.append({
+                    "entity": theme,
+                    "qid": id,
+                    "relation": relation,
+                    "object": obj,
+                    "hop": 0
+                })
+        self.tracer.annotate(entities=len(themes_id), triples=len(triples))
         print(f"[Extracted Triples]: {triples}")
         return triples
-    
+
+    @traced("expandTriples")
+    def expandTriples(self, themes_id, triples):
+        """
+        Expand the triples of the themes breadth-first to EXPANSION_DEPTH hops. Each hop fetches the
+        frontier (the not yet visited entities the previous hop links to, at most EXPANSION_FRONTIER, the
+        main theme's neighbours first) in batched queries. Links through denied (or not allowed) properties
+        aren't followed, and the expansion stops at EXPANSION_MAX_TRIPLES new triples or at its time budget
+        (EXPANSION_TIME_BUDGET, or the deadline of the triples stage).
+        Args:
+            themes_id (dict): A dictionary mapping themes to their Wikidata IDs.
+            triples (list): The triples of the themes (hop 0).
+        Returns:
+            list: The triples followed by the triples of the neighbours, whose "hop" is their distance to the themes.
+        """
+        if self.expansion_depth <= 1 or not themes_id:
+            return triples
+        end = time.monotonic() + self.expansion_time_budget
+        deadline = currentDeadline()
+        if deadline is not None:
+            end = min(end, deadline.end)
+
+        visited = set(themes_id.values())
+        # Served from the cache (or the local store): getTriples just fetched them
+        claims = self.entityTriples(themes_id.values())
+        frontier = self.expansionFrontier(claims, themes_id.values(), visited)
+        expanded = []
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            for hop in range(1, self.expansion_depth):
+                if not frontier or len(expanded) >= self.expansion_max_triples or time.monotonic() >= end:
+                    break
+                batch = list(frontier.items())[:self.expansion_frontier]
+                visited.update(qid for qid, _ in batch)
+                future = executor.submit(self.tracer.bind(self.entityTriples), [qid for qid, _ in batch])
+                if not wait([future], timeout=max(0.0, end - time.monotonic())).done:
+                    # Out of time: the fetch finishes in the background and fills the cache for the next time
+                    print(f"[expandTriples]: time budget reached at hop {hop}")
+                    break
+                claims = future.result()
+                for qid, label in batch:
+                    for relation, obj, pid, value_id in claims.get(qid, []):
+                        if len(expanded) >= self.expansion_max_triples:
+                            break
+                        if self.followsProperty(pid):
+                            expanded.append({"entity": label, "qid": qid, "relation": relation, "object": obj, "hop": hop})
+                frontier = self.expansionFrontier(claims, [qid for qid, _ in batch], visited)
+        finally:
+            executor.shutdown(wait=False)
+
+        self.tracer.annotate(triples_in=len(triples), expanded=len(expanded), visited=len(visited))
+        print(f"[expandTriples]: {len(expanded)} triples of {len(visited) - len(set(themes_id.values()))} neighbouring entities")
+        return triples + expanded
+
+    def expansionFrontier(self, claims, qids, visited):
+        """
+        Get the entities linked from the claims of qids (in order) through followed properties and not visited yet.
+        Returns:
+            dict: A dictionary mapping the Wikidata IDs of the linked entities to their labels.
+        """
+        frontier = {}
+        for qid in qids:
+            for _, obj, pid, value_id in claims.get(qid, []):
+                if value_id and value_id not in visited and self.followsProperty(pid) and not ENTITY_ID.match(obj):
+                    frontier.setdefault(value_id, obj)
+        return frontier
+
+    def followsProperty(self, pid):
+        return bool(pid) and (not self.expansion_allow or pid in self.expansion_allow) and pid not in self.expansion_deny
+
+    def entityTriples(self, qids):
+        """
+        Get the claims of entities. Entities in the local store (LOCAL_STORE_PATH) are answered from disk;
+        the others are fetched in batches of SPARQL_BATCH_SIZE (one query per batch), and a batch that fails
+        or times out falls back to one query per entity. Entities already being fetched by another
+        call are awaited instead of queried again. Fetched claims are cached and shared without labels, which
+        are resolved on every read (LabelResolver), so a label that couldn't be fetched is retried next time
+        instead of being cached as its ID.
+        Args:
+            qids (iterable): Wikidata IDs.
+        Returns:
+            dict: A dictionary mapping Wikidata IDs to lists of (relation, object, property ID, value ID) tuples
+                (the value ID is None for literals), without the entities that couldn't be fetched.
+        """
+        # Serve local and cached entities first and only query the missing ones
+        local_results = {}
+        results = {}
+        missing = []
+        for qid in dict.fromkeys(qids):
+            local = self.local_store.triples(qid, self.triples_per_entity) if self.local_store else None
+            if local is not None:
+                local_results[qid] = local
+                self.tracer.annotate(local_store_hits=1)
+                continue
+            cached = self.cacheGet("sparql", self.cache.key("sparql", self.sparql_endpoint, qid, self.triples_per_entity, TRIPLES_QUERY_VERSION))
+            if cached is MISSING:
+                missing.append(qid)
+            else:
+                results[qid] = cached
+
+        # Lead the fetch of the missing entities nobody else is fetching, and follow the others
+        leading, following = {}, {}
+        for qid in missing:
+            key = self.cache.key("sparql", self.sparql_endpoint, qid, self.triples_per_entity, TRIPLES_QUERY_VERSION)
+            call, leader = self.flights.join("sparql", key) if self.flights else (None, True)
+            (leading if leader else following)[qid] = (key, call)
+
+        batches = [list(leading)[i:i + self.sparql_batch_size] for i in range(0, len(leading), self.sparql_batch_size)]
+        try:
+            if batches:
+                with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+                    for batch_results in executor.map(self.tracer.bind(self.fetchTriplesBatch), batches):
+                        for qid, entity_triples in batch_results.items():
+                            self.cache.set("sparql", leading[qid][0], entity_triples)
+                        results.update(batch_results)
+        except Exception:
+            self.settleLeading(leading, results)
+            raise
+        except BaseException:
+            # Interrupted (Streamlit rerun, KeyboardInterrupt): the followers fetch the entities themselves
+            for qid, (key, call) in leading.items():
+                if call is not None:
+                    self.flights.cancel("sparql", key, call)
+            raise
+        self.settleLeading(leading, results)
+
+        for qid, (key, call) in following.items():
+            self.tracer.annotate(coalesced=1)
+            try:
+                entity_triples = call.result(timeout=self.followerTimeout())
+            except TimeoutError:
+                # The leading query outlives our deadline: the entity is skipped
+                self.tracer.annotate(coalesce_timeouts=1)
+                entity_triples = None
+            except CancelledError:
+                entity_triples = self.fetchTriplesBatch([qid]).get(qid)
+            if entity_triples is not None:
+                results[qid] = entity_triples
+        claims = {qid: entity_claims for qid, entity_claims in results.items() if entity_claims is not None}
+        return {**local_results, **self.labelClaims(claims)}
+
+    def settleLeading(self, leading, results):
+        """
+        Hand the result of the entities this call led to their followers. Failed entities resolve to None
+        so their followers skip them too, unless they failed because of our own deadline: then the followers
+        fetch them themselves.
+        Args:
+            leading (dict): A dictionary mapping Wikidata IDs to their (cache key, flight) pairs.
+            results (dict): A dictionary mapping the fetched Wikidata IDs to their raw claims.
+        """
+        deadline = currentDeadline()
+        for qid, (key, call) in leading.items():
+            if call is None:
+                continue
+            if qid not in results and deadline is not None and deadline.expired():
+                self.flights.cancel("sparql", key, call)
+            else:
+                self.flights.resolve("sparql", key, call, results.get(qid))
+
+    def labelClaims(self, claims):
+        """
+        Resolve the labels of raw claims with one LabelResolver call for every entity.
+        Args:
+            claims (dict): A dictionary mapping Wikidata IDs to lists of (property ID, value ID, value) tuples.
+        Returns:
+            dict: A dictionary mapping the Wikidata IDs to lists of (relation, object, property ID, value ID) tuples.
+        """
+        labels = self.labels.labels(
+            [pid for entity in claims.values() for pid, _, _ in entity] +
+            [value_id for entity in claims.values() for _, value_id, _ in entity if value_id]
+        )
+        return {
+            qid: [(labels[pid], labels[value_id] if value_id else value, pid, value_id) for pid, value_id, value in entity]
+            for qid, entity in claims.items()
+        }
+
+    def fetchTriplesBatch(self, qids):
+        """
+        Fetch the triples of several entities with a single SPARQL query, falling back
+        to one query per entity if the batched query fails.
+        Args:
+            qids (list): A list of Wikidata IDs.
+        Returns:
+            dict: A dictionary mapping each Wikidata ID to a list of (property ID, value ID, value) tuples.
+        """
+        try:
+            return self.sparqlTriples(qids)
+        except Exception as e:
+            self.tracer.error(e)
+            if len(qids) == 1:
+                print(f"[SPARQL Query Error]: {e}")
+                return {}
+            print(f"[SPARQL Batch Error - Falling back per entity]: {e}")
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=len(qids)) as executor:
+            for batch_results in executor.map(self.tracer.bind(self.fetchTriplesBatch), [[qid] for qid in qids]):
+                results.update(batch_results)
+        return results
+
+    @traced("sparqlQuery")
+    def sparqlTriples(self, qids):
+        """
+        Run the triples SPARQL query for a list of entities.
+        Values are collapsed to one per entity and property, and only the first TRIPLES_PER_ENTITY
+        properties are kept for each entity. The query returns IDs only: the property and value labels
+        are resolved by entityTriples (see labelClaims).
+        Args:
+            qids (list): A list of Wikidata IDs.
+        Returns:
+            dict: A dictionary mapping each Wikidata ID to a list of (property ID, value ID, value) tuples
+                (the value ID is None for literals, whose value is the literal).
+        Raises:
+            Exception: If the request fails or the response can't be parsed.
+        """
+        values = " ".join(f"wd:{qid}" for qid in qids)
+        # No label service: labels are resolved locally (see LabelResolver)
+        query = f"""
+        SELECT ?item ?property (MIN(?claim) AS ?value) WHERE {{
+            VALUES ?item {{ {values} }}
+            ?item ?ps ?claim .
+            ?property wikibase:directClaim ?ps ;
+                      wikibase:propertyType ?propertyType .
+
+            # Skip identifiers and media, and values that are categories or templates
+            FILTER(?propertyType NOT IN (wikibase:ExternalId, wikibase:CommonsMedia, wikibase:Url,
+                                         wikibase:GeoShape, wikibase:TabularData, wikibase:Math, wikibase:MusicalNotation))
+            FILTER NOT EXISTS {{ ?claim wdt:P31 wd:Q4167836 . }}
+            FILTER NOT EXISTS {{ ?claim wdt:P31 wd:Q11266439 . }}
+        }}
+        GROUP BY ?item ?property
+        """
+        response = self.transport.get(
+            self.sparql_endpoint,
+            endpoint="sparql",
+            params={"query": query, "format": "json"},
+            headers={"Accept": "application/sparql-results+json"},
+            timeout=self.sparql_timeout
+        )
+        response.raise_for_status()
+
+        claims = {qid: [] for qid in qids}
+        for r in response.json()["results"]["bindings"]:
+            qid = r["item"]["value"].rsplit("/", 1)[-1]
+            if qid not in claims or len(claims[qid]) >= self.triples_per_entity:
+                continue
+            pid = r["property"]["value"].rsplit("/", 1)[-1]
+            value = r["value"]
+            value_id = value["value"].rsplit("/", 1)[-1] if value["type"] == "uri" and ENTITY_IRI.match(value["value"]) else None
+            claims[qid].append((pid, value_id, value["value"]))
+        return claims
+
+    @traced("refineTriples")
     def refineTriples(self, prompt, triples):
         """
         Refine the extracted triples using the LLM to generate a more concise and relevant response.
@@ -214,7 +1519,279 @@ class KnowledgeEngine:
         Returns:
             dict: A dictionary containing the refined response with facts, questions, and an answer.
         """
-                
+        self.tracer.annotate(triples=len(triples))
+        if self.useMapReduce(triples):
+            for key, value in self.refineMapReduce(prompt, triples):
+                if key == "result":
+                    return value
+
+        system_msg, full_prompt = self.refinePrompt(prompt, triples)
+        content = self.llmQuery(system_msg, full_prompt, json_mode=True)
+        return self.parseRefined(content, prompt, triples)
+
+    @traced("refineTriples")
+    def refineTriplesStream(self, prompt, triples):
+        """
+        Streaming version of refineTriples.
+        Args:
+            prompt (str): The original prompt.
+            triples (list): A list of extracted triples.
+        Yields:
+            tuple: (key, value) events for every completed fact, question and the summary, followed by
+                a final ("result", dict) event with the same dict refineTriples returns.
+        """
+        self.tracer.annotate(triples=len(triples))
+        if self.useMapReduce(triples):
+            yield from self.refineMapReduce(prompt, triples)
+            return
+
+        system_msg, full_prompt = self.refinePrompt(prompt, triples)
+        parser = IncrementalJSONParser()
+        chunks = []
+        partial = {"facts": [], "questions": [], "summary": ""}
+        try:
+            for chunk in self.llmStream(system_msg, full_prompt, json_mode=True):
+                chunks.append(chunk)
+                for key, value in parser.feed(chunk):
+                    if key == "summary":
+                        partial[key] = value
+                    else:
+                        partial[key].append(value)
+                    yield key, value
+            content = "".join(chunks).strip()
+        except DeadlineExceeded as e:
+            # Out of time: keep what was streamed so far
+            self.tracer.error(e)
+            degrade("refine", "the refinement stream was cut at the deadline")
+            yield "result", partial
+            return
+        except Exception as e:
+            # Fall back to the regular request if the stream breaks
+            self.tracer.error(e)
+            print(f"[LLM Stream Error]: {e}")
+            content = self.llmQuery(system_msg, full_prompt, json_mode=True)
+
+        yield "result", self.parseRefined(content, prompt, triples)
+
+    def useMapReduce(self, triples):
+        """
+        Decide whether the triples are refined with map-reduce (REFINE_MODE "mapreduce", or "auto" when
+        the triples don't fit in REFINE_TOKEN_BUDGET) instead of a single prompt.
+        Args:
+            triples (list): A list of extracted triples.
+        Returns:
+            bool: True to use map-reduce.
+        """
+        if self.refine_mode == "single" or len(triples) < 2:
+            return False
+        if self.refine_mode == "mapreduce":
+            return True
+        return sum(estimateTokens(tripleLine(t)) for t in triples) > self.refine_token_budget
+
+    def refineMapReduce(self, prompt, triples):
+        """
+        Map-reduce refinement for large triple sets. Map: the triples are split into chunks of at most
+        REFINE_TOKEN_BUDGET tokens and each chunk is sent concurrently to the LLM to extract candidate facts
+        and questions. Reduce: the candidates are deduped and ranked locally and a short LLM call writes the
+        summary from the merged facts.
+        Args:
+            prompt (str): The original prompt.
+            triples (list): A list of extracted triples.
+        Yields:
+            tuple: (key, value) events for new facts and questions as each chunk completes and for the summary,
+                followed by a final ("result", dict) event with the facts, questions and summary.
+        """
+        chunks = chunkTriples(triples, self.refine_token_budget)
+        main_entity = triples[0]["entity"]
+        self.tracer.annotate(chunks=len(chunks))
+        print(f"[Refine Map-Reduce]: {len(triples)} triples in {len(chunks)} chunks")
+
+        # Map: extract candidates from every chunk concurrently
+        candidates = [None] * len(chunks)
+        streamed_facts, streamed_questions = [], []
+        with ThreadPoolExecutor(max_workers=max(1, min(len(chunks), self.refine_concurrency))) as executor:
+            futures = {executor.submit(self.tracer.bind(self.mapTriples), prompt, chunk): i for i, chunk in enumerate(chunks)}
+            for future in as_completed(futures):
+                candidate = future.result()
+                candidates[futures[future]] = candidate
+                for fact in candidate["facts"]:
+                    if isinstance(fact, str) and not isDuplicate(fact, streamed_facts, 0.85):
+                        yield "facts", fact
+                for question in candidate["questions"]:
+                    if isinstance(question, dict) and not isDuplicate(question.get("question", ""), streamed_questions, 0.85):
+                        yield "questions", question
+
+        # Reduce: dedupe and rank the candidates, then summarize
+        facts, questions = mergeCandidates(candidates, main_entity, self.refine_max_facts, self.refine_max_questions)
+        if not facts and not questions:
+            print("[Refine Map-Reduce - Error]: No candidates extracted, falling back to a single prompt.")
+            system_msg, full_prompt = self.refinePrompt(prompt, triples)
+            result = self.parseRefined(self.llmQuery(system_msg, full_prompt, json_mode=True), prompt, triples)
+            yield "summary", result.get("summary")
+            yield "result", result
+            return
+
+        summary = self.summarizeFacts(prompt, main_entity, facts)
+        yield "summary", summary
+        yield "result", {"facts": facts, "questions": questions, "summary": summary}
+
+    def mapTriples(self, prompt, triples):
+        """
+        Map step of the map-reduce refinement: extract candidate facts and questions from a chunk of triples.
+        Args:
+            prompt (str): The original prompt.
+            triples (list): A chunk of triples.
+        Returns:
+            dict: A dictionary with the candidate "facts" and "questions" (empty lists on failure).
+        """
+        system_msg = """
+        You are an educational assistant. Based on the given triples and the original user question:
+
+        1. Extract the key facts that are educationally relevant to the original question and its main entity.
+        - Skip over-general or tangential triples.
+        2. Generate up to 4 multiple-choice questions based on these facts:
+            - Each question must have 4 distinct answer options.
+            - One correct answer must be clearly indicated and must be one of the options.
+            - Randomize the order of the answer options.
+
+        Restrictions:
+        - Do NOT include any identifiers or metadata (e.g., "Kinobox ID", "template", or "category").
+        - Avoid generic tautologies or trivial statements.
+
+        Return a JSON object with this structure:
+        {
+        "facts": [ "Fact 1", "Fact 2", ... ],
+        "questions": [
+            {
+            "question": "What is the capital of France?",
+            "options": ["Paris", "London", "Berlin", "Madrid"],
+            "correct_answer": "Paris"
+            },
+            ...
+        ]
+        }
+
+        Output JSON only.
+        """
+        triplet_text = "\nTriples:\n" + "\n".join(tripleLine(t) for t in triples)
+        content = self.llmQuery(system_msg, f"Original question: {prompt}{triplet_text}", json_mode=True, stage="map")
+        # Invalid candidates are dropped: the other chunks make up for them
+        result = self.parseRefined(content, output="map") if content else {}
+        return {"facts": result.get("facts") or [], "questions": result.get("questions") or []}
+
+    def generatePart(self, name, prompt, triples):
+        """
+        Generate one part of a lazy response (summary, facts or questions) with its own LLM call,
+        cached independently of the other parts.
+        Args:
+            name (str): summary, facts or questions.
+            prompt (str): The original prompt.
+            triples (list): A list of extracted triples.
+        Returns:
+            The summary string, or the list of facts or questions (empty on failure).
+        """
+        with self.tracer.span("generate" + name.title(), triples=len(triples)):
+            main_entity = triples[0]["entity"] if triples else prompt
+            triplet_text = "\nTriples:\n" + "\n".join(tripleLine(t) for t in triples)
+            content = self.llmQuery(self.partPrompt(name, main_entity), f"Original question: {prompt}{triplet_text}", json_mode=name != "summary", stage="part")
+            if name == "summary":
+                return content or "No information could be generated."
+
+            result = self.parseRefined(content, prompt, triples, output="part") if content else {}
+            return result.get(name) or []
+
+    def partPrompt(self, name, main_entity):
+        """
+        Build the system message generating one part of a lazy response.
+        Args:
+            name (str): summary, facts or questions.
+            main_entity (str): The main theme of the prompt.
+        Returns:
+            str: The system message.
+        """
+        if name == "summary":
+            return (
+                "You are an educational assistant. Based on the given triples and the original user question, write a "
+                f"concise and enriched paragraph summarizing the key insights about {main_entity}. "
+                "Focus on the main entity and the original question, skip over-general or tangential triples, "
+                "integrate the ideas naturally instead of listing the facts, add brief context where helpful "
+                "(e.g., historical, cultural, practical) and make it read like a human educator's summary. "
+                "Do NOT include any identifiers or metadata. Output the paragraph only."
+            )
+        if name == "facts":
+            return f"""
+        You are an educational assistant. Based on the given triples and the original user question:
+
+        1. Select the most educationally relevant triples **directly related to {main_entity}**.
+        2. Extract up to {self.refine_max_facts} key facts that directly relate to the original question and the main entity.
+
+        Restrictions:
+        - Do NOT include any identifiers or metadata (e.g., "Kinobox ID", "template", or "category").
+        - Avoid generic tautologies or trivial statements.
+
+        Return a JSON object with this structure:
+        {{
+        "facts": [ "Fact 1", "Fact 2", ... ]
+        }}
+
+        Output JSON only.
+        """
+        return f"""
+        You are an educational assistant. Based on the given triples and the original user question:
+
+        Generate 5–{self.refine_max_questions} thought-provoking multiple-choice questions about {main_entity}:
+            - Each question must have 4 distinct answer options.
+            - One correct answer must be clearly indicated and must be one of the options.
+            - Randomize the order of the answer options so the correct answer does not always appear first.
+            - All questions should be meaningful, relevant, and fact-based.
+
+        Restrictions:
+        - Do NOT include any identifiers or metadata (e.g., "Kinobox ID", "template", or "category").
+
+        Return a JSON object with this structure:
+        {{
+        "questions": [
+            {{
+            "question": "What is the capital of France?",
+            "options": ["Paris", "London", "Berlin", "Madrid"],
+            "correct_answer": "Paris"
+            }},
+            ...
+        ]
+        }}
+
+        Output JSON only.
+        """
+
+    def summarizeFacts(self, prompt, main_entity, facts):
+        """
+        Reduce step of the map-reduce refinement: write the summary paragraph from the merged facts.
+        Args:
+            prompt (str): The original prompt.
+            main_entity (str): The main theme of the prompt.
+            facts (list): The merged facts.
+        Returns:
+            str: The summary (the first facts joined if the LLM call fails).
+        """
+        system_msg = (
+            "You are an educational assistant. Write a concise and enriched paragraph summarizing the key insights "
+            f"about {main_entity} from the given facts, focused on the original question. "
+            "Integrate the ideas naturally instead of listing the facts, add brief context where helpful "
+            "and make it read like a human educator's summary. Output the paragraph only."
+        )
+        facts_text = "\n".join(f"- {fact}" for fact in facts)
+        summary = self.llmQuery(system_msg, f"Original question: {prompt}\nFacts:\n{facts_text}", stage="summary")
+        return summary or " ".join(facts[:3])
+
+    def refinePrompt(self, prompt, triples):
+        """
+        Build the system message and user prompt used to refine the triples.
+        Args:
+            prompt (str): The original prompt.
+            triples (list): A list of extracted triples.
+        Returns:
+            tuple: The system message and the full user prompt.
+        """
         system_msg = """
         You are an educational assistant. Based on the given triples and the original user question:
 
@@ -224,7 +1801,7 @@ class KnowledgeEngine:
         2. Extract key factual information that directly relates to the original question and the main entity.
         3. Generate 5–10 thought-provoking multiple-choice questions based on the content:
             - Each question must have 4 distinct answer options.
-            - One correct answer must be clearly indicated.
+            - One correct answer must be clearly indicated and must be one of the options.
             - Randomize the order of the answer options so the correct answer does not always appear first.
             - All questions should be meaningful, relevant, and fact-based.
         4. Write a concise and enriched paragraph summarizing the key insights:
@@ -247,7 +1824,7 @@ class KnowledgeEngine:
             {
             "question": "What is the capital of France?",
             "options": ["Paris", "London", "Berlin", "Madrid"],
-            "correct_answer": "London"
+            "correct_answer": "Paris"
             },
             ...
         ],
@@ -264,22 +1841,123 @@ class KnowledgeEngine:
             for t in triples
         )
         full_prompt = f"Original question: {prompt}{triplet_text}"
+        return system_msg, full_prompt
 
-        content = self.llmQuery(system_msg, full_prompt, json_mode=True)
+    def parseOutput(self, output, content, expected=dict):
+        """
+        Parse a JSON completion, repairing it if needed (see repairJSON), and count the outcome.
+        Args:
+            output (str): The kind of output (themes, refine, map, part, regenerate), for the validation metrics.
+            content (str): The completion.
+            expected (type): dict or list, the type of the top-level value.
+        Returns:
+            The parsed value, or None if the completion can't be repaired.
+        """
         try:
-            # Clean up markdown if present
-            if content.startswith("```"):
-                content = content.split("```")[1].strip()
-                if content.startswith("json"):
-                    content = content[4:].strip()
-
-            print(f"[Refined Triples Result]: {content}")
-            return json.loads(content)
-             
-        except Exception as e:
+            value, repaired = repairJSON(content, expected)
+        except OutputError as e:
+            self.validation.count(output, "failed")
+            self.tracer.annotate(output_failed=1)
+            print(f"[Output Validation - {output}]: {e}")
+            return None
+        self.validation.count(output, "repaired" if repaired else "parsed")
+        if repaired:
+            self.tracer.annotate(output_repaired=1)
+        return value
+
+    def parseRefined(self, content, prompt=None, triples=None, output="refine"):
+        """
+        Parse and validate the refinement completion into the response dictionary. Invalid facts and
+        questions (e.g. a correct answer that isn't one of the options) are dropped and, given the prompt
+        and triples, replaced by a small follow-up call; a missing summary is written from the facts.
+        Args:
+            content (str): The raw LLM completion.
+            prompt (str): The original prompt (None drops the invalid items without regenerating them).
+            triples (list): The triples of the completion.
+            output (str): The kind of output, for the validation metrics.
+        Returns:
+            dict: A dictionary containing the refined response with facts, questions, and an answer.
+        """
+        value = self.parseOutput(output, content, dict)
+        if value is None:
             # Fallback to simple text if JSON parsing fails
             return {
                 "facts": [],
                 "questions": [],
                 "summary": content or "No information could be generated."
-            }
\ No newline at end of file
+            }
+        print(f"[Refined Triples Result]: {value}")
+
+        response, invalid = validateRefined(value)
+        for key, items in invalid.items():
+            if items:
+                self.validation.count(output, "invalid_items", len(items))
+                print(f"[Output Validation - {output}]: {len(items)} invalid {key}: {'; '.join(error for _, error in items)}")
+                if prompt is not None and self.regenerate_invalid:
+                    response[key] += self.regenerateItems(prompt, triples or [], key, items, response[key], output)
+
+        if output == "refine" and response["summary"] is None and prompt is not None:
+            response["summary"] = self.summarizeFacts(prompt, triples[0]["entity"] if triples else prompt, response["facts"])
+        elif response["summary"] is None:
+            del response["summary"]
+        return response
+
+    @traced("regenerateItems")
+    def regenerateItems(self, prompt, triples, key, invalid, valid, output="refine"):
+        """
+        Replace the invalid facts or questions of a completion with a small follow-up call that only asks
+        for as many new items, showing the model what was wrong with the old ones.
+        Args:
+            prompt (str): The original prompt.
+            triples (list): The triples of the completion.
+            key (str): facts or questions.
+            invalid (list): The invalid items, as (item, error) tuples.
+            valid (list): The valid items (the new ones must differ from them).
+            output (str): The kind of output that had invalid items, for the validation metrics.
+        Returns:
+            list: The valid new items (possibly fewer than the invalid ones).
+        """
+        deadline = currentDeadline()
+        if deadline is not None and deadline.expired():
+            return []
+        self.validation.count(output, "regenerations")
+        self.tracer.annotate(items=len(invalid))
+
+        if key == "facts":
+            shape = '{"facts": [ "Fact 1", ... ]}'
+        else:
+            shape = (
+                '{"questions": [{"question": "What is the capital of France?", '
+                '"options": ["Paris", "London", "Berlin", "Madrid"], "correct_answer": "Paris"}, ...]}'
+            )
+        system_msg = (
+            f"You are an educational assistant. Some {key} generated from the given triples were invalid. "
+            f"Write exactly {len(invalid)} new {key} based on the triples and the original user question, different "
+            f"from the existing ones. {'Each question must have 4 distinct answer options, and the correct answer must be exactly one of the options. ' if key == 'questions' else ''}"
+            f"Return a JSON object with this structure: {shape}. Output JSON only."
+        )
+        rejected = "\n".join(f"- {json.dumps(item, ensure_ascii=False)} ({error})" for item, error in invalid)
+        existing = "\n".join(f"- {item if key == 'facts' else item['question']}" for item in valid)
+        triplet_text = "\n".join(tripleLine(t) for t in triples)
+        user_msg = f"Original question: {prompt}\nTriples:\n{triplet_text}\nInvalid {key}:\n{rejected}\nExisting {key}:\n{existing}"
+
+        try:
+            content = self.llmQuery(system_msg, user_msg, json_mode=True, stage="regenerate")
+        except Exception as e:
+            # Out of time or the request failed: keep the valid items only
+            self.tracer.error(e)
+            print(f"[Output Validation - Regeneration Error]: {e}")
+            return []
+        value = self.parseOutput("regenerate", content, dict) if content else None
+        if value is None:
+            return []
+
+        items, _ = validateRefined(value)
+        seen = [" ".join((item if key == "facts" else item["question"]).lower().split()) for item in valid]
+        new_items = []
+        for item in items[key]:
+            if len(new_items) < len(invalid) and not isDuplicate(item if key == "facts" else item["question"], seen, 0.85):
+                new_items.append(item)
+        self.validation.count(output, "regenerated_items", len(new_items))
+        print(f"[Output Validation - Regenerated]: {len(new_items)} of {len(invalid)} {key}")
+        return new_items
@@ -0,0 +1,302 @@
+"""
+Local entity-label index for offline QID resolution.
+
+Builds a compact, memory-mapped table of normalized English labels and aliases, sorted so lookups
+are binary searches: exact matches, prefix matches and Levenshtein-bounded fuzzy matches each
+return the best QID with a confidence score.
+
+Usage:
+    python src/LabelIndex.py build latest-all.json.bz2 -o data/labels.idx
+    python src/LabelIndex.py build labels.tsv -o data/labels.idx
+    python src/LabelIndex.py lookup "Douglas Adams" --index data/labels.idx
+"""
+import argparse
+import heapq
+import json
+import mmap
+import os
+import re
+import struct
+import tempfile
+import unicodedata
+from array import array
+
+import Levenshtein
+
+from LocalStore import ENTITY_IRI, LABEL_IRIS, NT_LINE, NT_LITERAL, openDump
+
+MAGIC = b"KGLABEL1"
+HEADER = struct.Struct("<8sQ")
+ALIAS_IRI = "http://www.w3.org/2004/02/skos/core#altLabel"
+
+# Confidence of each kind of match before the ambiguity penalty
+EXACT_LABEL, EXACT_ALIAS, PREFIX, FUZZY = 1.0, 0.9, 0.7, 0.8
+
+
+def normalizeLabel(text):
+    """
+    Normalize a label for indexing: lowercase, no accents, punctuation or repeated spaces.
+    Args:
+        text (str): The label.
+    Returns:
+        str: The normalized label.
+    """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+
+class LabelIndex:
+    """
+    Read-only, memory-mapped sorted label table. Each record is a line
+    "normalized label \\t QID \\t weight \\t alias flag \\t label", and the header holds the record offsets.
+    """
+
+    def __init__(self, path, max_distance=2, fuzzy_scan=5000):
+        """
+        Args:
+            path (str): Path to an index built with LabelIndex.build.
+            max_distance (int): Maximum Levenshtein distance of a fuzzy match.
+            fuzzy_scan (int): Maximum records compared for a fuzzy lookup.
+        """
+        self.max_distance = max_distance
+        self.fuzzy_scan = fuzzy_scan
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a label index")
+        self._offsets = memoryview(self._map)[HEADER.size:HEADER.size + 8 * self.count].cast("Q")
+
+    def close(self):
+        self._offsets.release()
+        self._map.close()
+        self._file.close()
+
+    def __len__(self):
+        return self.count
+
+    # ---------- Records ----------
+
+    def _key(self, i):
+        start = self._offsets[i]
+        return self._map[start:self._map.find(b"\t", start)].decode("utf-8")
+
+    def _record(self, i):
+        start = self._offsets[i]
+        key, qid, weight, alias, label = self._map[start:self._map.find(b"\n", start)].decode("utf-8").split("\t")
+        return {"key": key, "qid": qid, "weight": float(weight), "alias": alias == "1", "label": label}
+
+    def _lowerBound(self, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # ---------- Lookup ----------
+
+    def lookup(self, term):
+        """
+        Resolve a term to its most likely QID: exact matches first, then prefix, then fuzzy matches.
+        Args:
+            term (str): The term to look up.
+        Returns:
+            dict: The best match ({"qid", "label", "confidence", "match"}), or None.
+        """
+        key = normalizeLabel(term)
+        if not key or not self.count:
+            return None
+        return self.exact(key) or self.prefix(key) or self.fuzzy(key)
+
+    def exact(self, key):
+        i = self._lowerBound(key)
+        records = []
+        while i < self.count and self._key(i) == key:
+            records.append(self._record(i))
+            i += 1
+        return self._best(records, "exact", lambda record: EXACT_ALIAS if record["alias"] else EXACT_LABEL)
+
+    def prefix(self, key, limit=50):
+        i = self._lowerBound(key)
+        records = []
+        while i < self.count and len(records) < limit:
+            record = self._record(i)
+            if not record["key"].startswith(key):
+                break
+            records.append(record)
+            i += 1
+        # The more of the label the term covers, the more confident the match
+        return self._best(records, "prefix", lambda record: PREFIX * len(key) / len(record["key"]))
+
+    def fuzzy(self, key):
+        # Candidates share the first character of the term (typos rarely hit it), within a bounded scan
+        start = self._lowerBound(key[0])
+        end = min(self._lowerBound(chr(ord(key[0]) + 1)), start + self.fuzzy_scan)
+        records = []
+        for i in range(start, end):
+            candidate = self._key(i)
+            if abs(len(candidate) - len(key)) > self.max_distance:
+                continue
+            if Levenshtein.distance(key, candidate, score_cutoff=self.max_distance) <= self.max_distance:
+                records.append(self._record(i))
+        return self._best(records, "fuzzy", lambda record: FUZZY * Levenshtein.ratio(key, record["key"]))
+
+    def _best(self, records, match, base):
+        """
+        Pick the best candidate and scale its confidence by its share of the candidates' weight,
+        so ambiguous labels (e.g. "Mercury") need the remote API unless one sense dominates.
+        """
+        if not records:
+            return None
+        scores = {}
+        for record in records:
+            score = base(record) * record["weight"]
+            if score > scores.get(record["qid"], (0, None))[0]:
+                scores[record["qid"]] = (score, record)
+        total = sum(score for score, _ in scores.values())
+        score, record = max(scores.values(), key=lambda item: item[0])
+        confidence = base(record) * score / total
+        return {"qid": record["qid"], "label": record["label"], "confidence": round(confidence, 3), "match": match}
+
+    # ---------- Build ----------
+
+    @staticmethod
+    def build(sources, path, chunk_size=500000):
+        """
+        Build an index from labels/aliases dumps, sorting in chunks on disk so memory stays bounded.
+        Args:
+            sources (list): Dump paths: Wikidata JSON (one entity per line), N-Triples (rdfs:label and
+                            skos:altLabel), or TSV lines "QID \\t label \\t alias|alias... \\t sitelinks" (optionally .gz/.bz2).
+            path (str): Path of the index file.
+            chunk_size (int): Records sorted in memory per run.
+        Returns:
+            int: The number of records.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with tempfile.TemporaryDirectory() as tmp:
+            runs, chunk = [], []
+            for source in sources:
+                for record in readLabels(source):
+                    chunk.append(record)
+                    if len(chunk) >= chunk_size:
+                        runs.append(writeRun(sorted(chunk), tmp, len(runs)))
+                        chunk = []
+            if chunk:
+                runs.append(writeRun(sorted(chunk), tmp, len(runs)))
+
+            # Merge the sorted runs into the data section, then prepend the header and offsets
+            offsets = array("Q")
+            data_path = os.path.join(tmp, "data")
+            files = [open(run, encoding="utf-8") for run in runs]
+            with open(data_path, "wb") as data:
+                previous = None
+                for line in heapq.merge(*files):
+                    if line == previous:
+                        continue
+                    previous = line
+                    offsets.append(data.tell())
+                    data.write(line.encode("utf-8"))
+            for f in files:
+                f.close()
+
+            base = HEADER.size + 8 * len(offsets)
+            for i in range(len(offsets)):
+                offsets[i] += base
+            with open(path, "wb") as out, open(data_path, "rb") as data:
+                out.write(HEADER.pack(MAGIC, len(offsets)))
+                offsets.tofile(out)
+                while True:
+                    block = data.read(1 << 20)
+                    if not block:
+                        break
+                    out.write(block)
+        return len(offsets)
+
+
+def recordLine(label, qid, weight, alias):
+    key = normalizeLabel(label)
+    if not key:
+        return None
+    label = " ".join(label.split())
+    return f"{key}\t{qid}\t{weight:.3f}\t{int(alias)}\t{label}\n"
+
+
+def readLabels(path):
+    """
+    Read the label records of a dump. Entities are weighted by their number of sitelinks when known
+    (a popular entity wins an ambiguous label).
+    Args:
+        path (str): The dump path.
+    Yields:
+        str: Record lines.
+    """
+    name = re.sub(r"\.(gz|bz2)$", "", path)
+    with openDump(path) as f:
+        for line in f:
+            if name.endswith(".nt"):
+                match = NT_LINE.match(line)
+                literal = NT_LITERAL.match(match.group(3)) if match else None
+                if not literal or literal.group(2) != "en" or not match.group(1).startswith(ENTITY_IRI):
+                    continue
+                if match.group(2) in LABEL_IRIS or match.group(2) == ALIAS_IRI:
+                    qid = match.group(1)[len(ENTITY_IRI):]
+                    record = recordLine(json.loads(f'"{literal.group(1)}"'), qid, 1.0, match.group(2) == ALIAS_IRI)
+                    if record:
+                        yield record
+            elif name.endswith(".tsv"):
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 2 or not re.match(r"^Q\d+$", fields[0]):
+                    continue
+                weight = 1.0 + float(fields[3]) if len(fields) > 3 and fields[3] else 1.0
+                for i, label in enumerate([fields[1]] + (fields[2].split("|") if len(fields) > 2 else [])):
+                    record = recordLine(label, fields[0], weight, i > 0)
+                    if record:
+                        yield record
+            else:
+                line = line.strip().rstrip(",")
+                if not line or line in ("[", "]"):
+                    continue
+                entity = json.loads(line)
+                if entity.get("type", "item") != "item":
+                    continue
+                weight = 1.0 + len(entity.get("sitelinks", {}))
+                label = entity.get("labels", {}).get("en", {}).get("value")
+                aliases = [alias["value"] for alias in entity.get("aliases", {}).get("en", [])]
+                for i, text in enumerate(([label] if label else []) + aliases):
+                    record = recordLine(text, entity["id"], weight, i > 0 or not label)
+                    if record:
+                        yield record
+
+
+def writeRun(lines, directory, number):
+    path = os.path.join(directory, f"run{number}")
+    with open(path, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the local entity-label index.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="Build the index from labels/aliases dumps.")
+    build.add_argument("dump", nargs="+", help="Wikidata JSON, N-Triples or TSV dumps (optionally .gz/.bz2).")
+    build.add_argument("-o", "--output", default=os.path.join(os.path.dirname(__file__), "../data", "labels.idx"))
+    lookup = subparsers.add_parser("lookup", help="Resolve terms with the index.")
+    lookup.add_argument("term", nargs="+")
+    lookup.add_argument("--index", default=os.path.join(os.path.dirname(__file__), "../data", "labels.idx"))
+    args = parser.parse_args()
+
+    if args.command == "build":
+        print(f"[LabelIndex - Build Done]: {LabelIndex.build(args.dump, args.output)} records")
+    else:
+        index = LabelIndex(args.index)
+        for term in args.term:
+            print(f"[LabelIndex - Lookup]: {term} -> {index.lookup(term)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+"""
+Label resolution for the SPARQL triples.
+
+The triples query returns raw property and item IDs instead of running the wikibase:label service.
+Property labels (a small, nearly static set) come from a local table built once from the SPARQL
+endpoint or a local store (the engine builds it in the background on its first run if it is missing); item labels come from an in-process LRU backed by the shared cache, and
+the remaining ones are fetched with batched wbgetentities calls (50 IDs per call).
+
+Usage:
+    python src/LabelResolver.py build -o data/property_labels.tsv
+    python src/LabelResolver.py build --store data/wikidata.sqlite -o data/property_labels.tsv
+    python src/LabelResolver.py lookup P31 Q42 --table data/property_labels.tsv
+"""
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from Cache import MISSING
+
+# Maximum number of IDs per wbgetentities call (API limit for anonymous clients)
+WBGETENTITIES_BATCH = 50
+
+# Seconds after which the lock of a property table build is considered abandoned (its process died)
+BUILD_LOCK_TIMEOUT = 600
+
+PROPERTY_LABELS_QUERY = """
+SELECT ?property ?label WHERE {
+    ?property a wikibase:Property ;
+              rdfs:label ?label .
+    FILTER(LANG(?label) = "en")
+}
+"""
+
+
+def loadPropertyLabels(path):
+    """
+    Load a property-label table (PID<TAB>label per line).
+    Args:
+        path (str): Path to the table.
+    Returns:
+        dict: A dictionary mapping property IDs to their English labels (empty if the file doesn't exist).
+    """
+    labels = {}
+    if not path or not os.path.exists(path):
+        return labels
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            pid, _, label = line.rstrip("\n").partition("\t")
+            if pid and label:
+                labels[pid] = label
+    return labels
+
+
+def writePropertyLabels(labels, path):
+    # Written to a temporary file of this process first so a running app never reads a partial table
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        for pid in sorted(labels, key=lambda pid: int(pid[1:]) if pid[1:].isdigit() else 0):
+            f.write(f"{pid}\t{labels[pid]}\n")
+    os.replace(temp_path, path)
+
+
+def acquireBuildLock(path):
+    """
+    Take the lock file of a property table build, so concurrent processes (batch workers, app servers)
+    don't all fetch the table. A lock older than BUILD_LOCK_TIMEOUT is taken over.
+    Args:
+        path (str): Path of the table.
+    Returns:
+        bool: Whether this process holds the lock (and must remove it with releaseBuildLock).
+    """
+    lock_path = f"{path}.lock"
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    for _ in range(2):
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) < BUILD_LOCK_TIMEOUT:
+                    return False
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+    return False
+
+
+def releaseBuildLock(path):
+    try:
+        os.remove(f"{path}.lock")
+    except FileNotFoundError:
+        pass
+
+
+class LabelResolver:
+    """
+    Resolves Wikidata IDs to English labels: properties from the local table, items from an LRU in front
+    of the shared cache, and everything else with batched wbgetentities calls. IDs without an English
+    label resolve to themselves (like the label service), so pruneTriples drops them.
+    """
+
+    def __init__(self, transport, api_url, cache=None, property_path=None, memory_size=20000, timeout=5, tracer=None, build_endpoint=None):
+        """
+        Args:
+            transport (HttpTransport): The shared HTTP transport.
+            api_url (str): The Wikidata API URL (wbgetentities).
+            cache (Cache): The shared cache (labels are kept under the "label" kind), or None.
+            property_path (str): Path to the property-label table (PID<TAB>label), or None.
+            memory_size (int): Maximum number of item labels in the in-process LRU.
+            timeout (float): Timeout (seconds) of each wbgetentities call.
+            tracer (Tracer): Tracer annotated with the label hits and fetches.
+            build_endpoint (str): SPARQL endpoint the property table is built from, in the background, when
+                property_path doesn't exist yet (None never builds it).
+        """
+        self.transport = transport
+        self.api_url = api_url
+        self.cache = cache
+        self.memory_size = memory_size
+        self.timeout = timeout
+        self.tracer = tracer
+        self.properties = loadPropertyLabels(property_path)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"property_hits": 0, "memory_hits": 0, "cache_hits": 0, "fetched": 0, "unlabeled": 0, "requests": 0}
+        if property_path and build_endpoint and not os.path.exists(property_path):
+            threading.Thread(target=self.buildTable, args=(property_path, build_endpoint), name="property-labels", daemon=True).start()
+
+    def buildTable(self, path, endpoint, poll=5):
+        """
+        Build the property table from a SPARQL endpoint and start using it. Only the process holding the
+        build lock fetches the table; the others wait for it to appear. Until it is ready, properties are
+        resolved with wbgetentities like items; if the build fails, it is tried again on the next start.
+        Args:
+            path (str): Path of the table to write.
+            endpoint (str): The SPARQL endpoint URL.
+            poll (float): Seconds between checks for a table built by another process.
+        """
+        if not acquireBuildLock(path):
+            deadline = time.monotonic() + BUILD_LOCK_TIMEOUT
+            while not os.path.exists(path) and os.path.exists(f"{path}.lock") and time.monotonic() < deadline:
+                time.sleep(poll)
+            labels = loadPropertyLabels(path)
+            if not labels:
+                print("[LabelResolver - Build Skipped]: another process is building the property table")
+                return
+        else:
+            try:
+                labels = fetchPropertyLabels(endpoint, transport=self.transport)
+                writePropertyLabels(labels, path)
+            except Exception as e:
+                print(f"[LabelResolver - Build Failed]: {e}")
+                return
+            finally:
+                releaseBuildLock(path)
+        with self._lock:
+            self.properties.update(labels)
+        print(f"[LabelResolver - Build Done]: {len(labels)} property labels in {path}")
+
+    def labels(self, ids):
+        """
+        Resolve IDs to their English labels.
+        Args:
+            ids (iterable): Property and item IDs.
+        Returns:
+            dict: A dictionary mapping every ID to its label (the ID itself when it has none or the fetch failed).
+        """
+        result, missing = {}, []
+        for id in dict.fromkeys(ids):
+            label = self.lookup(id)
+            if label is None:
+                missing.append(id)
+            else:
+                result[id] = label
+
+        batches = [missing[i:i + WBGETENTITIES_BATCH] for i in range(0, len(missing), WBGETENTITIES_BATCH)]
+        if len(batches) > 1:
+            bind = self.tracer.bind if self.tracer else (lambda fn: fn)
+            with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+                fetched = list(executor.map(bind(self.fetchLabels), batches))
+        else:
+            fetched = [self.fetchLabels(batch) for batch in batches]
+        for labels in fetched:
+            result.update(labels)
+        return result
+
+    def lookup(self, id):
+        """
+        Get a label from the local table, the LRU or the cache.
+        Returns:
+            str: The label, or None if it has to be fetched.
+        """
+        if id in self.properties:
+            self._count("property_hits")
+            return self.properties[id]
+        with self._lock:
+            if id in self._items:
+                self._items.move_to_end(id)
+                self._stats["memory_hits"] += 1
+                return self._items[id]
+        if self.cache is not None:
+            label = self.cache.get("label", self.cache.key("label", id))
+            if label is not MISSING:
+                self._count("cache_hits")
+                self._remember(id, label)
+                return label
+        return None
+
+    def fetchLabels(self, ids):
+        """
+        Fetch the English labels of up to WBGETENTITIES_BATCH IDs with one wbgetentities call.
+        Args:
+            ids (list): Property and item IDs.
+        Returns:
+            dict: A dictionary mapping the IDs to their labels (the IDs themselves if the call fails).
+        """
+        self._count("requests")
+        try:
+            response = self.transport.get(
+                self.api_url,
+                endpoint="wikidata",
+                params={"action": "wbgetentities", "ids": "|".join(ids), "props": "labels", "languages": "en", "format": "json"},
+                timeout=self.timeout
+            )
+            response.raise_for_status()
+            entities = response.json().get("entities", {})
+        except Exception as e:
+            if self.tracer:
+                self.tracer.error(e)
+            print(f"[LabelResolver - Error]: {e}")
+            return {id: id for id in ids}
+
+        labels = {}
+        for id in ids:
+            label = entities.get(id, {}).get("labels", {}).get("en", {}).get("value")
+            if label is None:
+                # Unlabeled (or missing) entities aren't cached, they may get a label later
+                self._count("unlabeled")
+                labels[id] = id
+                continue
+            labels[id] = label
+            self._count("fetched")
+            if id.startswith("P"):
+                with self._lock:
+                    self.properties[id] = label
+            else:
+                self._remember(id, label)
+            if self.cache is not None:
+                self.cache.set("label", self.cache.key("label", id), label)
+        if self.tracer:
+            self.tracer.annotate(labels_fetched=len(ids))
+        return labels
+
+    def _remember(self, id, label):
+        with self._lock:
+            self._items[id] = label
+            self._items.move_to_end(id)
+            while len(self._items) > self.memory_size:
+                self._items.popitem(last=False)
+
+    def _count(self, event):
+        with self._lock:
+            self._stats[event] += 1
+
+    def stats(self):
+        """
+        Get the label counters.
+        Returns:
+            dict: property_hits, memory_hits, cache_hits, fetched and unlabeled labels, wbgetentities requests,
+                and the number of known properties and items in memory.
+        """
+        with self._lock:
+            return {**self._stats, "properties": len(self.properties), "items": len(self._items)}
+
+
+def fetchPropertyLabels(endpoint, timeout=60, transport=None):
+    """
+    Fetch the English labels of every property from a SPARQL endpoint.
+    Args:
+        endpoint (str): The SPARQL endpoint URL.
+        timeout (float): Timeout of the query in seconds.
+        transport (HttpTransport): The transport sending the query (a new one by default).
+    Returns:
+        dict: A dictionary mapping property IDs to their labels.
+    """
+    if transport is None:
+        from HttpTransport import HttpTransport
+
+        transport = HttpTransport()
+    response = transport.get(
+        endpoint,
+        endpoint="sparql",
+        params={"query": PROPERTY_LABELS_QUERY, "format": "json"},
+        headers={"Accept": "application/sparql-results+json"},
+        timeout=timeout
+    )
+    response.raise_for_status()
+    return {
+        r["property"]["value"].rsplit("/", 1)[-1]: r["label"]["value"]
+        for r in response.json()["results"]["bindings"]
+    }
+
+
+def storePropertyLabels(path):
+    # Property labels of a store imported with src/LocalStore.py
+    connection = sqlite3.connect(path)
+    try:
+        return dict(connection.execute("SELECT pid, label FROM properties WHERE label IS NOT NULL").fetchall())
+    finally:
+        connection.close()
+
+
+def main():
+    default_table = os.path.join(os.path.dirname(__file__), "../data", "property_labels.tsv")
+    parser = argparse.ArgumentParser(description="Build or query the local property-label table.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="Build the table from the SPARQL endpoint or a local store.")
+    build.add_argument("--endpoint", default="https://query.wikidata.org/sparql")
+    build.add_argument("--store", help="Local store (src/LocalStore.py) to read the labels from instead of the endpoint.")
+    build.add_argument("-o", "--output", default=default_table)
+    lookup = subparsers.add_parser("lookup", help="Resolve IDs with the table and the Wikidata API.")
+    lookup.add_argument("id", nargs="+")
+    lookup.add_argument("--table", default=default_table)
+    lookup.add_argument("--api", default="https://www.wikidata.org/w/api.php")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        labels = storePropertyLabels(args.store) if args.store else fetchPropertyLabels(args.endpoint)
+        writePropertyLabels(labels, args.output)
+        print(f"[LabelResolver - Build Done]: {len(labels)} property labels")
+    else:
+        from HttpTransport import HttpTransport
+
+        resolver = LabelResolver(HttpTransport(), args.api, property_path=args.table)
+        print(json.dumps(resolver.labels(args.id), indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
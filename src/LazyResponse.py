@@ -0,0 +1,86 @@
+import threading
+
+
+class LazyResponse:
+    """
+    Response of KnowledgeEngine.getLazyResponse: the summary, facts and questions are separate tasks,
+    each generated the first time it is read (or prefetched in the background) and then kept.
+    Reads behave like the response dictionary of getCombinedResponse (get, [], in).
+    """
+
+    PARTS = ("summary", "facts", "questions")
+
+    def __init__(self, engine, prompt, triples, extra=None, themes=None, themes_id=None):
+        """
+        Args:
+            engine (KnowledgeEngine): The engine generating the parts.
+            prompt (str): The original prompt.
+            triples (list): The triples the parts are generated from.
+            extra (dict): Other response keys (e.g. degraded).
+            themes (list): The extracted themes, saved with the deck.
+            themes_id (dict): The resolved themes mapped to their Wikidata IDs, saved with the deck.
+        """
+        self.engine = engine
+        self.prompt = prompt
+        self.triples = triples
+        self.themes = themes
+        self.themes_id = themes_id
+        self.values = dict(extra or {})
+        self.locks = {part: threading.Lock() for part in self.PARTS}
+        self.save_lock = threading.Lock()
+
+    def part(self, name):
+        """
+        Get a part, generating it on first access. Concurrent readers (e.g. a prefetch and the UI)
+        wait for the same generation.
+        Args:
+            name (str): summary, facts or questions.
+        Returns:
+            The part (a string for the summary, a list for facts and questions).
+        """
+        with self.locks[name]:
+            if name not in self.values:
+                self.values[name] = self.engine.generatePart(name, self.prompt, self.triples)
+                # Save (or update) the deck after every part, so a tab that is never opened doesn't keep it
+                # out of the library (storeDeck skips it until it has facts or questions)
+                with self.save_lock:
+                    self.engine.storeDeck(self.prompt, dict(self.values), self.triples, self.themes, self.themes_id)
+            return self.values[name]
+
+    def isReady(self, name):
+        return name not in self.locks or name in self.values
+
+    def prefetch(self, executor, parts=("facts", "questions"), priority=2):
+        """
+        Generate parts in the background.
+        Args:
+            executor (PriorityExecutor): The executor running the generations.
+            parts (tuple): The parts to prefetch, in order.
+            priority (int): Priority of the tasks (after interactive work by default).
+        Returns:
+            list: The futures of the parts.
+        """
+        return [executor.submit(priority, self.engine.tracer.bind(self.part), name) for name in parts if not self.isReady(name)]
+
+    def get(self, key, default=None):
+        if key in self.locks:
+            return self.part(key)
+        return self.values.get(key, default)
+
+    def __getitem__(self, key):
+        if key in self.locks:
+            return self.part(key)
+        return self.values[key]
+
+    def __contains__(self, key):
+        return key in self.locks or key in self.values
+
+    def toDict(self):
+        """
+        Generate every missing part and return the plain response dictionary.
+        Returns:
+            dict: The response, like getCombinedResponse's.
+        """
+        for name in self.PARTS:
+            self.part(name)
+        return dict(self.values)
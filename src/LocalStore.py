@@ -0,0 +1,377 @@
+"""
+Local Wikidata subset store.
+
+Imports a slice of a Wikidata JSON dump (one entity per line, optionally .gz/.bz2 compressed) or of
+an N-Triples dump into an indexed SQLite database, so getTriples can answer from disk in milliseconds
+and only query the remote SPARQL endpoint for entities that aren't in the store.
+
+Usage:
+    python src/LocalStore.py import latest-all.json.bz2 --db data/wikidata.sqlite
+    python src/LocalStore.py import slice.nt.gz --db data/wikidata.sqlite
+    python src/LocalStore.py stats --db data/wikidata.sqlite
+"""
+import argparse
+import bz2
+import gzip
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# Property datatypes that are metadata rather than knowledge (skipped at import, as in the SPARQL query)
+SKIPPED_DATATYPES = {"external-id", "commonsMedia", "url", "geo-shape", "tabular-data", "math", "musical-notation"}
+
+ENTITY_IRI = "http://www.wikidata.org/entity/"
+DIRECT_CLAIM_IRI = "http://www.wikidata.org/prop/direct/"
+LABEL_IRIS = {"http://www.w3.org/2000/01/rdf-schema#label", "http://schema.org/name"}
+DESCRIPTION_IRI = "http://schema.org/description"
+PROPERTY_TYPE_IRI = "http://wikiba.se/ontology#propertyType"
+
+NT_LINE = re.compile(r'^<([^>]*)>\s+<([^>]*)>\s+(.*?)\s*\.\s*$')
+NT_LITERAL = re.compile(r'^"((?:[^"\\]|\\.)*)"(?:@([\w-]+)|\^\^<[^>]*>)?$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities (
+    qid TEXT PRIMARY KEY,
+    label TEXT,
+    description TEXT,
+    revision INTEGER,
+    import_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS properties (
+    pid TEXT PRIMARY KEY,
+    label TEXT,
+    datatype TEXT
+);
+CREATE TABLE IF NOT EXISTS claims (
+    subject TEXT NOT NULL,
+    property TEXT NOT NULL,
+    value TEXT NOT NULL,
+    is_entity INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS claims_subject ON claims(subject, property);
+CREATE INDEX IF NOT EXISTS claims_property ON claims(property);
+CREATE INDEX IF NOT EXISTS entities_label ON entities(label);
+"""
+
+
+def openDump(path):
+    """
+    Open a dump file as text, decompressing .gz and .bz2 on the fly.
+    Args:
+        path (str): The dump path.
+    Returns:
+        file: A text file object.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rt", encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def snakValue(snak):
+    """
+    Convert the value of a Wikidata JSON main snak to a string.
+    Args:
+        snak (dict): The main snak.
+    Returns:
+        tuple: The value and whether it is an entity ID, or None for unsupported values.
+    """
+    if snak.get("snaktype") != "value" or snak.get("datatype") in SKIPPED_DATATYPES:
+        return None
+    datavalue = snak.get("datavalue", {})
+    kind, value = datavalue.get("type"), datavalue.get("value")
+    if kind == "wikibase-entityid":
+        return value.get("id") or f"Q{value['numeric-id']}", True
+    if kind == "string":
+        return value, False
+    if kind == "monolingualtext":
+        return (value["text"], False) if value.get("language") == "en" else None
+    if kind == "time":
+        # +1952-03-11T00:00:00Z -> 1952-03-11 (or only the year for year precision)
+        date = value["time"].lstrip("+").split("T")[0]
+        return (date.split("-")[0] if value.get("precision", 11) <= 9 else date), False
+    if kind == "quantity":
+        amount = value["amount"].lstrip("+")
+        unit = value.get("unit", "1")
+        return (amount if unit == "1" else f"{amount} {unit.rsplit('/', 1)[-1]}"), False
+    if kind == "globecoordinate":
+        return f"{value['latitude']}, {value['longitude']}", False
+    return None
+
+
+class LocalStore:
+    """
+    SQLite store of Wikidata entities, property labels and claims, indexed by subject and property.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Path to the SQLite database (created if needed).
+        """
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        # SQLite connections can't be shared between threads, so keep one per thread
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    # ---------- Queries ----------
+
+    def triples(self, qid, limit=10):
+        """
+        Get the triples of an entity, shaped like the SPARQL results of getTriples: one sampled value per
+        property (the first by label), with property and value labels resolved from the store.
+        Args:
+            qid (str): The Wikidata ID.
+            limit (int): Maximum number of properties returned.
+        Returns:
+            list: A list of (relation, object, property ID, value ID) tuples (the value ID is None for literals),
+                or None if the store has no usable claims of the entity: it wasn't imported, was only imported
+                as the value of other entities' claims, or its properties have no labels in the store.
+        """
+        # The label and the ID of the sampled value come from the same row (ranked per property)
+        rows = self._connection().execute(
+            """
+            SELECT relation, object, property, value_id FROM (
+                SELECT p.label AS relation, CASE WHEN c.is_entity THEN e.label ELSE c.value END AS object,
+                       c.property AS property, CASE WHEN c.is_entity THEN c.value END AS value_id,
+                       ROW_NUMBER() OVER (
+                           PARTITION BY c.property ORDER BY CASE WHEN c.is_entity THEN e.label ELSE c.value END, c.rowid
+                       ) AS sample,
+                       MIN(c.rowid) OVER (PARTITION BY c.property) AS first
+                FROM claims c
+                JOIN properties p ON p.pid = c.property
+                LEFT JOIN entities e ON c.is_entity AND e.qid = c.value
+                WHERE c.subject = ? AND p.label IS NOT NULL AND (NOT c.is_entity OR e.label IS NOT NULL)
+            )
+            WHERE sample = 1
+            ORDER BY first
+            LIMIT ?
+            """,
+            (qid, limit)
+        ).fetchall()
+        return [tuple(row) for row in rows] or None
+
+    def label(self, qid):
+        row = self._connection().execute("SELECT label FROM entities WHERE qid = ?", (qid,)).fetchone()
+        return row[0] if row else None
+
+    def stats(self):
+        """
+        Get the number of stored entities, properties and claims.
+        Returns:
+            dict: The counts.
+        """
+        connection = self._connection()
+        return {
+            table: connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ("entities", "properties", "claims")
+        }
+
+    # ---------- Import ----------
+
+    def importDump(self, path, batch_size=1000):
+        """
+        Import a dump, choosing the format from the file name (.nt for N-Triples, JSON otherwise).
+        Args:
+            path (str): The dump path (.json, .nt, optionally .gz or .bz2).
+            batch_size (int): Number of entities (or lines) written per transaction.
+        Returns:
+            dict: The number of imported, skipped (unchanged) entities and imported claims.
+        """
+        name = path[:-3] if path.endswith(".gz") else path[:-4] if path.endswith(".bz2") else path
+        if name.endswith(".nt"):
+            return self.importNTriples(path, batch_size * 50)
+        return self.importJSONDump(path, batch_size)
+
+    def importJSONDump(self, path, batch_size=1000):
+        """
+        Stream a Wikidata JSON dump (one entity per line) into the store with bounded memory. Entities whose
+        stored revision is at least the dump revision are skipped, so re-importing a newer dump only
+        rewrites the entities that changed.
+        Args:
+            path (str): The dump path.
+            batch_size (int): Number of entities written per transaction.
+        Returns:
+            dict: The number of imported, skipped (unchanged) entities and imported claims.
+        """
+        connection = self._connection()
+        counts = {"entities": 0, "skipped": 0, "claims": 0}
+        pending = 0
+        start = time.time()
+
+        connection.execute("BEGIN")
+        with openDump(path) as f:
+            for line in f:
+                line = line.strip().rstrip(",")
+                if not line or line in ("[", "]"):
+                    continue
+                entity = json.loads(line)
+                if self._importEntity(connection, entity, counts):
+                    pending += 1
+                if pending >= batch_size:
+                    connection.execute("COMMIT")
+                    connection.execute("BEGIN")
+                    pending = 0
+                    print(f"[LocalStore - Import]: {counts['entities']} entities, {counts['claims']} claims "
+                          f"({time.time() - start:.0f}s)")
+        connection.execute("COMMIT")
+        return counts
+
+    def _importEntity(self, connection, entity, counts):
+        qid = entity["id"]
+        label = entity.get("labels", {}).get("en", {}).get("value")
+        description = entity.get("descriptions", {}).get("en", {}).get("value")
+
+        if entity.get("type") == "property":
+            connection.execute(
+                "INSERT OR REPLACE INTO properties (pid, label, datatype) VALUES (?, ?, ?)",
+                (qid, label, entity.get("datatype"))
+            )
+
+        revision = entity.get("lastrevid", 0)
+        row = connection.execute("SELECT revision FROM entities WHERE qid = ?", (qid,)).fetchone()
+        if row and row[0] is not None and row[0] >= revision:
+            counts["skipped"] += 1
+            return False
+
+        connection.execute(
+            "INSERT OR REPLACE INTO entities (qid, label, description, revision) VALUES (?, ?, ?, ?)",
+            (qid, label, description, revision)
+        )
+        connection.execute("DELETE FROM claims WHERE subject = ?", (qid,))
+        rows = []
+        for pid, statements in entity.get("claims", {}).items():
+            # Preferred statements first; deprecated ones are skipped
+            for statement in sorted(statements, key=lambda s: s.get("rank") != "preferred"):
+                if statement.get("rank") == "deprecated":
+                    continue
+                converted = snakValue(statement.get("mainsnak", {}))
+                if converted:
+                    rows.append((qid, pid, converted[0], int(converted[1])))
+        connection.executemany("INSERT INTO claims (subject, property, value, is_entity) VALUES (?, ?, ?, ?)", rows)
+        counts["entities"] += 1
+        counts["claims"] += len(rows)
+        return True
+
+    def importNTriples(self, path, batch_size=50000):
+        """
+        Stream an N-Triples dump (truthy wdt: statements, English labels/descriptions and property types) into
+        the store with bounded memory. The claims of a subject are replaced the first time it is seen in an
+        import, so re-importing a refreshed slice updates the entities it contains.
+        Args:
+            path (str): The dump path.
+            batch_size (int): Number of lines processed per transaction.
+        Returns:
+            dict: The number of imported entities and claims.
+        """
+        connection = self._connection()
+        import_id = int(time.time() * 1000)
+        counts = {"entities": 0, "skipped": 0, "claims": 0}
+        last_subject = None
+
+        connection.execute("BEGIN")
+        with openDump(path) as f:
+            for i, line in enumerate(f, 1):
+                match = NT_LINE.match(line)
+                if not match or not match.group(1).startswith(ENTITY_IRI):
+                    continue
+                subject = match.group(1)[len(ENTITY_IRI):]
+                predicate, obj = match.group(2), match.group(3)
+
+                if subject != last_subject:
+                    self._refreshSubject(connection, subject, import_id, counts)
+                    last_subject = subject
+
+                literal = NT_LITERAL.match(obj)
+                text = json.loads(f'"{literal.group(1)}"') if literal else None
+                english = literal is not None and literal.group(2) in (None, "en")
+
+                if predicate in LABEL_IRIS and literal and literal.group(2) == "en":
+                    connection.execute("UPDATE entities SET label = ? WHERE qid = ?", (text, subject))
+                    if subject.startswith("P"):
+                        connection.execute(
+                            "INSERT INTO properties (pid, label) VALUES (?, ?) ON CONFLICT(pid) DO UPDATE SET label = excluded.label",
+                            (subject, text)
+                        )
+                elif predicate == DESCRIPTION_IRI and literal and literal.group(2) == "en":
+                    connection.execute("UPDATE entities SET description = ? WHERE qid = ?", (text, subject))
+                elif predicate == PROPERTY_TYPE_IRI:
+                    datatype = obj.strip("<>").rsplit("#", 1)[-1]
+                    # wikibase:ExternalId -> external-id, wikibase:CommonsMedia -> commonsMedia...
+                    datatype = re.sub(r"(?<!^)(?=[A-Z])", "-", datatype).lower() if datatype != "CommonsMedia" else "commonsMedia"
+                    connection.execute(
+                        "INSERT INTO properties (pid, datatype) VALUES (?, ?) ON CONFLICT(pid) DO UPDATE SET datatype = excluded.datatype",
+                        (subject, datatype)
+                    )
+                elif predicate.startswith(DIRECT_CLAIM_IRI):
+                    pid = predicate[len(DIRECT_CLAIM_IRI):]
+                    if obj.startswith(f"<{ENTITY_IRI}"):
+                        value, is_entity = obj[len(ENTITY_IRI) + 1:-1], 1
+                    elif literal and english:
+                        value, is_entity = text, 0
+                    else:
+                        continue
+                    connection.execute(
+                        "INSERT INTO claims (subject, property, value, is_entity) VALUES (?, ?, ?, ?)",
+                        (subject, pid, value, is_entity)
+                    )
+                    counts["claims"] += 1
+
+                if i % batch_size == 0:
+                    connection.execute("COMMIT")
+                    connection.execute("BEGIN")
+                    print(f"[LocalStore - Import]: {i} lines, {counts['entities']} entities, {counts['claims']} claims")
+
+        # Metadata properties are kept out of the claims, as in the JSON import
+        placeholders = ",".join("?" * len(SKIPPED_DATATYPES))
+        connection.execute(
+            f"DELETE FROM claims WHERE property IN (SELECT pid FROM properties WHERE datatype IN ({placeholders}))",
+            tuple(SKIPPED_DATATYPES)
+        )
+        connection.execute("COMMIT")
+        return counts
+
+    def _refreshSubject(self, connection, subject, import_id, counts):
+        row = connection.execute("SELECT import_id FROM entities WHERE qid = ?", (subject,)).fetchone()
+        if row and row[0] == import_id:
+            return
+        if row:
+            connection.execute("DELETE FROM claims WHERE subject = ?", (subject,))
+            connection.execute("UPDATE entities SET import_id = ? WHERE qid = ?", (import_id, subject))
+        else:
+            connection.execute("INSERT INTO entities (qid, import_id) VALUES (?, ?)", (subject, import_id))
+        counts["entities"] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the local Wikidata subset store.")
+    parser.add_argument("command", choices=["import", "stats"], help="import a dump, or show the store size")
+    parser.add_argument("dump", nargs="*", help="Dump files to import (.json or .nt, optionally .gz/.bz2).")
+    parser.add_argument("--db", default=os.path.join(os.path.dirname(__file__), "../data", "wikidata.sqlite"),
+                        help="Path to the SQLite store.")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Entities written per transaction.")
+    args = parser.parse_args()
+
+    store = LocalStore(args.db)
+    if args.command == "import":
+        for path in args.dump:
+            print(f"[LocalStore - Import]: {path}")
+            print(f"[LocalStore - Import Done]: {store.importDump(path, args.batch_size)}")
+    print(f"[LocalStore - Stats]: {store.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import Levenshtein
+
+# Rough number of characters per token, used to size prompts without a tokenizer
+CHARS_PER_TOKEN = 4
+
+
+def estimateTokens(text):
+    """
+    Estimate the number of tokens of a text.
+    Args:
+        text (str): The text.
+    Returns:
+        int: The estimated number of tokens.
+    """
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def tripleLine(triple):
+    return f"- {triple['entity']} {triple['relation']} {triple['object']}"
+
+
+def chunkTriples(triples, token_budget):
+    """
+    Split triples into chunks of at most token_budget tokens, keeping the triples of an entity
+    together when they fit and never reordering them.
+    Args:
+        triples (list): A list of triples, grouped by entity.
+        token_budget (int): Maximum estimated tokens of triple lines per chunk.
+    Returns:
+        list: A list of chunks (lists of triples).
+    """
+    # Group consecutive triples of the same entity
+    groups = []
+    for triple in triples:
+        if groups and groups[-1][0]["entity"] == triple["entity"]:
+            groups[-1].append(triple)
+        else:
+            groups.append([triple])
+
+    chunks = []
+    current, current_tokens = [], 0
+    for group in groups:
+        group_tokens = sum(estimateTokens(tripleLine(t)) for t in group)
+        if current and current_tokens + group_tokens > token_budget:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        if group_tokens <= token_budget:
+            current.extend(group)
+            current_tokens += group_tokens
+            continue
+        # An entity larger than the budget is split on its own
+        for triple in group:
+            tokens = estimateTokens(tripleLine(triple))
+            if current and current_tokens + tokens > token_budget:
+                chunks.append(current)
+                current, current_tokens = [], 0
+            current.append(triple)
+            current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def isDuplicate(text, seen, threshold):
+    normalized = " ".join(text.lower().split())
+    for other in seen:
+        if Levenshtein.ratio(normalized, other) >= threshold:
+            return True
+    seen.append(normalized)
+    return False
+
+
+def mergeCandidates(candidates, main_entity, max_facts, max_questions, threshold=0.85):
+    """
+    Reduce step of the map-reduce refinement: dedupe the candidate facts and questions of every
+    chunk (Levenshtein similarity) and rank them, putting items about the main entity first.
+    Args:
+        candidates (list): One {"facts": [...], "questions": [...]} dict per chunk, in chunk order.
+        main_entity (str): The main theme of the prompt.
+        max_facts (int): Maximum number of facts kept.
+        max_questions (int): Maximum number of questions kept.
+        threshold (float): Similarity ratio (0-1) above which two items are duplicates.
+    Returns:
+        tuple: The merged list of facts and the merged list of questions.
+    """
+    main = (main_entity or "").lower()
+
+    def rank(items, text_of):
+        # Stable sort: mentions of the main entity first, then chunk order
+        return sorted(items, key=lambda item: 0 if main and main in text_of(item[1]).lower() else 1)
+
+    facts, questions = [], []
+    seen_facts, seen_questions = [], []
+    for chunk_index, candidate in enumerate(candidates):
+        for fact in candidate.get("facts", []):
+            if isinstance(fact, str) and fact.strip() and not isDuplicate(fact, seen_facts, threshold):
+                facts.append((chunk_index, fact))
+        for question in candidate.get("questions", []):
+            if isinstance(question, dict) and question.get("question") \
+                    and not isDuplicate(question["question"], seen_questions, threshold):
+                questions.append((chunk_index, question))
+
+    facts = [fact for _, fact in rank(facts, lambda fact: fact)][:max_facts]
+    questions = [question for _, question in rank(questions, lambda question: question["question"])][:max_questions]
+    return facts, questions
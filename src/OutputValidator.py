@@ -0,0 +1,243 @@
+import json
+import re
+import threading
+
+# Markdown code fence around a completion (```json ... ```), possibly with text around it
+FENCE = re.compile(r"```(?:json|JSON)?\s*(.*?)\s*(?:```|$)", re.DOTALL)
+TRAILING_COMMA = re.compile(r",\s*([}\]])")
+COMMENT = re.compile(r"(^|[,{\[])\s*//[^\n]*", re.MULTILINE)
+DANGLING_KEY = re.compile(r'(,|(?<=\{))\s*"(?:[^"\\]|\\.)*"\s*:?\s*$')
+PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+SMART_QUOTES = str.maketrans({"“": '"', "”": '"', "‘": "'", "’": "'"})
+
+MAX_THEMES = 10
+OPTIONS = 4
+
+
+class OutputError(ValueError):
+    """
+    Raised when a completion can't be repaired into JSON.
+    """
+
+
+def closeJSON(text):
+    """
+    Close the arrays and objects left open by a truncated completion. A string cut in the middle is dropped
+    (a truncated fact or summary is worse than a regenerated one), and so is a key left without its value.
+    Args:
+        text (str): JSON text starting at its first bracket.
+    Returns:
+        str: The text with the missing closing characters appended.
+    """
+    stack = []
+    in_string = escape = False
+    string_start = 0
+    for i, char in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string, string_start = True, i
+        elif char in "[{":
+            stack.append(char)
+        elif char in "]}" and stack:
+            stack.pop()
+    if in_string:
+        text = text[:string_start]
+    if stack and stack[-1] == "{":
+        text = DANGLING_KEY.sub("", text)
+    text = re.sub(r",\s*$", "", text.rstrip())
+    return text + "".join("]" if char == "[" else "}" for char in reversed(stack))
+
+
+def repairJSON(content, expected=dict):
+    """
+    Parse a JSON completion, repairing what models commonly get wrong: markdown fences, text around
+    the JSON, trailing commas, comments, smart quotes, Python literals and truncated output.
+    Args:
+        content (str): The completion.
+        expected (type): dict or list, the type of the top-level value.
+    Returns:
+        tuple: The parsed value, and whether it needed repairs.
+    Raises:
+        OutputError: If the completion can't be repaired into a value of the expected type.
+    """
+    content = (content or "").strip()
+    try:
+        value = json.loads(content)
+        if isinstance(value, expected):
+            return value, False
+    except ValueError:
+        pass
+
+    fenced = FENCE.search(content)
+    text = fenced.group(1) if fenced else content
+    opening = "{" if expected is dict else "["
+    start = text.find(opening)
+    if start < 0:
+        raise OutputError(f"no JSON {expected.__name__} in the completion")
+    text = text[start:].translate(SMART_QUOTES)
+    closing = "}" if expected is dict else "]"
+    end = text.rfind(closing)
+
+    candidates = [text[:end + 1]] if end >= 0 else []
+    candidates.append(closeJSON(text))
+    for candidate in candidates:
+        candidate = COMMENT.sub(r"\1", candidate)
+        candidate = re.sub(r"\b(True|False|None)\b(?=\s*[,}\]])", lambda m: PYTHON_LITERALS[m.group(1)], candidate)
+        candidate = TRAILING_COMMA.sub(r"\1", candidate)
+        try:
+            value = json.loads(candidate)
+        except ValueError:
+            continue
+        if isinstance(value, expected):
+            return value, True
+    raise OutputError(f"the completion isn't valid JSON ({content[:80]!r})")
+
+
+def isValidJSON(content):
+    """
+    Check whether a completion can be repaired into a JSON object or array.
+    """
+    for expected in (dict, list):
+        try:
+            repairJSON(content, expected)
+            return True
+        except OutputError:
+            pass
+    return False
+
+
+def validateThemes(value):
+    """
+    Validate the themes extracted from a prompt: a list of distinct, non-empty strings
+    (a {"themes": [...]} object is accepted).
+    Args:
+        value: The parsed completion.
+    Returns:
+        tuple: The valid themes (at most MAX_THEMES, in order), and the number of items dropped.
+    """
+    if isinstance(value, dict):
+        value = next((item for item in value.values() if isinstance(item, list)), [])
+    themes = []
+    for item in value if isinstance(value, list) else []:
+        if isinstance(item, str) and item.strip() and item.strip() not in themes:
+            themes.append(item.strip())
+    return themes[:MAX_THEMES], len(value) - len(themes) if isinstance(value, list) else 0
+
+
+def validateFact(fact):
+    """
+    Validate a fact.
+    Args:
+        fact: The fact item of a completion.
+    Returns:
+        tuple: The fact (a {"fact": ...} object is unwrapped) and the error, None if it is valid.
+    """
+    if isinstance(fact, dict) and isinstance(fact.get("fact"), str):
+        fact = fact["fact"]
+    if not isinstance(fact, str) or not fact.strip():
+        return fact, "a fact must be a non-empty string"
+    return fact.strip(), None
+
+
+def validateQuestion(question):
+    """
+    Validate a multiple-choice question: a question, OPTIONS distinct options and a correct answer that is
+    one of them. An answer given as a letter, an index or with another case is mapped to its option.
+    Args:
+        question: The question item of a completion.
+    Returns:
+        tuple: The question (answer normalized) and the error, None if it is valid.
+    """
+    if not isinstance(question, dict):
+        return question, "a question must be an object"
+    text = question.get("question")
+    options = question.get("options")
+    answer = question.get("correct_answer")
+    if not isinstance(text, str) or not text.strip():
+        return question, "the question text is missing"
+    if not isinstance(options, list) or not all(isinstance(option, str) and option.strip() for option in options):
+        return question, "the options must be a list of non-empty strings"
+    options = [option.strip() for option in options]
+    if len(options) != OPTIONS or len({option.lower() for option in options}) != OPTIONS:
+        return question, f"there must be {OPTIONS} distinct options"
+
+    if isinstance(answer, int) and 0 <= answer < OPTIONS:
+        answer = options[answer]
+    elif isinstance(answer, str):
+        answer = answer.strip()
+        letter = re.fullmatch(r"([A-Da-d])[).:]?", answer)
+        matches = [option for option in options if option.lower() == answer.lower()]
+        if matches:
+            answer = matches[0]
+        elif letter:
+            answer = options["abcd".index(letter.group(1).lower())]
+    if answer not in options:
+        return question, f"the correct answer {question.get('correct_answer')!r} is not one of the options"
+    return {**question, "question": text.strip(), "options": options, "correct_answer": answer}, None
+
+
+def validateRefined(value):
+    """
+    Validate a refinement completion item by item.
+    Args:
+        value (dict): The parsed completion.
+    Returns:
+        tuple: The response with the valid facts and questions and the summary (None if missing),
+            and the invalid items as a dictionary mapping facts and questions to (item, error) tuples.
+    """
+    response = {"facts": [], "questions": [], "summary": None}
+    invalid = {"facts": [], "questions": []}
+    for key, validate in (("facts", validateFact), ("questions", validateQuestion)):
+        items = value.get(key) or []
+        for item in items if isinstance(items, list) else [items]:
+            item, error = validate(item)
+            if error:
+                invalid[key].append((item, error))
+            else:
+                response[key].append(item)
+    summary = value.get("summary")
+    if isinstance(summary, str) and summary.strip():
+        response["summary"] = summary.strip()
+    return response, invalid
+
+
+class ValidationStats:
+    """
+    Counters of the structured-output validation per output (themes, refine, part, regenerate):
+    completions parsed as is, repaired, unusable (failed), invalid items and regenerations.
+    """
+
+    EVENTS = ("parsed", "repaired", "failed", "invalid_items", "regenerations", "regenerated_items")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def count(self, output, event, value=1):
+        with self._lock:
+            counters = self._stats.setdefault(output, dict.fromkeys(self.EVENTS, 0))
+            counters[event] += value
+
+    def stats(self):
+        """
+        Get the counters and the repair and regeneration rates per output.
+        Returns:
+            dict: A dictionary mapping outputs to counters, repair_rate (repaired completions) and
+                regeneration_rate (completions followed by a regeneration call), as fractions of completions.
+        """
+        with self._lock:
+            stats = {}
+            for output, counters in self._stats.items():
+                completions = counters["parsed"] + counters["repaired"] + counters["failed"]
+                stats[output] = {
+                    **counters,
+                    "repair_rate": counters["repaired"] / completions if completions else 0.0,
+                    "regeneration_rate": counters["regenerations"] / completions if completions else 0.0
+                }
+            return stats
@@ -0,0 +1,49 @@
+import itertools
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class PriorityExecutor:
+    """
+    Thread pool that runs queued tasks by priority (lower value first, FIFO within a priority).
+    Used to schedule the resolve and fetch tasks of every theme so the main theme always goes first.
+    """
+
+    def __init__(self, max_workers=8, name="pipeline"):
+        """
+        Args:
+            max_workers (int): Number of worker threads.
+            name (str): Prefix of the worker thread names.
+        """
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.workers = []
+        for i in range(max(1, max_workers)):
+            worker = threading.Thread(target=self.work, name=f"{name}-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, priority, fn, *args, **kwargs):
+        """
+        Queue a task.
+        Args:
+            priority (int): The task priority (lower runs first).
+            fn (callable): The function to run.
+            *args, **kwargs: Arguments passed to the function.
+        Returns:
+            Future: The future of the task result (cancel() drops it if it hasn't started).
+        """
+        future = Future()
+        self.queue.put((priority, next(self.counter), future, fn, args, kwargs))
+        return future
+
+    def work(self):
+        while True:
+            _, _, future, fn, args, kwargs = self.queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
@@ -0,0 +1,114 @@
+import threading
+from concurrent.futures import CancelledError, Future
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical computations: the first caller of a key (the leader) runs it,
+    and callers arriving while it is in flight (followers) wait for its result instead of starting
+    their own. Errors of the leader are raised in every follower. If the leader is cancelled
+    (interrupted by a BaseException such as a Streamlit rerun or a closed generator), one of the
+    waiting followers takes over as the new leader.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {}
+
+    def join(self, kind, key):
+        """
+        Join the in-flight call of a key, or start it.
+        Args:
+            kind (str): The kind of computation (used for the metrics).
+            key (str): The key of the computation.
+        Returns:
+            tuple: The call's Future and whether the caller is its leader. The leader must finish the
+                call with resolve, fail or cancel.
+        """
+        with self._lock:
+            call = self._calls.get((kind, key))
+            if call is not None:
+                self._count(kind, "coalesced")
+                return call, False
+            call = Future()
+            self._calls[(kind, key)] = call
+            self._count(kind, "leaders")
+            return call, True
+
+    def resolve(self, kind, key, call, value):
+        self._finish(kind, key)
+        call.set_result(value)
+
+    def fail(self, kind, key, call, error):
+        self._finish(kind, key, "errors")
+        call.set_exception(error)
+
+    def cancel(self, kind, key, call):
+        self._finish(kind, key, "cancelled")
+        call.cancel()
+
+    def _finish(self, kind, key, event=None):
+        with self._lock:
+            self._calls.pop((kind, key), None)
+            if event:
+                self._count(kind, event)
+
+    def do(self, kind, key, fn, *args, timeout=None, private=(), **kwargs):
+        """
+        Run fn once for all concurrent callers of a key.
+        Args:
+            kind (str): The kind of computation (used for the metrics).
+            key (str): The key of the computation.
+            fn (callable): The computation.
+            timeout (float): Maximum seconds a follower waits (None waits for the leader).
+            private (tuple): Exception classes specific to the leader (e.g. its own deadline): they are
+                             raised in the leader only, and the followers retry instead.
+        Returns:
+            tuple: The result, and whether it was shared from another caller's computation.
+        Raises:
+            Exception: The leader's error.
+            TimeoutError: If a follower waited longer than timeout (the leader keeps running).
+        """
+        while True:
+            call, leader = self.join(kind, key)
+            if not leader:
+                try:
+                    return call.result(timeout=timeout), True
+                except CancelledError:
+                    # The leader was interrupted: retry, possibly as the new leader
+                    continue
+            try:
+                value = fn(*args, **kwargs)
+            except private:
+                self.cancel(kind, key, call)
+                raise
+            except Exception as e:
+                self.fail(kind, key, call, e)
+                raise
+            except BaseException:
+                self.cancel(kind, key, call)
+                raise
+            self.resolve(kind, key, call, value)
+            return value, False
+
+    def inFlight(self):
+        with self._lock:
+            return len(self._calls)
+
+    def _count(self, kind, event):
+        counters = self._stats.setdefault(kind, {"leaders": 0, "coalesced": 0, "errors": 0, "cancelled": 0})
+        counters[event] += 1
+
+    def stats(self):
+        """
+        Get the leader, coalesced, error and cancellation counters per kind.
+        Returns:
+            dict: A dictionary mapping kinds to counters.
+        """
+        with self._lock:
+            return {kind: dict(counters) for kind, counters in self._stats.items()}
+
+
+# Shared by every engine (and so every Streamlit session) of the process
+FLIGHTS = SingleFlight()
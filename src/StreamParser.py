@@ -0,0 +1,102 @@
+import json
+
+
+class IncrementalJSONParser:
+    """
+    Incremental parser for the refineTriples JSON object while it is being streamed.
+    Text chunks are fed as they arrive, and every element of the watched top-level arrays
+    (facts, questions) and every watched top-level string (summary) is emitted as soon as
+    it is complete. Text before the first "{" (e.g. a markdown fence) is ignored.
+    """
+
+    def __init__(self, arrays=("facts", "questions"), strings=("summary",)):
+        """
+        Args:
+            arrays (tuple): Top-level keys whose array elements are emitted one by one.
+            strings (tuple): Top-level keys whose complete values are emitted.
+        """
+        self.arrays = set(arrays)
+        self.strings = set(strings)
+        self.buffer = ""
+        self.pos = 0
+        self.started = False
+        self.in_string = False
+        self.escape = False
+        self.depth = 0
+        self.key = None           # Current top-level key
+        self.expect_key = False   # Next string at depth 1 is a key
+        self.string_start = None  # Start of the current string (depth 1 or 2)
+        self.item_start = None    # Start of the current element of a watched array
+        self.done = False
+
+    def feed(self, text):
+        """
+        Feed a chunk of streamed text.
+        Args:
+            text (str): The next chunk of the completion.
+        Returns:
+            list: A list of (key, value) tuples completed by this chunk.
+        """
+        events = []
+        self.buffer += text
+        while self.pos < len(self.buffer) and not self.done:
+            char = self.buffer[self.pos]
+            if not self.started:
+                if char == "{":
+                    self.started = True
+                    self.depth = 1
+                    self.expect_key = True
+                self.pos += 1
+                continue
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    self._closeString(events)
+            elif char == '"':
+                self.in_string = True
+                if self.depth in (1, 2):
+                    self.string_start = self.pos
+                if self._inWatchedArray() and self.depth == 2:
+                    self.item_start = self.pos
+            elif char in "{[":
+                if self._inWatchedArray() and self.depth == 2 and char == "{":
+                    self.item_start = self.pos
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if self._inWatchedArray() and self.depth == 2 and self.item_start is not None:
+                    self._emit(events, self.key, self.buffer[self.item_start:self.pos + 1])
+                    self.item_start = None
+                if self.depth == 0:
+                    self.done = True
+            elif char == "," and self.depth == 1:
+                self.expect_key = True
+                self.key = None
+            self.pos += 1
+        return events
+
+    def _closeString(self, events):
+        raw = self.buffer[self.string_start:self.pos + 1]
+        if self.depth == 1:
+            if self.expect_key:
+                self.key = json.loads(raw)
+                self.expect_key = False
+            elif self.key in self.strings:
+                self._emit(events, self.key, raw)
+        elif self.depth == 2 and self._inWatchedArray() and self.item_start == self.string_start:
+            self._emit(events, self.key, raw)
+            self.item_start = None
+
+    def _inWatchedArray(self):
+        return self.key in self.arrays
+
+    def _emit(self, events, key, raw):
+        try:
+            events.append((key, json.loads(raw)))
+        except json.JSONDecodeError:
+            pass
@@ -0,0 +1,151 @@
+"""
+Local theme extraction with spaCy.
+
+Finds the main theme of a prompt and its other topics with the named entities and noun chunks of the
+prompt, in a few milliseconds instead of an LLM round trip. The engine completes the list with the
+entities linked to the main theme in Wikidata, and falls back to the LLM when the confidence is low.
+
+Usage:
+    python src/ThemeExtractor.py "The causes of the French Revolution" "DNA replication"
+"""
+import argparse
+import threading
+
+try:
+    import spacy
+except ImportError:
+    spacy = None
+
+# Entity types that name topics (dates, quantities, ordinals and money don't)
+TOPIC_ENTITIES = {"PERSON", "NORP", "FAC", "ORG", "GPE", "LOC", "PRODUCT", "EVENT", "WORK_OF_ART", "LAW", "LANGUAGE"}
+
+# Words that make a prompt a request rather than a topic ("tell me about", "explain")
+REQUEST_WORDS = {"tell", "explain", "describe", "learn", "study", "know", "teach", "quiz", "flashcards", "cards", "about"}
+
+# Confidence of a prompt that is a single short topic the model didn't tag ("Photosynthesis")
+SHORT_PROMPT_CONFIDENCE = 0.7
+
+
+class ThemeExtractor:
+    """
+    spaCy-based extraction of the themes of a prompt, with a confidence score. The model is loaded on first use;
+    without spaCy or the model, extract returns no themes (and the engine uses the LLM).
+    Also keeps the counters of the engine's local extractions and of their fallbacks to the LLM.
+    """
+
+    EVENTS = ("local", "unavailable", "low_confidence", "unresolved")
+
+    def __init__(self, model="en_core_web_sm", max_themes=10):
+        """
+        Args:
+            model (str): The spaCy pipeline (needs a parser and an entity recognizer).
+            max_themes (int): Maximum number of themes extracted from the prompt.
+        """
+        self.model = model
+        self.max_themes = max_themes
+        self._nlp = None
+        self._error = None
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(self.EVENTS, 0)
+
+    def available(self):
+        """
+        Load the spaCy pipeline if needed.
+        Returns:
+            bool: Whether local extraction can run.
+        """
+        with self._lock:
+            if self._nlp is None and self._error is None:
+                if spacy is None:
+                    self._error = "spaCy isn't installed (pip install spacy)"
+                else:
+                    try:
+                        self._nlp = spacy.load(self.model, disable=["lemmatizer"])
+                    except OSError as e:
+                        self._error = f"{e} (python -m spacy download {self.model})"
+                if self._error:
+                    print(f"[ThemeExtractor - Unavailable]: {self._error}")
+            return self._nlp is not None
+
+    def extract(self, prompt):
+        """
+        Extract the themes of a prompt: the main theme (the first topic entity, or else the largest noun chunk),
+        then the other entities and noun chunks in order.
+        Args:
+            prompt (str): The prompt.
+        Returns:
+            tuple: The themes (main theme first, empty if spaCy is unavailable) and the confidence (0-1), the
+                fraction of the prompt's content words covered by the themes, lowered when the main theme is
+                only a noun chunk.
+        """
+        if not prompt.strip() or not self.available():
+            return [], 0.0
+        doc = self._nlp(prompt)
+
+        content = [token for token in doc if self.isContent(token)]
+        entities = [span for span in doc.ents if span.label_ in TOPIC_ENTITIES]
+        chunks = [self.trimChunk(chunk) for chunk in doc.noun_chunks]
+        chunks = [chunk for chunk in chunks if chunk is not None and any(self.isContent(token) for token in chunk)]
+
+        if entities:
+            main, main_weight = entities[0], 1.0
+        elif chunks:
+            main, main_weight = max(chunks, key=lambda chunk: sum(self.isContent(token) for token in chunk)), 0.8
+        elif 0 < len(content) <= 3:
+            # A short topic the model found nothing in: the prompt itself
+            return [prompt.strip()], SHORT_PROMPT_CONFIDENCE
+        else:
+            return [], 0.0
+
+        themes, covered = [], set()
+        for span in [main, *entities, *chunks]:
+            text = span.text.strip()
+            if text and text.lower() not in (theme.lower() for theme in themes):
+                themes.append(text)
+                covered.update(token.i for token in span)
+        coverage = sum(1 for token in content if token.i in covered) / len(content) if content else 0.0
+        return themes[:self.max_themes], coverage * main_weight
+
+    def count(self, event):
+        with self._lock:
+            self._stats[event] += 1
+
+    def stats(self):
+        """
+        Get the counters of local extractions and fallbacks.
+        Returns:
+            dict: local, unavailable, low_confidence and unresolved counts, and local_rate (local / attempts).
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        attempts = sum(stats.values())
+        stats["local_rate"] = stats["local"] / attempts if attempts else 0.0
+        return stats
+
+    @staticmethod
+    def isContent(token):
+        return token.is_alpha and not token.is_stop and token.lower_ not in REQUEST_WORDS
+
+    @staticmethod
+    def trimChunk(chunk):
+        # Drop leading determiners, pronouns and request words ("the history", "my notes", "about Rome")
+        start = chunk.start
+        while start < chunk.end and (chunk.doc[start].pos_ in ("DET", "PRON") or chunk.doc[start].lower_ in REQUEST_WORDS):
+            start += 1
+        return chunk.doc[start:chunk.end] if start < chunk.end else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract the themes of prompts with spaCy.")
+    parser.add_argument("prompt", nargs="+")
+    parser.add_argument("--model", default="en_core_web_sm")
+    args = parser.parse_args()
+
+    extractor = ThemeExtractor(args.model)
+    for prompt in args.prompt:
+        themes, confidence = extractor.extract(prompt)
+        print(f"[ThemeExtractor]: {prompt} -> {themes} (confidence {confidence:.2f})")
+
+
+if __name__ == "__main__":
+    main()
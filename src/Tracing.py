@@ -0,0 +1,351 @@
+import contextvars
+import functools
+import inspect
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (seconds) of the Prometheus latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    One timed stage of a trace. Numeric attributes added with Tracer.annotate are summed.
+    """
+
+    def __init__(self, tracer, stage, parent=None, **attrs):
+        self.tracer = tracer
+        self.stage = stage
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:8]
+        self.parent_id = parent.span_id if parent else None
+        self.attrs = dict(attrs)
+        self.error = None
+        self.start = time.time()
+        self.duration = None
+        self.lock = threading.Lock()
+
+    def add(self, **values):
+        with self.lock:
+            for name, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self.attrs[name] = self.attrs.get(name, 0) + value
+                else:
+                    self.attrs[name] = value
+
+    def finish(self):
+        self.duration = time.time() - self.start
+        self.tracer.record(self)
+
+    def toDict(self):
+        return {
+            "trace": self.trace_id,
+            "span": self.span_id,
+            "parent": self.parent_id,
+            "stage": self.stage,
+            "start": self.start,
+            "duration": self.duration,
+            "error": self.error,
+            **self.attrs
+        }
+
+
+class Tracer:
+    """
+    Per-stage tracing for the KnowledgeEngine pipeline.
+    Each stage runs in a span that records its wall time, error class and numeric attributes
+    (bytes, triple and token counts, cache hits...). Finished spans are appended to a JSON-lines
+    trace file and aggregated into metrics exported in the Prometheus text format.
+    """
+
+    def __init__(self, trace_path=None, metrics_path=None, history=1000):
+        """
+        Args:
+            trace_path (str): JSON-lines file receiving every finished span (None disables it).
+            metrics_path (str): File rewritten with the Prometheus metrics after every trace (None disables it).
+            history (int): Number of recent spans (and durations per stage) kept in memory.
+        """
+        self.trace_path = trace_path
+        self.metrics_path = metrics_path
+        self.spans = deque(maxlen=history)
+        self.durations = {}
+        self.stages = {}
+        self.errors = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+        self.history = history
+
+        for path in (trace_path, metrics_path):
+            if path:
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def span(self, stage, **attrs):
+        """
+        Context manager running a stage in a new span (child of the current one, if any).
+        Args:
+            stage (str): The stage name.
+            **attrs: Initial attributes of the span.
+        Returns:
+            ContextManager[Span]: The active span.
+        """
+        return _SpanContext(self, Span(self, stage, _current_span.get(), **attrs))
+
+    def annotate(self, **values):
+        """
+        Add attributes to the current span (numeric values are summed). Does nothing outside a span.
+        """
+        span = _current_span.get()
+        if span is not None:
+            span.add(**values)
+
+    def error(self, exception):
+        """
+        Mark the current span as failed with the class of the given exception.
+        Args:
+            exception (Exception): The exception caught by the stage.
+        """
+        span = _current_span.get()
+        if span is not None:
+            span.error = exception.__class__.__name__
+
+    def bind(self, fn):
+        """
+        Wrap a function so it runs under the current span when called from another thread
+        (along with the rest of the current context, e.g. the generation deadline).
+        Args:
+            fn (callable): The function to wrap (e.g. before passing it to an executor).
+        Returns:
+            callable: The wrapped function.
+        """
+        context = contextvars.copy_context()
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            # A context can't be entered by two threads at once, so every call runs in its own copy
+            return context.copy().run(fn, *args, **kwargs)
+        return wrapper
+
+    def record(self, span):
+        entry = span.toDict()
+        with self.lock:
+            self.spans.append(entry)
+            self.durations.setdefault(span.stage, deque(maxlen=self.history)).append(span.duration)
+
+            stage = self.stages.setdefault(span.stage, {
+                "count": 0, "seconds": 0.0, "buckets": [0] * len(LATENCY_BUCKETS), "totals": {}
+            })
+            stage["count"] += 1
+            stage["seconds"] += span.duration
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if span.duration <= bound:
+                    stage["buckets"][i] += 1
+            for name, value in span.attrs.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    stage["totals"][name] = stage["totals"].get(name, 0) + value
+            if span.error:
+                key = (span.stage, span.error)
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+            if self.trace_path:
+                try:
+                    with open(self.trace_path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                except OSError as e:
+                    print(f"[Tracing - Trace Write Error]: {e}")
+
+        # A root span ends a trace: refresh the metrics file
+        if span.parent_id is None and self.metrics_path:
+            self.writePrometheus(self.metrics_path)
+
+    def addCollector(self, collector):
+        """
+        Register an extra source of Prometheus lines (e.g. cache or transport counters).
+        Args:
+            collector (callable): Function returning a list of Prometheus text lines.
+        """
+        self.collectors.append(collector)
+
+    def summary(self):
+        """
+        Get the latency percentiles and attribute totals per stage.
+        Returns:
+            dict: A dictionary mapping each stage to its count, p50, p95, p99 and totals.
+        """
+        with self.lock:
+            result = {}
+            for stage, data in self.stages.items():
+                durations = sorted(self.durations.get(stage, []))
+                result[stage] = {
+                    "count": data["count"],
+                    "p50": percentile(durations, 50),
+                    "p95": percentile(durations, 95),
+                    "p99": percentile(durations, 99),
+                    **data["totals"]
+                }
+            return result
+
+    def recentSpans(self, limit=50):
+        """
+        Get the most recently finished spans.
+        Args:
+            limit (int): Maximum number of spans to return.
+        Returns:
+            list: A list of span dictionaries, newest last.
+        """
+        with self.lock:
+            return list(self.spans)[-limit:]
+
+    def prometheus(self):
+        """
+        Render the metrics in the Prometheus text exposition format.
+        Returns:
+            str: The metrics text.
+        """
+        lines = [
+            "# HELP kg_stage_duration_seconds Wall time of each pipeline stage.",
+            "# TYPE kg_stage_duration_seconds histogram"
+        ]
+        with self.lock:
+            for stage, data in sorted(self.stages.items()):
+                for bound, count in zip(LATENCY_BUCKETS, data["buckets"]):
+                    lines.append(f'kg_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'kg_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {data["count"]}')
+                lines.append(f'kg_stage_duration_seconds_sum{{stage="{stage}"}} {data["seconds"]}')
+                lines.append(f'kg_stage_duration_seconds_count{{stage="{stage}"}} {data["count"]}')
+
+            lines += ["# HELP kg_stage_errors_total Failed stage runs by error class.", "# TYPE kg_stage_errors_total counter"]
+            for (stage, error), count in sorted(self.errors.items()):
+                lines.append(f'kg_stage_errors_total{{stage="{stage}",error="{error}"}} {count}')
+
+            names = sorted({name for data in self.stages.values() for name in data["totals"]})
+            for name in names:
+                lines += [f"# HELP kg_stage_{name}_total Sum of {name} over stage runs.", f"# TYPE kg_stage_{name}_total counter"]
+                for stage, data in sorted(self.stages.items()):
+                    if name in data["totals"]:
+                        lines.append(f'kg_stage_{name}_total{{stage="{stage}"}} {data["totals"][name]}')
+
+        for collector in self.collectors:
+            lines += collector()
+        return "\n".join(lines) + "\n"
+
+    def writePrometheus(self, path):
+        """
+        Write the Prometheus metrics to a file (atomically, for the node exporter textfile collector).
+        Args:
+            path (str): The destination file.
+        """
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(self.prometheus())
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"[Tracing - Metrics Write Error]: {e}")
+
+    def serve(self, port, host="127.0.0.1"):
+        """
+        Serve the Prometheus metrics over HTTP (GET /metrics) from a background thread.
+        Args:
+            port (int): The port to listen on.
+            host (str): The interface to bind.
+        Returns:
+            ThreadingHTTPServer: The running server.
+        """
+        tracer = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = tracer.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class _SpanContext:
+    def __init__(self, tracer, span):
+        self.span = span
+        self.token = None
+
+    def __enter__(self):
+        self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.reset(self.token)
+        if exc is not None and self.span.error is None:
+            self.span.error = exc_type.__name__
+        self.span.finish()
+        return False
+
+
+def traced(stage):
+    """
+    Decorator running a KnowledgeEngine method in a span of self.tracer.
+    Generator methods keep their span open until the generator is exhausted or closed.
+    Args:
+        stage (str): The stage name.
+    """
+    def decorator(method):
+        if inspect.isgeneratorfunction(method):
+            @functools.wraps(method)
+            def generator_wrapper(self, *args, **kwargs):
+                span = Span(self.tracer, stage, _current_span.get())
+                generator = method(self, *args, **kwargs)
+                try:
+                    while True:
+                        # The span is only current while the generator runs, not while the caller consumes it
+                        token = _current_span.set(span)
+                        try:
+                            item = next(generator)
+                        except StopIteration:
+                            return
+                        finally:
+                            _current_span.reset(token)
+                        yield item
+                except BaseException as e:
+                    if not isinstance(e, GeneratorExit):
+                        span.error = span.error or e.__class__.__name__
+                    generator.close()
+                    raise
+                finally:
+                    span.finish()
+            return generator_wrapper
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.tracer.span(stage):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of sorted values.
+    Args:
+        values (list): Sorted values.
+        pct (float): The percentile (0-100).
+    Returns:
+        float: The percentile, or None if there are no values.
+    """
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, math.ceil(pct / 100 * len(values)) - 1))
+    return values[index]
@@ -0,0 +1,127 @@
+import re
+
+import Levenshtein
+
+from MapReduce import estimateTokens, tripleLine
+
+# Relations that are metadata rather than knowledge (identifiers, templates, categories, media...)
+METADATA_RELATION = re.compile(
+    r"\bID\b|identifier|\bcategory\b|\btemplate\b|Commons|\bURL\b|website|image|logo|\bicon\b|"
+    r"pronunciation|audio|video|locator map|\bsignature\b|Freebase|Google Knowledge Graph|"
+    r"described by source|catalog code|on focus list",
+    re.IGNORECASE
+)
+METADATA_OBJECT = re.compile(r"^(https?://|Category:|Template:)|^[QP]\d+$|\.(svg|png|jpe?g|gif|ogg|webm)$", re.IGNORECASE)
+
+# Relations that usually carry educational content about an entity
+KEY_RELATIONS = {
+    "instance of", "subclass of", "part of", "has part(s)", "has part", "country", "inception", "founded by",
+    "named after", "field of work", "discoverer or inventor", "use", "located in the administrative territorial entity",
+    "capital", "capital of", "official language", "continent", "author", "creator", "developer", "genre",
+    "movement", "occupation", "notable work", "award received", "studied by", "facet of", "opposite of",
+    "different from", "time period", "location", "date of birth", "date of death", "place of birth", "significant event"
+}
+
+
+def pruneTriples(triples):
+    """
+    Drop triples about identifiers, templates, categories and media.
+    Args:
+        triples (list): A list of triples.
+    Returns:
+        list: The remaining triples.
+    """
+    return [
+        t for t in triples
+        if not METADATA_RELATION.search(t["relation"]) and not METADATA_OBJECT.search(t["object"].strip())
+    ]
+
+
+def dedupeTriples(triples, threshold=0.9):
+    """
+    Drop near-identical triples of the same entity (Levenshtein similarity of relation + object).
+    Args:
+        triples (list): A list of triples.
+        threshold (float): Similarity ratio (0-1) above which two triples are duplicates.
+    Returns:
+        list: The triples without duplicates, in their original order.
+    """
+    seen = {}
+    result = []
+    for t in triples:
+        text = f"{t['relation']} {t['object']}".lower()
+        others = seen.setdefault(t["entity"], [])
+        if any(Levenshtein.ratio(text, other) >= threshold for other in others):
+            continue
+        others.append(text)
+        result.append(t)
+    return result
+
+
+def scoreTriple(triple, main_entity, entity_rank):
+    """
+    Relevance of a triple to the main entity.
+    Args:
+        triple (dict): The triple.
+        main_entity (str): The main theme.
+        entity_rank (dict): Position of every entity in the theme list.
+    Returns:
+        float: The score (higher is more relevant).
+    """
+    main = main_entity.lower()
+    rank = entity_rank.get(triple["entity"], len(entity_rank))
+    score = 1.0 if rank == 0 else max(0.2, 0.7 - 0.05 * rank)
+    if rank and main and main in triple["object"].lower():
+        score += 0.3
+    if triple["relation"].lower() in KEY_RELATIONS:
+        score += 0.2
+    if re.fullmatch(r"[\d\s.,:+\-TZ]+", triple["object"]):
+        score -= 0.1
+    # Triples of neighbouring entities (multi-hop expansion) rank below the themes' own triples
+    score -= 0.2 * triple.get("hop", 0)
+    return score
+
+
+def rankTriples(triples, main_entity, token_budget=None):
+    """
+    Keep the most relevant triples within a token budget.
+    Args:
+        triples (list): A list of triples, grouped by entity in theme order.
+        main_entity (str): The main theme.
+        token_budget (int): Maximum estimated tokens of the triple lines (None keeps every triple).
+    Returns:
+        list: The selected triples, in their original order.
+    """
+    if not token_budget:
+        return list(triples)
+
+    # The main entity ranks first, the other themes in their order of appearance
+    entity_rank = {main_entity: 0}
+    for t in triples:
+        entity_rank.setdefault(t["entity"], len(entity_rank))
+
+    order = sorted(range(len(triples)), key=lambda i: -scoreTriple(triples[i], main_entity, entity_rank))
+    selected, used = set(), 0
+    for i in order:
+        tokens = estimateTokens(tripleLine(triples[i]))
+        if used + tokens > token_budget:
+            continue
+        selected.add(i)
+        used += tokens
+    return [t for i, t in enumerate(triples) if i in selected]
+
+
+def preprocessTriples(triples, main_entity, token_budget=None, dedupe_threshold=0.9):
+    """
+    Prune, dedupe and rank the triples before they are sent to the LLM.
+    Args:
+        triples (list): A list of triples.
+        main_entity (str): The main theme.
+        token_budget (int): Maximum estimated tokens of the triple lines (None keeps every triple).
+        dedupe_threshold (float): Similarity ratio above which two triples are duplicates.
+    Returns:
+        list: The processed triples.
+    """
+    triples = pruneTriples(triples)
+    triples = dedupeTriples(triples, dedupe_threshold)
+    return rankTriples(triples, main_entity, token_budget)
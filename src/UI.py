@@ -1,53 +1,36 @@
+from CardStyle import POST_IT_COLORS, SHARED_CARD_STYLE, STICKER_DECORATION, darker_color
+from DeckExporter import FORMATS, DeckExporter
 from KnowledgeEngine import KnowledgeEngine
+from LazyResponse import LazyResponse
 import streamlit as st
 import random
 
-# ---------- Constants ----------
-
-POST_IT_COLORS = ["#cdfc93", "#ff7ecd", "#71d7ff", "#ce81ff", "#fff68b"]
-SHARED_CARD_STYLE = (
-    "background: {bg_color}; "
-    "padding: 25px 20px; "
-    "border-radius: 12px; "
-    "max-width: 600px; "
-    "box-shadow: 5px 7px 15px rgba(0,0,0,0.3); "
-    "font-family: 'Comic Sans MS', cursive, sans-serif; "
-    "border: 2px solid {border_color}; "
-    "margin-top: 20px; "
-    "position: relative;"
-)
-
-STICKER_DECORATION = (
-    "position: absolute; "
-    "top: 0px; "
-    "left: -15px; "
-    "width: 60px; "
-    "height: 15px; "
-    "background: repeating-linear-gradient(45deg, #FFD580, #FFD580 5px, #FFA500 5px, #FFA500 10px); "
-    "border-radius: 3px; "
-    "box-shadow: 0 1px 3px rgba(0,0,0,0.15); "
-    "transform: rotate(-40deg);"
-)
-
-
+# Card area reruns on its own when its buttons are clicked (st.experimental_fragment in Streamlit 1.33,
+# st.fragment from 1.37); without fragment support every click reruns the whole script
+fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda function: function)
 
 # ---------- Utilities ----------
     
+@st.cache_resource
+def get_engine():
+    # One engine (settings, HTTP pools, caches and worker pools) shared by every session and rerun
+    return KnowledgeEngine()
+
+@st.cache_resource
+def get_exporter():
+    return DeckExporter(workers=1)
+
 def setupUI():
     st.set_page_config(page_title="KG Project", page_icon=":guardsman:", layout="centered")
 
-def darker_color(hex_color, amount=30):
-    hex_color = hex_color.lstrip('#')
-    r, g, b = [int(hex_color[i:i+2], 16) for i in (0, 2, 4)]
-    r, g, b = max(r - amount, 0), max(g - amount, 0), max(b - amount, 0)
-    return f"#{r:02x}{g:02x}{b:02x}"
-
 def initialize_state():
     st.session_state.setdefault('active_tab', 'summary')
     st.session_state.setdefault('fact_index', 0)
     st.session_state.setdefault('question_index', 0)
     st.session_state.setdefault('last_prompt', "")
     st.session_state.setdefault('response_data', None)
+    st.session_state.setdefault('question_results', {})
+    st.session_state.setdefault('score', (0, 0))
 
 def render_card(title, content, bg_color, border_color, question_mode=False, correct=0, total=0):
     base_style = SHARED_CARD_STYLE.format(bg_color=bg_color, border_color=border_color)
@@ -76,21 +59,29 @@ def render_card(title, content, bg_color, border_color, question_mode=False, cor
 
 # ---------- UI Renderers ----------
 
-def render_summary_tab(prompt, summary, bg_color, border_color):
-    card_sum_html = render_card(f"📝 About {prompt}", summary, bg_color, border_color)
-    
-    if st.button("Export as PNG"):
-        export_html_as_png(card_sum_html)
+def render_summary_tab(prompt, summary, bg_color, border_color, exporter):
+    render_card(f"📝 About {prompt}", summary, bg_color, border_color)
+
+    card = {"kind": "summary", "title": f"About {prompt}", "front": summary, "back": ""}
+    render_card_export(card, bg_color, exporter, "export_summary", "summary.png")
+
+def render_card_export(card, bg_color, exporter, key, file_name):
+    # The PNG is only rendered on the server when asked for, and kept while the same card is shown
+    if st.button("Export as PNG", key=key):
+        st.session_state[f"{key}_png"] = (card, exporter.cardPNG(card, bg_color))
+    rendered = st.session_state.get(f"{key}_png")
+    if rendered and rendered[0] == card:
+        st.download_button(f"Download {file_name}", rendered[1], file_name=file_name, mime="image/png", key=f"{key}_download")
 
 def render_list_tab(title, items):
     st.markdown(f"<h4>{title}</h4>", unsafe_allow_html=True)
     st.markdown("<ul>" + "".join(f"<li>{item}</li>" for item in items) + "</ul>", unsafe_allow_html=True) if items else st.info("No items available.")
 
 
-def render_flashcard_tab(facts, bg_color, border_color):
+def render_flashcard_tab(facts, bg_color, border_color, exporter):
     if facts:
         index = st.session_state.fact_index
-        card_tab_html = render_card(f"📘 Fact {index + 1}", facts[index], bg_color, border_color)
+        render_card(f"📘 Fact {index + 1}", facts[index], bg_color, border_color)
 
         # Custom column widths to control button placement
         col1, col2, col3, col4 = st.columns([1.5, 1, 1, 1.05])
@@ -104,9 +95,9 @@ def render_flashcard_tab(facts, bg_color, border_color):
             st.button("➡️", on_click=lambda: update_index('fact_index', 1), key="next_fact_btn")
             
             
-        if st.button("Export as PNG"):
-            export_html_as_png(card_tab_html)
-        
+        card = {"kind": "fact", "title": f"Fact {index + 1}", "front": facts[index], "back": ""}
+        render_card_export(card, bg_color, exporter, "export_fact", f"fact_{index + 1}.png")
+
     else:
         st.info("No facts available.")
 
@@ -123,8 +114,8 @@ def render_question_flashcard(questions, bg_color, border_color):
     feedback_key = f"q_feedback_{index}"
     submitted_key = f"submitted_{index}"
 
-    # Compute score once (before rendering card) based on current session_state
-    correct_count, answered_count = get_question_score(questions)
+    # Score kept up to date on submit (before rendering card)
+    correct_count, answered_count = get_question_score()
 
     # Render the question card first (with score)
     render_card(
@@ -165,6 +156,7 @@ def render_question_flashcard(questions, bg_color, border_color):
             st.warning("Please select an answer before submitting.")
         else:
             st.session_state[submitted_key] = True
+            record_answer(index, selected == correct)
             if selected == correct:
                 st.session_state[feedback_key] = ("Correct! 🎉", "success")
             else:
@@ -197,16 +189,19 @@ def update_index(index_key, step):
     st.session_state.pop(f"q_feedback_{current_index}", None)
     st.session_state[index_key] = new_index
 
-def get_question_score(questions):
-    correct_count = 0
-    answered_count = 0
-    for i, q in enumerate(questions):
-        if st.session_state.get(f"submitted_{i}", False):
-            answered_count += 1
-            selected = st.session_state.get(f"q_radio_{i}")
-            if selected == q['correct_answer']:
-                correct_count += 1
-    return correct_count, answered_count
+def record_answer(index, is_correct):
+    # Update the running score instead of rescanning every question on each rerun
+    results = st.session_state.question_results
+    correct_count, answered_count = st.session_state.score
+    if index in results:
+        correct_count -= results[index]
+    else:
+        answered_count += 1
+    results[index] = is_correct
+    st.session_state.score = (correct_count + is_correct, answered_count)
+
+def get_question_score():
+    return st.session_state.score
 
 
 def render_feedback(is_correct, correct_answer, max_width="600px", margin="margin-bottom: 15px;"):
@@ -235,7 +230,37 @@ def render_tab_buttons():
 def set_tab(tab_name):
     st.session_state.active_tab = tab_name
 
-def showResponseCard(prompt, response):
+def load_part(response, part, default):
+    # Lazy responses generate the facts and questions the first time their tab is shown
+    if isinstance(response, LazyResponse) and not response.isReady(part):
+        with st.spinner(f"Generating {part}..."):
+            return response.get(part) or default
+    return response.get(part) or default
+
+@fragment
+def render_deck_export(prompt, response, exporter):
+    # Renders every card of the deck on the server (cached per card) in the chosen format
+    col1, col2 = st.columns([1, 1])
+    with col1:
+        format = st.selectbox("Export whole deck", FORMATS, format_func=lambda name: {"png": "PNG images (zip)", "pdf": "PDF", "anki": "Anki deck"}[name], key="export_format")
+    with col2:
+        st.markdown("<div style='margin-top: 28px;'>", unsafe_allow_html=True)
+        if st.button("Prepare export", key="export_prepare"):
+            with st.spinner("Rendering deck..."):
+                try:
+                    deck = response.toDict() if isinstance(response, LazyResponse) else response
+                    st.session_state.deck_export = (format, *exporter.export(prompt, deck, format))
+                except (ImportError, ValueError) as e:
+                    st.session_state.deck_export = None
+                    st.warning(str(e))
+
+    export = st.session_state.get('deck_export')
+    if export and export[0] == format:
+        _, data, file_name = export
+        st.download_button(f"Download {file_name}", data, file_name=file_name, key="export_download")
+
+@fragment
+def showResponseCard(prompt, response, exporter):
     bg_color = random.choice(POST_IT_COLORS)
     border_color = darker_color(bg_color)
 
@@ -245,58 +270,97 @@ def showResponseCard(prompt, response):
 
         tab = st.session_state.active_tab
         if tab == 'summary':
-            render_summary_tab(prompt, response.get('summary', 'No summary available'), bg_color, border_color)
+            render_summary_tab(prompt, load_part(response, 'summary', 'No summary available'), bg_color, border_color, exporter)
         elif tab == 'facts':
-            render_flashcard_tab(response.get('facts', []), bg_color, border_color)
+            render_flashcard_tab(load_part(response, 'facts', []), bg_color, border_color, exporter)
         elif tab == 'questions':
-            render_question_flashcard(response.get('questions', []), bg_color, border_color)
+            render_question_flashcard(load_part(response, 'questions', []), bg_color, border_color)
             
             
-# Export Flashcard 
-def export_html_as_png(html_str, filename="card.png"):
-    export_script = f"""
-    <div id="hidden-card" style="
-      position: absolute;
-      left: 0;
-      top: 0;
-      opacity: 0;
-      pointer-events: none;
-      z-index: -1;
-    ">
-      <div id="capture" style="display: inline-block;">
-        {html_str}
-      </div>
-    </div>
-
-    <script src="https://html2canvas.hertzen.com/dist/html2canvas.min.js"></script>
-    <script>
-      window.setTimeout(() => {{
-        html2canvas(document.getElementById('capture'), {{
-          backgroundColor: null,
-          scale: window.devicePixelRatio
-        }}).then(canvas => {{
-          canvas.toBlob(blob => {{
-            const url = URL.createObjectURL(blob);
-            const a = document.createElement('a');
-            a.href = url;
-            a.download = '{filename}';
-            a.click();
-            URL.revokeObjectURL(url);
-          }});
-        }});
-      }}, 500);
-    </script>
-    """
-    st.components.v1.html(export_script, height=0, width=0, scrolling=False)
+def render_stream_preview(partial):
+    bg_color = POST_IT_COLORS[0]
+    border_color = darker_color(bg_color)
+
+    st.caption(f"Generating... {len(partial['facts'])} facts, {len(partial['questions'])} questions so far")
+    for i, fact in enumerate(partial['facts']):
+        render_card(f"📘 Fact {i + 1}", fact, bg_color, border_color)
+    for i, qdata in enumerate(partial['questions']):
+        render_card(f"❓ Question {i + 1}", qdata.get('question', ''), bg_color, border_color)
+
+
+def render_debug_sidebar(engine):
+    with st.sidebar:
+        st.header("Pipeline metrics")
+
+        summary = engine.tracer.summary()
+        if summary:
+            st.subheader("Stages")
+            st.dataframe([{"stage": stage, **data} for stage, data in summary.items()], hide_index=True)
+
+        spans = engine.tracer.recentSpans()
+        if spans:
+            st.subheader("Last trace")
+            last_trace = spans[-1]["trace"]
+            st.dataframe([span for span in spans if span["trace"] == last_trace], hide_index=True)
+
+        st.subheader("Cache")
+        st.json(engine.cache.stats())
+        st.subheader("Local theme extraction")
+        st.json(engine.local_themes.stats())
+        st.subheader("Labels")
+        st.json(engine.labels.stats())
+        st.subheader("HTTP")
+        st.json(engine.transport.metrics())
+        st.subheader("Output validation")
+        st.json(engine.validation.stats())
+        if engine.library is not None:
+            st.subheader("Deck library")
+            st.json(engine.library.stats())
+        if engine.hedge is not None:
+            st.subheader("LLM hedging")
+            st.json(engine.hedge.stats())
+
+        st.download_button("Download Prometheus metrics", engine.tracer.prometheus(), file_name="metrics.prom")
+
+
+def open_deck(library, deck_id):
+    deck = library.get(deck_id, served=True)
+    for key in list(st.session_state.keys()):
+        del st.session_state[key]
+    initialize_state()
+    st.session_state.response_data = {**deck["response"], "library": {"id": deck["id"], "topic": deck["topic"], "similarity": 1.0}}
+    st.session_state.last_prompt = deck["topic"]
+
+@fragment
+def render_library_browser(library, page_size=10):
+    with st.expander("Deck library"):
+        query = st.text_input("Search saved decks", key="library_query")
+        page = st.number_input("Page", min_value=1, value=1, step=1, key="library_page")
+        # One page at a time, however many decks are saved
+        decks = library.search(query, page, page_size) if query.strip() else library.list(page, page_size)
+        if not decks:
+            st.info("No saved decks found.")
+            return
+        for deck in decks:
+            col1, col2 = st.columns([5, 1])
+            with col1:
+                st.markdown(f"**{deck['topic']}** · {deck['facts']} facts, {deck['questions']} questions")
+                if deck.get("snippet"):
+                    st.caption(deck["snippet"])
+            with col2:
+                if st.button("Open", key=f"library_open_{deck['id']}"):
+                    open_deck(library, deck["id"])
+                    st.rerun()
 
 
 # ---------- Main App ----------
 
-def mainUI(debugUI=False):
+def mainUI(debugUI=False, debugMetrics=False):
     setupUI()
     initialize_state()
 
-    engine = KnowledgeEngine() if not debugUI else None
+    engine = get_engine() if not debugUI else None
+    exporter = engine.exporter if engine else get_exporter()
 
     # Header
     col1, col2 = st.columns([1, 6])
@@ -308,12 +372,20 @@ def mainUI(debugUI=False):
         unsafe_allow_html=True
     )
 
-    # Input
+    # Input (decks already in the library are served without generating them again)
     prompt = st.text_input("Enter your theme:")
+    # Per-request theme extraction: spaCy and Wikidata (falls back to the LLM when unsure) or the LLM
+    local_themes = st.toggle(
+        "Fast theme extraction",
+        value=bool(engine) and engine.theme_extractor == "local",
+        help="Find the themes locally instead of asking the LLM (the LLM is still used for unclear prompts)."
+    )
+    extractor = "local" if local_themes else "llm"
     if st.button("Generate", type="primary") and prompt:
         # --- Full session cleanup (except prompt) ---
         for key in list(st.session_state.keys()):
             del st.session_state[key]
+        initialize_state()
 
         # Optionally re-set prompt (if needed after clearing)
         st.session_state["last_prompt"] = prompt
@@ -328,8 +400,25 @@ def mainUI(debugUI=False):
                     ],
                     "summary": "This is a concise summary explaining the topic in a few lines."
                 }
+            elif engine.lazy_refinement:
+                # Only the summary now: facts and questions are generated when their tab is opened
+                response = engine.getLazyResponse(prompt, extractor=extractor)
             else:
-                response = engine.getCombinedResponse(prompt)
+                response = None
+                preview = st.empty()
+                partial = {"facts": [], "questions": [], "summary": None}
+
+                # Show facts and questions as soon as they are streamed
+                for key, value in engine.getCombinedResponseStream(prompt, extractor=extractor):
+                    if key == "result":
+                        response = value
+                    elif key == "summary":
+                        partial["summary"] = value
+                    else:
+                        partial[key].append(value)
+                        with preview.container():
+                            render_stream_preview(partial)
+                preview.empty()
 
             st.session_state.response_data = response
             st.session_state.last_prompt = prompt
@@ -341,4 +430,16 @@ def mainUI(debugUI=False):
         prompt = st.session_state.last_prompt
 
     if st.session_state.response_data:
-        showResponseCard(prompt, st.session_state.response_data)
+        showResponseCard(prompt, st.session_state.response_data, exporter)
+        render_deck_export(prompt, st.session_state.response_data, exporter)
+        if st.session_state.response_data.get("library"):
+            st.caption(f"From the deck library (saved for \"{st.session_state.response_data['library']['topic']}\").")
+        # Parts cut short to meet RESPONSE_DEADLINE
+        if st.session_state.response_data.get("degraded"):
+            st.caption("Generated in a hurry: " + "; ".join(st.session_state.response_data["degraded"].values()) + ".")
+
+    if engine and engine.library:
+        render_library_browser(engine.library)
+
+    if debugMetrics and engine:
+        render_debug_sidebar(engine)
@@ -0,0 +1,270 @@
+"""
+Headless batch deck generation.
+
+Runs KnowledgeEngine.getDeck (the deck with its themes and triples) for every topic of a file
+across a pool of worker processes, streaming each deck to a JSONL file as soon as it is ready.
+Finished topics are recorded in a checkpoint file so an interrupted run can be resumed without
+regenerating them (decks already in the output count as finished too, even if the run was killed
+before their checkpoint line was written).
+
+Usage:
+    python src/batch.py topics.txt -o decks.jsonl --workers 4
+    python src/batch.py topics.txt -o decks.jsonl --max-llm 2 --max-sparql 5 --report report.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from KnowledgeEngine import KnowledgeEngine
+
+# Engine of the current worker process
+_engine = None
+
+
+def initWorker(keys_path, semaphores, verbose, workers=1):
+    """
+    Create the engine of a worker process and install the global per-backend concurrency caps.
+    Args:
+        keys_path (str): Path to the keys.json file (None for the default).
+        semaphores (dict): Shared semaphores per endpoint name (openrouter, sparql, wikidata).
+        verbose (bool): Keep the engine's log output.
+        workers (int): Number of worker processes, which share the engine's rate limits (RATE_LIMITS).
+    """
+    global _engine
+    if not verbose:
+        sys.stdout = open(os.devnull, "w")
+    _engine = KnowledgeEngine(keys_path)
+    for endpoint, semaphore in semaphores.items():
+        _engine.transport.setConcurrencyLimit(endpoint, semaphore)
+    # Every process has its own token buckets: split the rates so the whole pool stays within them
+    for endpoint, bucket in list(_engine.transport.limits.items()):
+        _engine.transport.setRateLimit(endpoint, bucket.rate / workers, max(1, bucket.capacity / workers))
+
+
+def generateDeck(topic):
+    """
+    Generate the deck of one topic in a worker process.
+    Args:
+        topic (str): The topic.
+    Returns:
+        dict: The topic, the response (or an error), what it was generated from (themes, themes_id and
+            triples, for src/DeckLibrary.py import) and the seconds spent per stage.
+    """
+    start = time.perf_counter()
+    try:
+        deck = _engine.getDeck(topic) or {}
+        error = None if deck.get("response") else "No response generated"
+    except Exception as e:
+        deck, error = {}, f"{e.__class__.__name__}: {e}"
+
+    return {
+        "topic": topic,
+        "response": deck.get("response"),
+        "themes": deck.get("themes", []),
+        "themes_id": deck.get("themes_id", {}),
+        "triples": deck.get("triples", []),
+        "model": _engine.modelFor("refine"),
+        "error": error,
+        "seconds": time.perf_counter() - start,
+        "stages": lastTraceStages(_engine.tracer)
+    }
+
+
+def lastTraceStages(tracer):
+    """
+    Sum the seconds spent per stage in the most recent trace of a tracer.
+    Args:
+        tracer (Tracer): The engine tracer.
+    Returns:
+        dict: A dictionary mapping stage names to seconds.
+    """
+    spans = tracer.recentSpans(limit=1000)
+    roots = [span for span in spans if span["parent"] is None]
+    if not roots:
+        return {}
+    stages = {}
+    for span in spans:
+        if span["trace"] == roots[-1]["trace"]:
+            stages[span["stage"]] = stages.get(span["stage"], 0.0) + span["duration"]
+    return stages
+
+
+def readTopics(path):
+    """
+    Read the topics file: one topic per line (blank lines and # comments are skipped),
+    or JSON lines with a "topic" field. Duplicates are dropped.
+    Args:
+        path (str): The topics file.
+    Returns:
+        list: The topics, in file order.
+    """
+    topics = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                line = json.loads(line)["topic"].strip()
+            topics.append(line)
+    return list(dict.fromkeys(topics))
+
+
+def readFinished(path):
+    """
+    Read the finished topics of a checkpoint or output file: the topics of its lines without an error.
+    A line cut short by a killed run is skipped.
+    Args:
+        path (str): The JSONL file.
+    Returns:
+        set: The finished topics.
+    """
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                data = json.loads(line)
+            except ValueError:
+                continue
+            if not data.get("error"):
+                finished.add(data["topic"])
+    return finished
+
+
+def endPartialLine(path):
+    # A run killed in the middle of a line leaves it unterminated: start the next line on its own
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, "rb+") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+
+
+def appendLine(f, data):
+    # Flush and sync every line so a killed run never loses a finished deck
+    f.write(json.dumps(data, ensure_ascii=False) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def runBatch(topics, output_path, checkpoint_path, workers, caps, keys_path=None, verbose=False):
+    """
+    Generate the decks of all topics that aren't in the checkpoint yet.
+    Args:
+        topics (list): The topics to generate.
+        output_path (str): JSONL file receiving one line per generated deck (appended).
+        checkpoint_path (str): JSONL file listing the finished topics (appended).
+        workers (int): Number of worker processes.
+        caps (dict): Maximum requests in flight per endpoint name, across all workers.
+        keys_path (str): Path to the keys.json file (None for the default).
+        verbose (bool): Keep the engine's log output.
+    Returns:
+        dict: The run report.
+    """
+    # A deck written to the output just before a kill isn't in the checkpoint yet: it is finished too
+    finished = readFinished(checkpoint_path) | readFinished(output_path)
+    pending = [topic for topic in topics if topic not in finished]
+    print(f"[Batch]: {len(topics)} topics, {len(topics) - len(pending)} already done, {len(pending)} to generate")
+
+    report = {"topics": len(topics), "skipped": len(topics) - len(pending), "done": 0, "failed": 0, "failures": {}, "stages": {}}
+    start = time.perf_counter()
+    endPartialLine(output_path)
+    endPartialLine(checkpoint_path)
+
+    with multiprocessing.Manager() as manager, \
+            open(output_path, "a", encoding="utf-8") as output, \
+            open(checkpoint_path, "a", encoding="utf-8") as checkpoint:
+        semaphores = {endpoint: manager.BoundedSemaphore(cap) for endpoint, cap in caps.items() if cap}
+        with ProcessPoolExecutor(max_workers=workers, initializer=initWorker, initargs=(keys_path, semaphores, verbose, workers)) as executor:
+            # Keep a bounded number of topics queued so results stream out as they complete
+            queue = iter(pending)
+            running = set()
+            try:
+                while True:
+                    while len(running) < workers * 2:
+                        topic = next(queue, None)
+                        if topic is None:
+                            break
+                        running.add(executor.submit(generateDeck, topic))
+                    if not running:
+                        break
+
+                    completed, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in completed:
+                        result = future.result()
+                        appendLine(output, result)
+                        for stage, seconds in result["stages"].items():
+                            report["stages"][stage] = report["stages"].get(stage, 0.0) + seconds
+                        if result["error"]:
+                            report["failed"] += 1
+                            report["failures"][result["topic"]] = result["error"]
+                            print(f"[Batch - Failed]: {result['topic']} ({result['error']})")
+                        else:
+                            report["done"] += 1
+                            appendLine(checkpoint, {"topic": result["topic"]})
+                            print(f"[Batch - Done]: {result['topic']} ({result['seconds']:.1f}s)")
+            except KeyboardInterrupt:
+                print("[Batch]: Interrupted, finished topics are saved in the checkpoint")
+                for future in running:
+                    future.cancel()
+                raise
+
+    elapsed = time.perf_counter() - start
+    generated = report["done"] + report["failed"]
+    report["seconds"] = elapsed
+    report["throughput_per_minute"] = 60 * report["done"] / elapsed if elapsed else 0.0
+    report["stage_mean_seconds"] = {stage: seconds / generated for stage, seconds in report["stages"].items()} if generated else {}
+    return report
+
+
+def printReport(report):
+    print()
+    print(f"Topics: {report['topics']}  done: {report['done']}  failed: {report['failed']}  skipped: {report['skipped']}")
+    print(f"Wall time: {report['seconds']:.1f}s  throughput: {report['throughput_per_minute']:.2f} topics/min")
+    if report["stages"]:
+        print(f"\n  {'stage':<22} {'total (s)':>10} {'mean (s)':>10}")
+        for stage, seconds in sorted(report["stages"].items(), key=lambda item: -item[1]):
+            print(f"  {stage:<22} {seconds:>10.1f} {report['stage_mean_seconds'][stage]:>10.2f}")
+    for topic, error in report["failures"].items():
+        print(f"  failed: {topic}: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate flashcard decks for a file of topics.")
+    parser.add_argument("topics", help="File with one topic per line (or JSON lines with a \"topic\" field).")
+    parser.add_argument("-o", "--output", default="decks.jsonl", help="JSONL file receiving the generated decks.")
+    parser.add_argument("--checkpoint", help="Checkpoint file (defaults to <output>.checkpoint).")
+    parser.add_argument("--workers", type=int, default=4, help="Number of worker processes.")
+    parser.add_argument("--max-llm", type=int, default=4, help="Maximum OpenRouter requests in flight across workers.")
+    parser.add_argument("--max-sparql", type=int, default=5, help="Maximum SPARQL queries in flight across workers.")
+    parser.add_argument("--max-wikidata", type=int, default=10, help="Maximum Wikidata API requests in flight across workers.")
+    parser.add_argument("--keys", help="Path to the keys.json file.")
+    parser.add_argument("--report", help="Write the final report to this JSON file.")
+    parser.add_argument("--verbose", action="store_true", help="Show the engine's log output.")
+    args = parser.parse_args()
+
+    caps = {"openrouter": args.max_llm, "sparql": args.max_sparql, "wikidata": args.max_wikidata}
+    report = runBatch(
+        readTopics(args.topics),
+        args.output,
+        args.checkpoint or f"{args.output}.checkpoint",
+        args.workers,
+        caps,
+        keys_path=args.keys,
+        verbose=args.verbose
+    )
+    printReport(report)
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
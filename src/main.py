@@ -1,4 +1,4 @@
 from UI import mainUI
 
 if __name__ == "__main__":
-    mainUI(debugUI=False)
\ No newline at end of file
+    mainUI(debugUI=False, debugMetrics=False)
\ No newline at end of file
@@ -0,0 +1,37 @@
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from FakeServices import FakeServices  # noqa: E402
+from KnowledgeEngine import KnowledgeEngine  # noqa: E402
+
+# Fast fake services: the tests check behaviour, not latency
+FAST_CONFIG = {
+    "openrouter": {"latency": 0.01, "jitter": 0.0, "tokens_per_second": 100000},
+    "sparql": {"latency": 0.01, "per_entity": 0.0, "jitter": 0.0},
+    "wikidata": {"latency": 0.0, "jitter": 0.0}
+}
+
+
+@pytest.fixture
+def services():
+    with FakeServices(FAST_CONFIG, seed=1) as services:
+        yield services
+
+
+@pytest.fixture
+def keys_path(services, tmp_path):
+    path = tmp_path / "keys.json"
+    path.write_text(json.dumps(services.keys(CACHE_ENABLED=False, DECK_LIBRARY_PATH=str(tmp_path / "decks.sqlite"))))
+    return str(path)
+
+
+@pytest.fixture
+def engine(keys_path):
+    return KnowledgeEngine(keys_path)
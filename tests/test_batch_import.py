@@ -0,0 +1,23 @@
+import json
+
+import batch
+from DeckLibrary import DeckLibrary, importDecks
+from KnowledgeEngine import normalizePrompt
+
+
+def test_batch_output_line_imports_with_its_themes(engine, tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, "_engine", engine)
+    line = batch.generateDeck("Photosynthesis")
+    assert line["error"] is None and line["themes"][0] == "Photosynthesis" and line["triples"]
+    # Metadata added by a library hit must not be saved with the deck
+    line["response"]["library"] = {"id": 1, "topic": "Photosynthesis", "similarity": 1.0, "match": "exact"}
+
+    output = tmp_path / "decks.jsonl"
+    output.write_text(json.dumps(line) + "\n")
+    library = DeckLibrary(str(tmp_path / "imported.sqlite"), normalize=normalizePrompt)
+    assert importDecks(library, str(output)) == 1
+
+    deck = library.findEntity(line["themes_id"]["Photosynthesis"], line["themes"])
+    assert deck is not None and deck["topic"] == "Photosynthesis"
+    assert deck["themes"] == line["themes"] and deck["qids"] == line["themes_id"]
+    assert deck["triples"] == line["triples"] and "library" not in deck["response"]
@@ -0,0 +1,25 @@
+from concurrent.futures import CancelledError
+
+import pytest
+
+from KnowledgeEngine import TRIPLES_QUERY_VERSION
+
+
+def test_interrupted_leader_cancels_its_followers(engine, monkeypatch):
+    key = engine.cache.key("sparql", engine.sparql_endpoint, "Q1", engine.triples_per_entity, TRIPLES_QUERY_VERSION)
+    followers = []
+
+    def interrupted(qids):
+        # Another call joins the flight while the leader's query is running, then the leader is interrupted
+        followers.append(engine.flights.join("sparql", key))
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(engine, "fetchTriplesBatch", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        engine.entityTriples(["Q1"])
+
+    call, leader = followers[0]
+    assert not leader
+    with pytest.raises(CancelledError):
+        call.result(timeout=0)
+    assert engine.flights.inFlight() == 0
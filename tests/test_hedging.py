@@ -0,0 +1,42 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from Hedging import HedgeCancelled
+from HttpTransport import Cancellation
+
+
+@pytest.fixture(params=[b"", b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n"],
+                ids=["before headers", "before first event"])
+def stalled_url(request):
+    """A server that reads the request, sends the parametrized bytes and then stalls."""
+    server = socket.create_server(("127.0.0.1", 0))
+    connections = []
+
+    def serve():
+        while True:
+            try:
+                connection, _ = server.accept()
+            except OSError:
+                return
+            connections.append(connection)
+            connection.recv(65536)
+            connection.sendall(request.param)
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield f"http://127.0.0.1:{server.getsockname()[1]}/chat"
+    server.close()
+    for connection in connections:
+        connection.close()
+
+
+def test_cancel_stops_a_stalled_attempt(engine, stalled_url):
+    cancel = Cancellation()
+    threading.Timer(0.3, cancel.set).start()
+    start = time.monotonic()
+    with pytest.raises(HedgeCancelled):
+        engine.cancellableCompletion({"model": "fake"}, {}, stalled_url, cancel)
+    # Well before the 30 seconds read timeout of the attempt
+    assert time.monotonic() - start < 5
@@ -0,0 +1,50 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from HttpTransport import HttpTransport
+
+
+@pytest.fixture
+def server():
+    """A local server answering every request with the status (and headers) of its path, e.g. /502."""
+    hits = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def respond(self):
+            hits.append((self.command, self.path))
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            status, _, retry_after = self.path.strip("/").partition("/")
+            self.send_response(int(status))
+            if retry_after:
+                self.send_header("Retry-After", retry_after)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        do_GET = do_POST = respond
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}", hits
+    httpd.shutdown()
+
+
+@pytest.mark.parametrize("method, path, attempts", [
+    ("GET", "/502", 3),
+    ("POST", "/500", 1),
+    ("POST", "/502", 1),
+    ("POST", "/504", 1),
+    ("POST", "/429", 3),
+    ("POST", "/503", 3),
+    ("POST", "/502/0", 3),
+])
+def test_post_is_only_resent_when_rejected(server, method, path, attempts):
+    url, hits = server
+    transport = HttpTransport(max_retries=2, backoff_base=0.001)
+    response = transport.request(method, url + path, endpoint="test", data=b"{}", timeout=5)
+    assert response.status_code == int(path.split("/")[1])
+    assert len(hits) == attempts
@@ -0,0 +1,21 @@
+import requests
+
+
+class FailingTransport:
+    # Stand-in for the HTTP transport while the Wikidata API is unreachable
+    def get(self, url, **kwargs):
+        raise requests.ConnectionError("Wikidata API unreachable")
+
+
+def test_labels_unavailable_during_fetch_are_resolved_on_the_next_read(engine, monkeypatch):
+    with monkeypatch.context() as patch:
+        patch.setattr(engine.labels, "transport", FailingTransport())
+        claims = engine.entityTriples(["Q1"])["Q1"]
+    # The labels fell back to the IDs...
+    assert claims and all(relation == pid for relation, _, pid, _ in claims)
+
+    # ...but the claims were cached without them, so they resolve once the API is back
+    claims = engine.entityTriples(["Q1"])["Q1"]
+    assert all(relation != pid for relation, _, pid, _ in claims)
+    assert all(obj != value_id for _, obj, _, value_id in claims if value_id)
+    assert engine.cache.stats()["sparql"]["memory_hits"] >= 1